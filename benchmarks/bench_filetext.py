@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# pyflyby/benchmarks/bench_filetext.py.
+# Copyright (C) 2017 Karl Chen.
+# License: MIT http://opensource.org/licenses/MIT
+
+"""
+Benchmark L{FileText} slicing on a large synthetic source file.
+
+Generates a module of C{--lines} lines (100,000 by default) and, for each
+scenario, measures the time and the peak memory use of a fresh process that
+reads the file and:
+  - C{slice}: slices it into one L{FileText} per line, by position, as
+    statement splitting does;
+  - C{slice+join}: additionally materializes the text of every slice;
+  - C{concatenate}: concatenates all of the slices back together;
+  - C{statements}: splits it into L{PythonStatement}s.
+"""
+
+from __future__ import absolute_import, division, with_statement
+
+import optparse
+import os
+import resource
+import subprocess
+import sys
+from   tempfile                 import mkstemp
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "lib", "python"))
+
+from   pyflyby._file            import FilePos, FileText, Filename, read_file
+from   pyflyby._parse           import PythonBlock
+
+
+SCENARIOS = ["read", "slice", "slice+join", "concatenate", "statements"]
+
+
+def make_source(filename, num_lines):
+    with open(filename, 'w') as f:
+        f.write("from os import path\n")
+        for i in range(num_lines - 1):
+            f.write("x%d = path.join('a', %r)  # comment\n" % (i, "b" * (i%40)))
+
+
+def slice_lines(text):
+    endpos = text.endpos
+    result = []
+    for lineno in xrange(text.startpos.lineno, endpos.lineno):
+        result.append(text[FilePos(lineno, 1):FilePos(lineno+1, 1)])
+    return result
+
+
+def run_scenario(scenario, filename):
+    """
+    Run C{scenario} on C{filename} in this process.
+
+    @return:
+      C{(elapsed, peak_rss_kb)}
+    """
+    start = time.time()
+    text = read_file(Filename(filename))
+    if scenario == "read":
+        text.endpos
+    elif scenario == "slice":
+        slices = slice_lines(text)
+    elif scenario == "slice+join":
+        slices = slice_lines(text)
+        for s in slices:
+            s.joined
+    elif scenario == "concatenate":
+        slices = slice_lines(text)
+        assert FileText.concatenate(slices).joined == text.joined
+    elif scenario == "statements":
+        PythonBlock(text).statements
+    else:
+        raise ValueError("unknown scenario %r" % (scenario,))
+    elapsed = time.time() - start
+    return elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--lines", type="int", default=100000,
+                      help="Number of lines in the source file "
+                      "(default %default)")
+    parser.add_option("--scenario", choices=SCENARIOS,
+                      help="Run only this scenario in this process "
+                      "(used internally)")
+    parser.add_option("--filename",
+                      help="Source file to use (used internally)")
+    options, args = parser.parse_args()
+    if args:
+        parser.error("unexpected arguments")
+    if options.scenario:
+        elapsed, rss = run_scenario(options.scenario, options.filename)
+        print elapsed, rss
+        return
+    fd, filename = mkstemp(prefix="pyflyby_bench_filetext_", suffix=".py")
+    os.close(fd)
+    try:
+        make_source(filename, options.lines)
+        print "%d lines, %d bytes" % (
+            options.lines, os.path.getsize(filename))
+        for scenario in SCENARIOS:
+            output = subprocess.check_output(
+                [sys.executable, os.path.abspath(__file__),
+                 "--scenario", scenario, "--filename", filename])
+            elapsed, rss = output.split()
+            print "%-12s %8.2f ms  %8.1f MB peak RSS" % (
+                scenario, float(elapsed) * 1000, int(rss) / 1024)
+    finally:
+        os.unlink(filename)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# pyflyby/benchmarks/bench_submodules.py.
+# Copyright (C) 2017 Karl Chen.
+# License: MIT http://opensource.org/licenses/MIT
+
+"""
+Benchmark submodule enumeration on a synthetic package tree.
+
+Creates a package with C{--packages} subpackages of C{--modules} modules each
+(10,000 modules by default), both as a directory tree and as a zip file, and
+times enumerating all of them with C{pkgutil.iter_modules} and with
+pyflyby's cached enumeration (cold and warm).
+"""
+
+from __future__ import absolute_import, division, with_statement
+
+import optparse
+import os
+import pkgutil
+from   shutil                   import rmtree
+import sys
+from   tempfile                 import mkdtemp
+import time
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "lib", "python"))
+
+from   pyflyby._modules         import (_iter_modules, _listdir_cache,
+                                        _zip_modules_cache)
+
+
+def make_tree(root, num_packages, num_modules):
+    """
+    Create C{root}/benchpkg with the given number of subpackages and modules,
+    and a zip file C{root}/benchpkg.zip with the same contents.
+
+    @return:
+      C{(dirname, zipname)}
+    """
+    pkgdir = os.path.join(root, "benchpkg")
+    zipname = os.path.join(root, "benchpkg.zip")
+    os.mkdir(pkgdir)
+    with zipfile.ZipFile(zipname, 'w') as zf:
+        open(os.path.join(pkgdir, "__init__.py"), 'w').close()
+        zf.writestr("benchpkg/__init__.py", "")
+        for i in range(num_packages):
+            subdir = os.path.join(pkgdir, "sub%d" % i)
+            os.mkdir(subdir)
+            open(os.path.join(subdir, "__init__.py"), 'w').close()
+            zf.writestr("benchpkg/sub%d/__init__.py" % i, "")
+            for j in range(num_modules):
+                open(os.path.join(subdir, "mod%d.py" % j), 'w').close()
+                zf.writestr("benchpkg/sub%d/mod%d.py" % (i, j), "")
+    return pkgdir, os.path.join(zipname, "benchpkg")
+
+
+def enumerate_pkgutil(pkgdir):
+    count = 0
+    for _, name, ispkg in pkgutil.iter_modules([pkgdir]):
+        if ispkg:
+            for t in pkgutil.iter_modules([os.path.join(pkgdir, name)]):
+                count += 1
+    return count
+
+
+def enumerate_pyflyby(pkgdir):
+    count = 0
+    for name, ispkg in _iter_modules([pkgdir]):
+        if ispkg:
+            for t in _iter_modules([os.path.join(pkgdir, name)]):
+                count += 1
+    return count
+
+
+def timeit(func, arg, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        count = func(arg)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, count
+
+
+def clear_caches():
+    _listdir_cache.clear()
+    _zip_modules_cache.clear()
+    sys.path_importer_cache.clear()
+
+
+def cold(func):
+    def wrapped(arg):
+        clear_caches()
+        return func(arg)
+    return wrapped
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--packages", type="int", default=100,
+                      help="Number of subpackages (default %default)")
+    parser.add_option("--modules", type="int", default=100,
+                      help="Number of modules per subpackage "
+                      "(default %default)")
+    parser.add_option("--repeat", type="int", default=5,
+                      help="Take the best of this many runs "
+                      "(default %default)")
+    options, args = parser.parse_args()
+    if args:
+        parser.error("unexpected arguments")
+    root = mkdtemp(prefix="pyflyby_bench_submodules_", suffix=".tmp")
+    try:
+        pkgdir, zippkg = make_tree(root, options.packages, options.modules)
+        print "%d packages x %d modules" % (options.packages, options.modules)
+        for label, path in [("directory", pkgdir), ("zip", zippkg)]:
+            for name, func in [("pkgutil",       cold(enumerate_pkgutil)),
+                               ("pyflyby cold",  cold(enumerate_pyflyby)),
+                               ("pyflyby warm",  enumerate_pyflyby)]:
+                elapsed, count = timeit(func, path, options.repeat)
+                print "%-10s %-14s %6d modules  %8.2f ms" % (
+                    label, name, count, elapsed * 1000)
+    finally:
+        rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -15,9 +15,10 @@ import types
 
 from   pyflyby._file            import FileText, Filename
 from   pyflyby._flags           import CompilerFlags
-from   pyflyby._idents          import DottedIdentifier, is_identifier
+from   pyflyby._idents          import (DottedIdentifier, brace_identifiers,
+                                        is_identifier)
 from   pyflyby._importdb        import ImportDB
-from   pyflyby._importstmt      import Import
+from   pyflyby._importstmt      import Import, ImportStatement
 from   pyflyby._log             import logger
 from   pyflyby._modules         import ModuleHandle
 from   pyflyby._parse           import PythonBlock, infer_compile_mode
@@ -549,6 +550,442 @@ def _find_missing_imports_in_ast(node, namespaces):
         logger.debug("ast=%s", ast.dump(node))
     return _MissingImportFinder(namespaces).find_missing_imports(node)
 
+
+class _ImportBinding(object):
+    """
+    A name bound by an import statement, as tracked by
+    L{_UnusedAndMissingImportFinder}.
+
+    @iattr imp:
+      The L{Import}.
+    @iattr linenos:
+      Line numbers of the statements that import it.  Repeating an identical
+      import in the same scope and import block adds to this list rather than
+      creating a new binding.
+    @iattr block:
+      Number of the import block the binding is in: consecutive top-level
+      import statements, or a top-level compound statement such as a
+      C{try}/C{except ImportError}.
+    @iattr used:
+      Whether the binding has been referenced.
+    @iattr replaced:
+      Whether a later store replaced the binding.
+    @iattr shadowed:
+      Earlier import bindings of the same name that this one replaced without
+      making them unused, e.g. alternative imports in a C{try}/C{except
+      ImportError}, or C{import a} followed by C{import a.b}.  They are unused
+      if this one is.
+    """
+    __slots__ = ('imp', 'linenos', 'block', 'used', 'replaced', 'shadowed')
+
+    def __init__(self, imp, lineno, block):
+        self.imp = imp
+        self.linenos = [lineno]
+        self.block = block
+        self.used = False
+        self.replaced = False
+        self.shadowed = []
+
+    @property
+    def is_submodule(self):
+        # 'import a.b' binds 'a', but so does 'import a.c'; neither makes the
+        # other redundant.
+        return '.' in self.imp.import_as
+
+
+# Marker stored in a function's scope for names declared C{global} there.
+_GLOBAL_DECLARATION = object()
+
+# Module-level names that are defined without being in C{__builtin__}.
+_MAGIC_GLOBALS = frozenset(['__file__', '__builtins__', '__path__',
+                            '__module__', 'WindowsError'])
+
+
+class _UnusedAndMissingImportFinder(_MissingImportFinder):
+    """
+    A helper class to be used only by
+    L{pyflyby._imports2s.find_unused_and_missing_imports}.
+
+    This extends the scope model of L{_MissingImportFinder} to also track
+    which imports are used.  Only base names are considered, i.e. C{foo.bar}
+    is a use of C{foo}, and builtins count as defined.
+
+    Uses in doctests (see L{scan_soft}), uses in strings such as C{"L{foo}"}
+    or C{"{foo}".format}, and uses inside a C{try} block that handles
+    C{NameError} are "soft": they make imports used, but undefined names
+    there aren't reported as missing.
+
+    Like pyflakes, an unused import that is redefined at the top level of the
+    module is reported as unused, but not if the redefinition is
+    conditional (e.g. in an C{except ImportError} clause) or a loop
+    variable.  Repeating an import counts as a redefinition unless it is
+    in the same import block.  The name bound by C{except ... as name} at
+    module level is a redefinition too, even though it's conditional.
+    """
+
+    def __init__(self):
+        super(_UnusedAndMissingImportFinder, self).__init__([{}])
+        self._module_scope = self.scopestack[-1]
+        self.missing_imports = []
+        # All import bindings.
+        self._bindings = []
+        # Import bindings that were replaced while unused.
+        self._redefined = []
+        # Names in __all__.
+        self._all_names = set()
+        # Names with soft uses.
+        self._soft_names = set()
+        # Scopes (by id) that contain a 'from ... import *'.
+        self._star_scopes = set()
+        # Nesting depth of conditional/loop blocks within the current scope.
+        self._depth = 0
+        # Number of the current import block; see L{_ImportBinding.block}.
+        self._block = 0
+        self._loop_target = False
+        self._name_error_handled = 0
+        self._soft = False
+        self._import_blocks = ()
+
+    def scan(self, node, import_blocks=()):
+        """
+        Analyze the module AST C{node}.
+
+        @param import_blocks:
+          Sequence of C{(first_lineno, last_lineno, imports)} for top-level
+          blocks of import statements.  The import statements of C{node} on
+          those lines are ignored; instead, C{imports} are imported at the
+          position of the block, with line number C{first_lineno}.  This
+          allows analyzing code whose import blocks have been changed since
+          C{node} was parsed.
+        """
+        self._import_blocks = import_blocks
+        self.visit(node)
+        self._finish_deferred_load_checks()
+
+    def scan_soft(self, node):
+        """
+        Analyze the AST C{node} of doctests in the module.  The doctests are
+        analyzed together in a scope on top of the module scope.  Their loads
+        only count as soft uses, and their imports aren't tracked.
+        """
+        self._soft = True
+        try:
+            with self._NewScopeCtx():
+                self.visit(node)
+                self._finish_deferred_load_checks()
+        finally:
+            self._soft = False
+
+    @property
+    def has_unused_imports(self):
+        return bool(self._redefined) or any(
+            not b.used and not b.replaced for b in self._bindings)
+
+    @property
+    def unused_imports(self):
+        """
+        The unused imports, sorted by line number.
+
+        @rtype:
+          C{list} of C{(}L{Import}C{, lineno)}
+        """
+        result = set()
+        def add(binding):
+            if binding.used:
+                return
+            result.update((binding.imp, lineno) for lineno in binding.linenos)
+            for shadowed in binding.shadowed:
+                add(shadowed)
+        for binding in self._redefined:
+            # An explicit reference in a doctest or string counts even if it
+            # really refers to the redefinition.
+            if binding.imp.import_as.split('.')[0] not in self._soft_names:
+                add(binding)
+        for binding in self._bindings:
+            if not binding.replaced:
+                add(binding)
+        return sorted(result, key=lambda (imp, lineno): (lineno, imp))
+
+    def generic_visit(self, node):
+        # Like _MissingImportFinder.generic_visit(), without the type checks.
+        # This visitor sees every node of the module, so it's worth being
+        # fast.
+        for field in node._fields:
+            value = getattr(node, field, None)
+            if isinstance(value, ast.AST):
+                self.visit(value)
+            elif isinstance(value, list):
+                for item in value:
+                    if isinstance(item, ast.AST):
+                        self.visit(item)
+
+    @contextlib.contextmanager
+    def _DepthCtx(self):
+        self._depth += 1
+        try:
+            yield
+        finally:
+            self._depth -= 1
+
+    def visit_Module(self, node):
+        if self._import_blocks:
+            self._visit_module_body_with_import_blocks(node.body)
+        else:
+            for stmt in node.body:
+                self._visit_module_stmt(stmt)
+        all_names = self._all_names
+        if all_names:
+            for name, value in self._module_scope.items():
+                if name in all_names and isinstance(value, _ImportBinding):
+                    value.used = True
+
+    def _visit_module_body_with_import_blocks(self, body):
+        blocks = sorted(self._import_blocks)
+        visited = set()
+        for stmt in body:
+            if isinstance(stmt, (ast.Import, ast.ImportFrom)):
+                block = next((b for b in blocks
+                              if b[0] <= stmt.lineno <= b[1]), None)
+                if block is not None:
+                    if block[0] not in visited:
+                        visited.add(block[0])
+                        for imp in block[2]:
+                            self._visit_import(imp, block[0])
+                    continue
+            self._visit_module_stmt(stmt)
+
+    def _visit_module_stmt(self, stmt):
+        if isinstance(stmt, (ast.Import, ast.ImportFrom)):
+            self.visit(stmt)
+        else:
+            # Imports in a compound statement are in a block of their own,
+            # and so are the imports after it.
+            self._block += 1
+            self.visit(stmt)
+            self._block += 1
+
+    def visit_Import(self, node):
+        for imp in ImportStatement(node).imports:
+            self._visit_import(imp, node.lineno)
+
+    visit_ImportFrom = visit_Import
+
+    def _visit_import(self, imp, lineno):
+        if imp.split.module_name == "__future__":
+            return
+        if imp.import_as == "*":
+            self._star_scopes.add(id(self.scopestack[-1]))
+            return
+        name = imp.import_as.split('.')[0]
+        if self._soft or isinstance(self.scopestack[-1], _ClassScope):
+            self._visit_Store(name)
+        else:
+            self._visit_Store(name, _ImportBinding(imp, lineno, self._block))
+
+    def visit_Global(self, node):
+        # Be more conservative than pyflakes: a global declaration makes the
+        # function refer to the module-level binding, so an import used through
+        # it is used.
+        scope = self.scopestack[-1]
+        for name in node.names:
+            if scope is not self._module_scope:
+                scope[name] = _GLOBAL_DECLARATION
+            self._module_scope.setdefault(name, None)
+
+    def visit_Assign(self, node):
+        self.visit(node.value)
+        self.visit(node.targets)
+        self._visit_all(node.targets, node.value)
+
+    def visit_AugAssign(self, node):
+        if isinstance(node.target, ast.Name):
+            self._visit_Load(node.target.id, node.lineno)
+            self.visit(node.value)
+            self._visit_Store(node.target.id)
+        else:
+            self.visit(node.target)
+            self.visit(node.value)
+        self._visit_all([node.target], node.value)
+
+    def _visit_all(self, targets, value):
+        # Record names in a module-level '__all__ = [...]' or
+        # '__all__ += [...]'.
+        if self.scopestack[-1] is not self._module_scope:
+            return
+        if not any(isinstance(t, ast.Name) and t.id == '__all__'
+                   for t in targets):
+            return
+        if isinstance(value, (ast.List, ast.Tuple)):
+            self._all_names.update(
+                elt.s for elt in value.elts if isinstance(elt, ast.Str))
+
+    def visit_For(self, node):
+        self.visit(node.iter)
+        self._loop_target = True
+        try:
+            self.visit(node.target)
+        finally:
+            self._loop_target = False
+        with self._DepthCtx():
+            self.visit(node.body)
+            self.visit(node.orelse)
+
+    def visit_comprehension(self, node):
+        self._loop_target = True
+        try:
+            super(_UnusedAndMissingImportFinder, self).visit_comprehension(node)
+        finally:
+            self._loop_target = False
+
+    def visit_DictComp(self, node):
+        with self._NewScopeCtx(include_class_scopes=True):
+            self.visit(node.generators)
+            self.visit(node.key)
+            self.visit(node.value)
+
+    def visit_SetComp(self, node):
+        with self._NewScopeCtx(include_class_scopes=True):
+            self.visit(node.generators)
+            self.visit(node.elt)
+
+    def _visit_conditional(self, node):
+        with self._DepthCtx():
+            self.generic_visit(node)
+
+    visit_If = visit_While = visit_With = visit_TryFinally = _visit_conditional
+
+    def visit_TryExcept(self, node):
+        handles_name_error = False
+        for handler in node.handlers:
+            if isinstance(handler.type, ast.Tuple):
+                types = handler.type.elts
+            else:
+                types = [handler.type]
+            if any(isinstance(t, ast.Name) and t.id == 'NameError'
+                   for t in types):
+                handles_name_error = True
+        with self._DepthCtx():
+            if handles_name_error:
+                self._name_error_handled += 1
+            try:
+                self.visit(node.body)
+            finally:
+                if handles_name_error:
+                    self._name_error_handled -= 1
+            self.visit(node.handlers)
+            self.visit(node.orelse)
+
+    def visit_ExceptHandler(self, node):
+        if node.type is not None:
+            self.visit(node.type)
+        if isinstance(node.name, ast.Name):
+            # Like pyflakes, count 'except ... as e' at module level as
+            # redefining an unused import 'e', although it's conditional.
+            self._visit_Store(node.name.id, unconditional=True)
+        elif node.name is not None:
+            self.visit(node.name)
+        self.visit(node.body)
+
+    def visit_Str(self, node):
+        if '{' in node.s:
+            for name in brace_identifiers(node.s):
+                self._visit_Load(name, node.lineno, soft=True)
+
+    def visit_Name(self, node):
+        ctx = node.ctx
+        if isinstance(ctx, ast.Load):
+            self._visit_Load(node.id, node.lineno)
+        elif isinstance(ctx, ast.Del):
+            # Don't remove the binding; just make sure an import isn't
+            # considered unused because of a 'del'.
+            self._visit_Load(node.id, node.lineno, soft=True)
+        else:
+            self._visit_Store(node.id)
+
+    def visit_Attribute(self, node):
+        # Only the base name matters for whether an import is used or
+        # missing.
+        self.visit(node.value)
+
+    def _visit_Store(self, name, binding=None, unconditional=False):
+        if name is None:
+            # No vararg/kwarg.
+            return
+        scope = self.scopestack[-1]
+        old = scope.get(name)
+        if old is _GLOBAL_DECLARATION:
+            return
+        if isinstance(old, _ImportBinding):
+            if (binding is not None and binding.imp == old.imp and
+                binding.block == old.block):
+                # Repeated identical import in the same block.
+                if binding.linenos[0] not in old.linenos:
+                    old.linenos.append(binding.linenos[0])
+                return
+            old.replaced = True
+            if (not old.used and
+                scope is self._module_scope and
+                (self._depth == 0 or unconditional) and
+                not self._loop_target and
+                not (binding is not None and
+                     (binding.is_submodule or old.is_submodule))):
+                self._redefined.append(old)
+            elif binding is not None:
+                binding.used = old.used
+                binding.shadowed.append(old)
+        if binding is not None:
+            self._bindings.append(binding)
+        scope[name] = binding
+
+    def _visit_Load(self, name, lineno, soft=False):
+        soft = soft or self._soft or self._name_error_handled > 0
+        if soft:
+            self._soft_names.add(name)
+        scopestack = self.scopestack
+        if self._in_FunctionDef:
+            # Names stored later in this function don't count, but names
+            # stored later in enclosing scopes do (see
+            # L{_MissingImportFinder._visit_Load}).  So check the function's
+            # own scope now, and the others later.
+            try:
+                value = scopestack[-1][name]
+            except KeyError:
+                self._deferred_load_checks.append(
+                    (name, lineno, soft, scopestack[:-1]))
+                return
+            if value is _GLOBAL_DECLARATION:
+                self._deferred_load_checks.append(
+                    (name, lineno, soft, (scopestack[0], self._module_scope)))
+            elif isinstance(value, _ImportBinding):
+                value.used = True
+        elif soft:
+            self._deferred_load_checks.append((name, lineno, soft, scopestack))
+        else:
+            self._check_load(name, lineno, soft, scopestack)
+
+    def _check_load(self, name, lineno, soft, scopes):
+        for scope in reversed(scopes):
+            try:
+                value = scope[name]
+            except KeyError:
+                continue
+            if value is _GLOBAL_DECLARATION:
+                value = self._module_scope.get(name)
+            if isinstance(value, _ImportBinding):
+                value.used = True
+            return
+        if soft or name in _MAGIC_GLOBALS:
+            return
+        if any(id(scope) in self._star_scopes for scope in scopes):
+            return
+        self.missing_imports.append((name, lineno))
+
+    def _finish_deferred_load_checks(self):
+        for name, lineno, soft, scopes in self._deferred_load_checks:
+            self._check_load(name, lineno, soft, scopes)
+        self._deferred_load_checks = []
+
+
 # TODO: maybe we should replace _find_missing_imports_in_ast with
 # _find_missing_imports_in_code(compile(node)).  The method of parsing opcodes
 # is simpler, because Python takes care of the scoping issue for us and we
@@ -4,6 +4,7 @@
 
 from __future__ import absolute_import, division, with_statement
 
+import logging
 import optparse
 import os
 import signal
@@ -15,9 +16,16 @@ from   pyflyby._file            import (FileText, Filename, atomic_write_file,
                                         expand_py_files_from_args, read_file)
 from   pyflyby._importstmt      import ImportFormatParams
 from   pyflyby._log             import logger
+from   pyflyby._report          import (FileReport, ReportWriter,
+                                        report_timing, reporting_to)
+from   pyflyby._tidycache       import DEFAULT_MAX_ENTRIES, TidyCache
 from   pyflyby._util            import cached_attribute
 
 
+# Default for C{--watch-delay}.
+DEFAULT_WATCH_DELAY = 0.5
+
+
 def hfmt(s):
     return dedent(s).strip()
 
@@ -70,7 +78,6 @@ def parse_args(addopts=None, import_format_params=False, modify_action_params=Fa
 
     if modify_action_params:
         group = optparse.OptionGroup(parser, "Action options")
-        action_diff = action_external_command('pyflyby-diff')
         def parse_action(v):
             V = v.strip().upper()
             if V == 'PRINT':
@@ -113,8 +120,9 @@ def parse_args(addopts=None, import_format_params=False, modify_action_params=Fa
                    Comma-separated list of action(s) to take.  If PRINT, print
                    the changed file to stdout.  If REPLACE, then modify the
                    file in-place.  If EXECUTE:mycommand, then execute
-                   'mycommand oldfile tmpfile'.  If DIFF, then execute
-                   'pyflyby-diff'.  If QUERY, then query user to continue.
+                   'mycommand oldfile tmpfile'.  If DIFF, then print a
+                   unified diff, colorized if stdout is a terminal.  If
+                   QUERY, then query user to continue.
                    If IFCHANGED, then continue actions only if file was
                    changed.'''))
         group.add_option(
@@ -144,11 +152,92 @@ def parse_args(addopts=None, import_format_params=False, modify_action_params=Fa
             help=hfmt('''
                Equivalent to --action=IFCHANGED,DIFF,QUERY,REPLACE (default
                when stdin & stdout are ttys) '''))
-        if os.isatty(0) and os.isatty(1):
-            default_actions = actions_interactive
-        else:
-            default_actions = [action_print]
-        parser.set_default('actions', tuple(default_actions))
+        # The default actions are set after parsing, since they depend on
+        # --watch.
+        parser.set_default('actions', None)
+        group.add_option(
+            "--jobs", "-j", type='int', default=1, metavar='N',
+            help=hfmt('''
+               Process files in N worker processes (default 1).  Results
+               are still reported in filename order.  If 0, use one worker
+               per CPU.'''))
+        group.add_option(
+            "--watch", action='store_true', default=False,
+            help=hfmt('''
+               Instead of processing the given files and directories, watch
+               them and process *.py files shortly after they change, until
+               interrupted.  The default action is then IFCHANGED,REPLACE.
+               Changes to the import database are picked up.'''))
+        group.add_option(
+            "--watch-delay", type='float', default=DEFAULT_WATCH_DELAY,
+            metavar='SECONDS',
+            help=hfmt('''
+               With --watch, process changed files once nothing has changed
+               for SECONDS (default %s).''' % (DEFAULT_WATCH_DELAY,)))
+        group.add_option(
+            "--batch", action='store_true', default=False,
+            help=hfmt('''
+               Read any number of files from stdin, as NUL-terminated
+               filename and content pairs: FILENAME\\0CONTENT\\0...  Write
+               the output for each to stdout in the same format, before
+               reading the next one.  FILENAME needn't exist; it determines
+               the import database and appears in messages.  If a file can't
+               be processed, its output is its input.  Implies
+               --action=PRINT.'''))
+        group.add_option(
+            "--report", type='string', metavar='FILE', default=None,
+            help=hfmt('''
+               Write a JSON record per processed file to FILE, one per line:
+               whether it changed, the imports added and removed, the
+               undefined names that couldn't be imported, and the time
+               spent reading, parsing, analyzing, formatting and writing
+               it.'''))
+        parser.add_option_group(group)
+
+        group = optparse.OptionGroup(parser, "Git options")
+        group.add_option(
+            "--changed-since", type='string', metavar='REF', default=None,
+            help=hfmt('''
+               Only process *.py files (under the given filenames, if any)
+               that differ between REF and the working tree, plus untracked
+               files.'''))
+        group.add_option(
+            "--staged", action='store_true', default=False,
+            help=hfmt('''
+               Only process *.py files with staged changes (relative to
+               --changed-since, default HEAD), and read their content from
+               the git index instead of the working tree.  With
+               --action=replace, files with unstaged changes are not
+               replaced.'''))
+        parser.add_option_group(group)
+
+        group = optparse.OptionGroup(parser, "Cache options")
+        group.add_option(
+            "--cache", action='store_true', default=False,
+            help=hfmt('''
+               Remember which files were left unchanged, and skip them in
+               later runs if neither they, the options, the import database
+               nor pyflyby have changed.'''))
+        group.add_option(
+            "--no-cache", action='store_false', dest='cache',
+            help=hfmt('''
+               (Default) Don't use the cache of unchanged files.'''))
+        def cache_dir_callback(option, opt_str, value, parser):
+            parser.values.cache_dir = value
+            parser.values.cache = True
+        group.add_option(
+            "--cache-dir", type='string', action='callback',
+            callback=cache_dir_callback, default=None, metavar='DIR',
+            help=hfmt('''
+               Directory for the cache of unchanged files; implies --cache.
+               (Default: $PYFLYBY_CACHE_DIR/tidy.)'''))
+        group.add_option(
+            "--cache-max-entries", type='int', metavar='N',
+            default=DEFAULT_MAX_ENTRIES,
+            help=hfmt('''
+               Maximum number of files to remember in the cache (default
+               %d).  The least recently used are forgotten first.'''
+                      % (DEFAULT_MAX_ENTRIES,)))
         parser.add_option_group(group)
 
     if import_format_params:
@@ -230,9 +319,84 @@ def parse_args(addopts=None, import_format_params=False, modify_action_params=Fa
             max_line_length       =options.width,
             align_future          =options.align_future
             )
+    if modify_action_params:
+        if options.batch:
+            if options.actions not in (None, (action_print,)):
+                syntax("--batch only supports --action=PRINT")
+            if options.watch or options.staged or options.changed_since:
+                syntax("--batch is incompatible with --watch, --staged and "
+                       "--changed-since")
+            options.actions = (action_print,)
+        if options.actions is None:
+            if options.watch:
+                options.actions = (action_ifchanged, action_replace)
+            elif os.isatty(0) and os.isatty(1):
+                options.actions = tuple(actions_interactive)
+            else:
+                options.actions = (action_print,)
+        if options.watch and options.staged:
+            syntax("--watch and --staged are incompatible")
+        if options.changed_since or options.staged:
+            args = _git_changed_args(options, args)
+        if options.cache:
+            options.cache = TidyCache(_tool_cache_key(options),
+                                      directory=options.cache_dir,
+                                      max_entries=options.cache_max_entries)
+        else:
+            options.cache = None
+        if options.report:
+            try:
+                options.report = ReportWriter(options.report)
+            except IOError as e:
+                raise SystemExit("%s: --report: %s" % (sys.argv[0], e))
     return options, args
 
 
+def _git_changed_args(options, args):
+    """
+    Return the changed files under C{args} selected by C{--changed-since}
+    and C{--staged}.  Exit if there are none.
+
+    @rtype:
+      C{list} of L{Filename}s
+    """
+    from pyflyby._git import GitError, git_changed_py_files
+    try:
+        filenames = git_changed_py_files(options.changed_since,
+                                         staged=options.staged, paths=args)
+    except GitError as e:
+        raise SystemExit("%s: %s" % (sys.argv[0], e))
+    if not filenames:
+        logger.info("No changed python files")
+        raise SystemExit(0)
+    logger.debug("Changed files: %s", ' '.join(map(str, filenames)))
+    return filenames
+
+
+# Options that don't affect the output of a modify function.
+_NON_OUTPUT_OPTIONS = frozenset([
+    'actions', 'jobs', 'cache', 'cache_dir', 'cache_max_entries', 'params',
+    'changed_since', 'staged', 'server', 'watch', 'watch_delay', 'batch',
+    'report'])
+
+def _tool_cache_key(options):
+    """
+    Return a string identifying the running tool and the C{options} that can
+    affect its output, for L{TidyCache}.
+
+    @rtype:
+      C{str}
+    """
+    items = []
+    for k, v in sorted(vars(options).items()):
+        if k in _NON_OUTPUT_OPTIONS:
+            continue
+        if isinstance(v, dict):
+            v = sorted(v.items())
+        items.append((k, v))
+    return repr((os.path.basename(sys.argv[0]), items))
+
+
 def _default_on_error(filename):
     raise SystemExit("bad filename %s" % (filename,))
 
@@ -276,21 +440,70 @@ class AbortActions(Exception):
     pass
 
 
+class NeedsLocalExecution(Exception):
+    """
+    The command can't be run by a L{pyflyby._cmdserver} server on behalf of
+    a client, e.g. because it prompts the user or runs an external command;
+    the client should run it itself.
+    """
+
+
+# Whether this process is running a command on behalf of a
+# L{pyflyby._cmdserver} client.
+running_in_server = False
+
+
 class Modifier(object):
-    def __init__(self, modifier, filename):
+    def __init__(self, modifier, filename, cache=None, read_function=read_file,
+                 reporter=None):
         self.modifier = modifier
         self.filename = filename
+        self.cache = cache
+        self.read_function = read_function
+        self.reporter = reporter
+        if reporter is not None:
+            self.report = FileReport(filename)
+        else:
+            self.report = None
         self._tmpfiles = []
 
     @cached_attribute
     def input_content(self):
-        return read_file(self.filename)
+        report = self.report
+        if report is not None and "read" in report.timings:
+            # A worker process of process_actions already read the file for
+            # this report; don't count the parent's re-read.
+            report = None
+        with reporting_to(report):
+            with report_timing("read"):
+                return self.read_function(self.filename)
 
     # TODO: refactor to avoid having these heavy-weight things inside a
     # cached_attribute, which causes annoyance while debugging.
     @cached_attribute
     def output_content(self):
-        return FileText(self.modifier(self.input_content), filename=self.filename)
+        cache = self.cache
+        report = self.report
+        input_content = self.input_content
+        if cache is not None:
+            key = cache.key(input_content, self.filename)
+            if key in cache:
+                logger.debug("%s: known to be unchanged", self.filename)
+                if report is not None:
+                    report.cached = True
+                    report.changed = False
+                return input_content
+        with reporting_to(report):
+            # Parsing and formatting are timed as nested phases; the rest is
+            # analysis.
+            with report_timing("analysis"):
+                result = FileText(self.modifier(input_content),
+                                  filename=self.filename)
+        if report is not None:
+            report.changed = result != input_content
+        if cache is not None and result == input_content:
+            cache.add(key)
+        return result
 
     def _tempfile(self):
         from tempfile import NamedTemporaryFile
@@ -302,18 +515,19 @@ class Modifier(object):
     @cached_attribute
     def output_content_filename(self):
         f, fname = self._tempfile()
-        f.write(self.output_content.joined)
+        self.output_content.write_to(f)
         f.flush()
         return fname
 
     @cached_attribute
     def input_content_filename(self):
-        if isinstance(self.filename, Filename):
+        if (isinstance(self.filename, Filename) and
+            self.read_function is read_file):
             return self.filename
         # If the input was stdin, and the user wants a diff, then we need to
         # write it to a temp file.
         f, fname = self._tempfile()
-        f.write(self.input_content)
+        self.input_content.write_to(f)
         f.flush()
         return fname
 
@@ -323,27 +537,106 @@ class Modifier(object):
             f.close()
 
 
-def process_actions(filenames, actions, modify_function):
+def process_actions(filenames, actions, modify_function, jobs=1, cache=None,
+                    staged=False, watch=False,
+                    watch_delay=DEFAULT_WATCH_DELAY, batch=False,
+                    report=None):
+    """
+    Run C{actions} on each of C{filenames}, modified by C{modify_function}.
+
+    @type jobs:
+      C{int}
+    @param jobs:
+      Number of worker processes to run C{modify_function} in.  The workers
+      are forked after the first file has been processed (which loads the
+      import database), so they share it copy-on-write.  Files are handed out
+      dynamically, but the results, including log messages, are collected in
+      the parent, which runs the actions in filename order.  Interactive
+      actions therefore still prompt one file at a time.  If 0, then use one
+      worker per CPU.
+    @type cache:
+      L{TidyCache}
+    @param cache:
+      If not C{None}, then skip files that C{cache} knows
+      C{modify_function} leaves unchanged, and record the files that it
+      leaves unchanged.
+    @type staged:
+      C{bool}
+    @param staged:
+      Whether to read the input from the git index instead of from the
+      files.
+    @type watch:
+      C{bool}
+    @param watch:
+      Whether to watch C{filenames} instead, and run C{actions} on files
+      after they change, until interrupted.  Changed files are processed
+      once nothing has changed for C{watch_delay} seconds.
+    @type batch:
+      C{bool}
+    @param batch:
+      Whether to read files from stdin in the C{--batch} format instead of
+      processing C{filenames}.  C{actions} are ignored; the output for each
+      file is written to stdout in the same format.
+    @type report:
+      L{ReportWriter}
+    @param report:
+      If not C{None}, then write a L{FileReport} for each file to it, and
+      close it when done.
+    """
+    try:
+        _process_actions(filenames, actions, modify_function, jobs, cache,
+                         staged, watch, watch_delay, batch, report)
+    finally:
+        if report is not None:
+            report.close()
+
+
+def _process_actions(filenames, actions, modify_function, jobs, cache,
+                     staged, watch, watch_delay, batch, reporter):
+    if batch:
+        if running_in_server:
+            raise NeedsLocalExecution("--batch")
+        if filenames:
+            syntax("--batch reads files from stdin; got arguments")
+        _process_actions_batch(modify_function, cache, reporter)
+        return
+    if watch:
+        if running_in_server:
+            raise NeedsLocalExecution("--watch")
+        _process_actions_watch(filenames, actions, modify_function, cache,
+                               watch_delay, reporter)
+        return
+    if running_in_server:
+        for action in actions:
+            if action not in (action_print, action_ifchanged, action_replace,
+                              action_diff):
+                raise NeedsLocalExecution(
+                    "action %s" % (getattr(action, "__name__", action),))
     errors = []
     def on_error_filename_arg(arg):
         print >>sys.stderr, "%s: bad filename %s" % (sys.argv[0], arg)
         errors.append("%s: bad filename" % (arg,))
     filenames = filename_args(filenames, on_error=on_error_filename_arg)
-    for filename in filenames:
-        try:
-            m = Modifier(modify_function, filename)
-            for action in actions:
-                action(m)
-        except AbortActions:
-            continue
-        except Exception as e:
-            errors.append("%s: %s: %s" % (filename, type(e).__name__, e))
-            if str(filename) not in str(e):
-                e = type(e)("While processing %s: %s" % (filename, e))
-            if logger.debug_enabled:
-                raise e, None, sys.exc_info()[2]
-            traceback.print_exception(*sys.exc_info())
-            continue
+    read_function = read_file
+    if staged:
+        from pyflyby._git import read_git_index
+        staged_contents = read_git_index(filenames)
+        def read_function(filename):
+            return FileText(staged_contents[filename], filename=filename)
+    def make_modifier(filename):
+        return Modifier(modify_function, filename, cache, read_function,
+                        reporter)
+    if jobs == 0:
+        import multiprocessing
+        jobs = multiprocessing.cpu_count()
+    if jobs > 1 and len(filenames) > 2 and Filename.STDIN not in filenames:
+        _process_actions_parallel(filenames, actions, make_modifier, jobs,
+                                  cache, errors)
+    else:
+        for filename in filenames:
+            _run_actions(make_modifier(filename), actions, errors)
+    if cache is not None:
+        cache.prune()
     if errors:
         msg = "\n%s: encountered the following problems:\n" % (sys.argv[0],)
         for e in errors:
@@ -353,13 +646,268 @@ def process_actions(filenames, actions, modify_function):
         raise SystemExit(msg)
 
 
+def _read_nul_terminated(f):
+    """
+    Yield the NUL-terminated strings read from C{f}, plus any unterminated
+    string at the end.  Each string is yielded as soon as it's complete,
+    without waiting for more input.
+    """
+    try:
+        fd = f.fileno()
+    except (AttributeError, IOError):
+        read = f.read
+    else:
+        read = lambda size: os.read(fd, size)
+    pending = []
+    while True:
+        data = read(1 << 16)
+        if not data:
+            break
+        parts = data.split("\0")
+        for part in parts[:-1]:
+            pending.append(part)
+            yield "".join(pending)
+            pending = []
+        if parts[-1]:
+            pending.append(parts[-1])
+    if pending:
+        yield "".join(pending)
+
+
+def _process_actions_batch(modify_function, cache, reporter):
+    """
+    Implementation of L{process_actions} for C{batch=True}.
+    """
+    errors = []
+    items = _read_nul_terminated(sys.stdin)
+    for name in items:
+        try:
+            content = next(items)
+        except StopIteration:
+            errors.append("%s: missing content" % (name,))
+            break
+        output = content
+        report = FileReport(name) if reporter is not None else None
+        try:
+            filename = Filename(name)
+            m = Modifier(modify_function, filename, cache,
+                         lambda f: FileText(content, filename=f))
+            m.report = report
+            output = m.output_content
+        except Exception as e:
+            errors.append("%s: %s: %s" % (name, type(e).__name__, e))
+            if report is not None:
+                report.error = "%s: %s" % (type(e).__name__, e)
+            if logger.debug_enabled:
+                raise
+            traceback.print_exception(*sys.exc_info())
+        with reporting_to(report):
+            with report_timing("write"):
+                sys.stdout.write(name + "\0")
+                if isinstance(output, FileText):
+                    output.write_to(sys.stdout)
+                else:
+                    sys.stdout.write(output)
+                sys.stdout.write("\0")
+                sys.stdout.flush()
+        if report is not None:
+            reporter.write(report)
+    if cache is not None:
+        cache.prune()
+    if errors:
+        raise SystemExit("%s: %d of the files couldn't be processed:\n    %s"
+                         % (sys.argv[0], len(errors), "\n    ".join(errors)))
+
+
+def _process_actions_watch(pathnames, actions, modify_function, cache,
+                           delay, reporter):
+    """
+    Implementation of L{process_actions} for C{watch=True}.
+    """
+    from pyflyby import _file
+    from pyflyby._importdb import ImportDB
+    from pyflyby._watch import file_watcher
+    if not pathnames:
+        syntax("--watch needs files or directories to watch")
+    _file.mmap_enabled = False
+    try:
+        watcher = file_watcher(pathnames)
+    except OSError as e:
+        raise SystemExit("%s: %s" % (sys.argv[0], e))
+    logger.info("Watching %d files for changes", len(watcher.filenames))
+    try:
+        while True:
+            filenames = watcher.wait(delay)
+            ImportDB.clear_default_cache_if_changed(filenames)
+            errors = []
+            for filename in filenames:
+                _run_actions(Modifier(modify_function, filename, cache,
+                                      reporter=reporter),
+                             actions, errors)
+                # Don't report our own changes.
+                watcher.refresh(filename)
+            if cache is not None:
+                cache.prune()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+
+def _run_actions(m, actions, errors):
+    """
+    Run C{actions} on the L{Modifier} C{m}, recording any error in
+    C{errors}.
+    """
+    filename = m.filename
+    try:
+        for action in actions:
+            action(m)
+    except AbortActions:
+        pass
+    except Exception as e:
+        errors.append("%s: %s: %s" % (filename, type(e).__name__, e))
+        if m.report is not None:
+            m.report.error = "%s: %s" % (type(e).__name__, e)
+            m.reporter.write(m.report)
+        if str(filename) not in str(e):
+            e = type(e)("While processing %s: %s" % (filename, e))
+        if logger.debug_enabled:
+            raise e, None, sys.exc_info()[2]
+        traceback.print_exception(*sys.exc_info())
+        return
+    if m.report is not None:
+        m.reporter.write(m.report)
+
+
+class _RecordingLogHandler(logging.Handler):
+    """
+    Log handler that records formatted messages, for a worker process to
+    send to the parent.
+    """
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append((record.levelno, self.format(record)))
+
+
+# Set in the parent before forking workers; see L{_process_actions_parallel}.
+_worker_make_modifier = None
+
+def _init_worker():
+    # Let the parent handle KeyboardInterrupt.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _modify_in_worker(filename):
+    """
+    Compute the output for C{filename} in a worker process, using the
+    L{Modifier} returned by L{_worker_make_modifier}.
+
+    @rtype:
+      C{tuple}
+    @return:
+      C{(output, log_messages, error, num_cached, report)}.  C{output} is the
+      new text of the file, or C{None} if it is unchanged or there was an
+      error.  C{error} is C{None} or a C{(summary, formatted_traceback)}
+      tuple.  C{num_cached} is the number of entries added to the
+      L{TidyCache}.  C{report} is the L{FileReport}, or C{None}.
+    """
+    filename = Filename(filename)
+    handler = _RecordingLogHandler()
+    orig_handlers = logger.handlers[:]
+    logger.handlers[:] = [handler]
+    m = _worker_make_modifier(filename)
+    cache = m.cache
+    orig_num_added = cache.num_added if cache is not None else 0
+    try:
+        try:
+            if m.output_content == m.input_content:
+                output = None
+            else:
+                output = m.output_content.joined
+            error = None
+        except Exception as e:
+            output = None
+            summary = "%s: %s: %s" % (filename, type(e).__name__, e)
+            if m.report is not None:
+                m.report.error = "%s: %s" % (type(e).__name__, e)
+            if str(filename) not in str(e):
+                e = type(e)("While processing %s: %s" % (filename, e))
+            exc_info = sys.exc_info()
+            error = (summary, ''.join(traceback.format_exception(
+                type(e), e, exc_info[2])))
+    finally:
+        logger.handlers[:] = orig_handlers
+    num_cached = cache.num_added - orig_num_added if cache is not None else 0
+    return output, handler.messages, error, num_cached, m.report
+
+
+def _process_actions_parallel(filenames, actions, make_modifier, jobs,
+                              cache, errors):
+    """
+    Implementation of L{process_actions} for C{jobs} > 1.
+    """
+    import multiprocessing
+    global _worker_make_modifier
+    # Process the first file here.  Besides giving the user something to look
+    # at, this loads the import database before forking.
+    _run_actions(make_modifier(filenames[0]), actions, errors)
+    _worker_make_modifier = make_modifier
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pool = multiprocessing.Pool(jobs, _init_worker)
+    try:
+        results = pool.imap(_modify_in_worker,
+                            [str(f) for f in filenames[1:]])
+        for filename in filenames[1:]:
+            # Use a timeout so that KeyboardInterrupt isn't blocked.
+            output, log_messages, error, num_cached, report = (
+                results.next(timeout=1e9))
+            if cache is not None:
+                cache.num_added += num_cached
+            for level, message in log_messages:
+                logger.log(level, "%s", message)
+            m = make_modifier(filename)
+            if report is not None:
+                m.report = report
+            if error is not None:
+                summary, formatted_traceback = error
+                errors.append(summary)
+                sys.stderr.write(formatted_traceback)
+                if report is not None:
+                    m.reporter.write(report)
+                if logger.debug_enabled:
+                    raise SystemExit(1)
+                continue
+            if output is None:
+                m.output_content = m.input_content
+            else:
+                m.output_content = FileText(output, filename=filename)
+            _run_actions(m, actions, errors)
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        _worker_make_modifier = None
+
+
 def action_print(m):
-    output_content = m.output_content
-    sys.stdout.write(output_content.joined)
+    output = m.output_content
+    with reporting_to(m.report):
+        with report_timing("write"):
+            output.write_to(sys.stdout)
 
 
 def action_ifchanged(m):
-    if m.output_content.joined == m.input_content.joined:
+    # Compare without materializing the output, which usually shares most
+    # of its text with the input.
+    if m.output_content == m.input_content:
         logger.debug("unmodified: %s", m.filename)
         raise AbortActions
 
@@ -367,8 +915,175 @@ def action_ifchanged(m):
 def action_replace(m):
     if m.filename == Filename.STDIN:
         raise Exception("Can't replace stdio in-place")
+    if m.read_function is not read_file:
+        # The input came from elsewhere, e.g. the git index.  Don't clobber
+        # changes that are only in the file.
+        if read_file(m.filename) != m.input_content:
+            raise Exception(
+                "%s differs from the processed input (unstaged changes?); "
+                "not replacing" % (m.filename,))
+    output = m.output_content
     logger.info("%s: *** modified ***", m.filename)
-    atomic_write_file(m.filename, m.output_content)
+    with reporting_to(m.report):
+        with report_timing("write"):
+            atomic_write_file(m.filename, output)
+
+
+def _diff_opcodes(a, b):
+    """
+    Return C{difflib.SequenceMatcher} opcodes for turning the list C{a} into
+    C{b}.
+
+    The common prefix and suffix are matched directly, which is much faster
+    than C{SequenceMatcher} when only a few lines changed.
+    """
+    import difflib
+    n = min(len(a), len(b))
+    prefix = 0
+    while prefix < n and a[prefix] == b[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < n - prefix and a[-1-suffix] == b[-1-suffix]:
+        suffix += 1
+    a_end = len(a) - suffix
+    b_end = len(b) - suffix
+    # Don't treat frequent lines, e.g. blank lines, as junk.  (The heuristic
+    # can't be turned off before Python 2.7.1.)
+    kwargs = {}
+    if sys.version_info >= (2, 7, 1):
+        kwargs["autojunk"] = False
+    matcher = difflib.SequenceMatcher(None, a[prefix:a_end], b[prefix:b_end],
+                                      **kwargs)
+    opcodes = [("equal", 0, prefix, 0, prefix)]
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        opcodes.append((tag, i1+prefix, i2+prefix, j1+prefix, j2+prefix))
+    opcodes.append(("equal", a_end, len(a), b_end, len(b)))
+    # Merge adjacent and drop empty opcodes.
+    result = []
+    for opcode in opcodes:
+        tag, i1, i2, j1, j2 = opcode
+        if i1 == i2 and j1 == j2:
+            continue
+        if result and result[-1][0] == "equal" == tag:
+            result[-1] = (tag, result[-1][1], i2, result[-1][3], j2)
+        else:
+            result.append(opcode)
+    return result
+
+
+def _format_range(start, stop):
+    # Same as difflib's _format_range_unified.
+    length = stop - start
+    if length == 1:
+        return "%d" % (start + 1,)
+    if not length:
+        return "%d,0" % (start,)
+    return "%d,%d" % (start + 1, length)
+
+
+def unified_diff(old, new, filename, context=3):
+    r"""
+    Yield the lines of a unified diff between C{old} and C{new}, like C{diff
+    -u} would.
+
+      >>> print ''.join(unified_diff("a\nb\nc\n", "a\nB\nc\n", "f.py")),
+      --- f.py
+      +++ f.py
+      @@ -1,3 +1,3 @@
+       a
+      -b
+      +B
+       c
+
+    @type old:
+      L{FileText} or C{str}
+    @type new:
+      L{FileText} or C{str}
+    @type filename:
+      C{str}
+    @rtype:
+      generator of C{str}
+    """
+    if isinstance(old, FileText):
+        old = old.joined
+    if isinstance(new, FileText):
+        new = new.joined
+    a = old.splitlines(True)
+    b = new.splitlines(True)
+    opcodes = _diff_opcodes(a, b)
+    if opcodes == [("equal", 0, len(a), 0, len(b))] or not opcodes:
+        return
+    # Group changes into hunks with up to C{context} lines of context around
+    # them, like difflib.SequenceMatcher.get_grouped_opcodes.
+    if opcodes[0][0] == "equal":
+        tag, i1, i2, j1, j2 = opcodes[0]
+        opcodes[0] = tag, max(i1, i2-context), i2, max(j1, j2-context), j2
+    if opcodes[-1][0] == "equal":
+        tag, i1, i2, j1, j2 = opcodes[-1]
+        opcodes[-1] = tag, i1, min(i2, i1+context), j1, min(j2, j1+context)
+    groups = []
+    group = []
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == "equal" and i2 - i1 > 2 * context:
+            group.append((tag, i1, min(i2, i1+context), j1,
+                          min(j2, j1+context)))
+            groups.append(group)
+            group = []
+            i1, j1 = max(i1, i2-context), max(j1, j2-context)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == "equal"):
+        groups.append(group)
+    yield "--- %s\n" % (filename,)
+    yield "+++ %s\n" % (filename,)
+    def lines(prefix, lines):
+        for line in lines:
+            if line.endswith("\n"):
+                yield prefix + line
+            else:
+                yield prefix + line + "\n"
+                yield "\\ No newline at end of file\n"
+    for group in groups:
+        yield "@@ -%s +%s @@\n" % (
+            _format_range(group[0][1], group[-1][2]),
+            _format_range(group[0][3], group[-1][4]))
+        for tag, i1, i2, j1, j2 in group:
+            if tag == "equal":
+                for line in lines(" ", a[i1:i2]):
+                    yield line
+                continue
+            for line in lines("-", a[i1:i2]):
+                yield line
+            for line in lines("+", b[j1:j2]):
+                yield line
+
+
+_DIFF_COLORS = [
+    ("---", "\033[1m"),
+    ("+++", "\033[1m"),
+    ("@@", "\033[36m"),
+    ("-", "\033[31m"),
+    ("+", "\033[32m"),
+]
+
+def _colorize_diff_line(line):
+    for prefix, color in _DIFF_COLORS:
+        if line.startswith(prefix):
+            return "%s%s\033[0m\n" % (color, line.rstrip("\n"))
+    return line
+
+
+def action_diff(m):
+    """
+    Print a unified diff between the input and output of C{m}.  Colorize it
+    if stdout is a terminal.
+    """
+    colorize = sys.stdout.isatty()
+    for line in unified_diff(m.input_content, m.output_content,
+                             str(m.filename)):
+        if colorize:
+            line = _colorize_diff_line(line)
+        sys.stdout.write(line)
+    sys.stdout.flush()
 
 
 def action_external_command(command):
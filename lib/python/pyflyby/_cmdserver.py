@@ -0,0 +1,405 @@
+# pyflyby/_cmdserver.py.
+# Copyright (C) 2017 Karl Chen.
+# License: MIT http://opensource.org/licenses/MIT
+
+"""
+Server that runs a command-line tool on behalf of thin clients.
+
+Each run of a tool such as C{tidy-imports} pays for starting python,
+importing pyflyby and loading the import database before it looks at any
+file.  With C{--server}, the tool instead connects to a long-running server
+process that has all of that loaded already.  The client sends its
+arguments, working directory and (on request) stdin.  The server runs the
+tool's main function with those, and sends back stdout, stderr and the exit
+status.  If there is no server, the client starts one in the background and
+runs the command itself.
+
+There is one server per tool, python, pyflyby installation and C{PYFLYBY_*}
+environment.  It listens on a unix domain socket in
+C{$PYFLYBY_CACHE_DIR/server}, handles one request at a time, and exits when
+it has been idle for C{IDLE_TIMEOUT} seconds or when the pyflyby code
+changes.  Changes to the import database are noticed before each request.
+
+Commands that prompt the user or run external commands, such as C{--diff},
+can't be run by the server; the client runs them itself.
+
+This module only imports the standard library at the top level, so that the
+client can load it without importing the C{pyflyby} package (see
+C{bin/tidy-imports}).
+"""
+
+from __future__ import absolute_import, division, with_statement
+
+import errno
+import hashlib
+import json
+import os
+import socket
+import sys
+
+
+# Command-line argument that makes a tool run as a server.
+SERVE_ARG = "--run-as-server"
+
+# Command-line argument that makes a tool run as a client.
+CLIENT_ARG = "--server"
+
+# Seconds after the last request that a server exits.
+IDLE_TIMEOUT = 3600
+
+# Environment variables that can affect the output of a tool.  Clients and
+# servers only talk to each other if these are the same.
+_ENV_PREFIXES = ("PYFLYBY_",)
+_ENV_NAMES = ("HOME", "PYTHONPATH", "XDG_CACHE_HOME")
+
+
+def _encode(s):
+    # JSON strings are unicode; pass byte strings through losslessly.
+    return s.decode("latin-1")
+
+
+def _decode(s):
+    return s.encode("latin-1")
+
+
+def _send(f, message):
+    f.write(json.dumps(message) + "\n")
+    f.flush()
+
+
+def _receive(f):
+    """
+    Read a message from C{f}.
+
+    @rtype:
+      C{dict}
+    @raise EOFError:
+      The other end closed the connection.
+    """
+    line = f.readline()
+    if not line:
+        raise EOFError
+    return json.loads(line)
+
+
+def server_socket_path(script):
+    """
+    Return the filename of the socket of the server for the tool C{script}
+    in the current environment.
+
+    @type script:
+      C{str}
+    @rtype:
+      C{str}
+    """
+    # This is the same as L{pyflyby._file.get_cache_dir}, which we can't
+    # import here.
+    cache_dir = os.environ.get("PYFLYBY_CACHE_DIR")
+    if not cache_dir:
+        xdg_cache_home = (os.environ.get("XDG_CACHE_HOME") or
+                          os.path.expanduser("~/.cache"))
+        cache_dir = os.path.join(xdg_cache_home, "pyflyby")
+    script = os.path.realpath(script)
+    h = hashlib.sha1()
+    h.update("%s\0%s\0%s\0" % (
+        sys.executable, script,
+        os.path.realpath(os.path.dirname(os.path.abspath(__file__)))))
+    for k, v in sorted(os.environ.items()):
+        if k.startswith(_ENV_PREFIXES) or k in _ENV_NAMES:
+            h.update("%s=%s\0" % (k, v))
+    return os.path.join(cache_dir, "server", "%s-%s.sock" % (
+        os.path.basename(script), h.hexdigest()[:16]))
+
+
+def _start_server(script, socket_path):
+    """
+    Start a server for C{script} in the background, listening on
+    C{socket_path}.
+    """
+    import subprocess
+    dirname = os.path.dirname(socket_path)
+    try:
+        os.makedirs(dirname, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    with open(os.devnull) as devnull:
+        with open(socket_path[:-len(".sock")] + ".log", "w") as log:
+            subprocess.Popen(
+                [sys.executable, os.path.realpath(script), SERVE_ARG],
+                stdin=devnull, stdout=log, stderr=log, close_fds=True,
+                cwd="/", preexec_fn=os.setsid)
+
+
+def run_client(argv):
+    """
+    Run the tool command line C{argv} in a server, starting the server if
+    there isn't one.
+
+    @type argv:
+      C{list} of C{str}
+    @rtype:
+      C{int}
+    @return:
+      The exit status of the command, or C{None} if the caller should run
+      the command itself.
+    """
+    stdin_isatty = os.isatty(0)
+    if stdin_isatty and os.isatty(1):
+        # Interactive use; the defaults involve prompting the user.
+        return None
+    socket_path = server_socket_path(argv[0])
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except socket.error as e:
+        sock.close()
+        if e.errno in (errno.ENOENT, errno.ECONNREFUSED):
+            try:
+                _start_server(argv[0], socket_path)
+            except (IOError, OSError):
+                pass
+        return None
+    stdin_data = None
+    f = sock.makefile("r+")
+    try:
+        _send(f, dict(argv=[_encode(x) for x in argv],
+                      cwd=_encode(os.getcwd()),
+                      stdin_isatty=stdin_isatty))
+        while True:
+            message = _receive(f)
+            if message.get("stdin"):
+                stdin_data = sys.stdin.read()
+                _send(f, dict(data=_encode(stdin_data)))
+            elif "status" in message:
+                streams = {1: sys.stdout, 2: sys.stderr}
+                for fd, data in message["output"]:
+                    streams[fd].write(_decode(data))
+                    streams[fd].flush()
+                return message["status"]
+            else:
+                break
+    except (EOFError, IOError, socket.error, ValueError):
+        pass
+    finally:
+        f.close()
+        sock.close()
+    # The server couldn't run the command.
+    if stdin_data is not None:
+        from cStringIO import StringIO
+        sys.stdin = StringIO(stdin_data)
+    return None
+
+
+class _OutputCapture(object):
+    """
+    Writable file object that records what is written to it as C{(fd, data)}
+    in C{output}, which can be shared with other L{_OutputCapture}s to keep
+    the order of writes to stdout and stderr.
+    """
+
+    encoding = None
+
+    def __init__(self, fd, output):
+        self.fd = fd
+        self.output = output
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        self.output.append((self.fd, str(data)))
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+class _ClientStdin(object):
+    """
+    Readable file object that reads the client's stdin on demand.
+    """
+
+    encoding = None
+
+    def __init__(self, f, isatty):
+        self._f = f
+        self._isatty = isatty
+        self._data = None
+
+    def read(self, size=-1):
+        from pyflyby._cmdline import NeedsLocalExecution
+        if self._data is None:
+            if self._isatty:
+                raise NeedsLocalExecution("reading stdin from a terminal")
+            _send(self._f, dict(stdin=True))
+            self._data = _decode(_receive(self._f)["data"])
+        if size < 0:
+            result, self._data = self._data, ""
+        else:
+            result, self._data = self._data[:size], self._data[size:]
+        return result
+
+    def isatty(self):
+        return self._isatty
+
+
+def _run_request(main, f, request):
+    """
+    Run C{main} for the client C{request} and return the response.
+
+    @rtype:
+      C{dict}
+    """
+    import signal
+    import traceback
+    from   pyflyby import _cmdline
+    from   pyflyby._importdb import ImportDB
+    from   pyflyby._log import logger
+    orig_argv = sys.argv
+    orig_stdin, orig_stdout, orig_stderr = sys.stdin, sys.stdout, sys.stderr
+    orig_level = logger.level
+    output = []
+    stdout = _OutputCapture(1, output)
+    stderr = _OutputCapture(2, output)
+    try:
+        os.chdir(_decode(request["cwd"]))
+    except OSError:
+        return dict(fallback=True)
+    ImportDB.clear_default_cache_if_changed()
+    sys.argv = [_decode(x) for x in request["argv"]]
+    sys.stdin = _ClientStdin(f, request["stdin_isatty"])
+    sys.stdout = stdout
+    sys.stderr = stderr
+    _cmdline.running_in_server = True
+    try:
+        try:
+            main()
+            status = 0
+        except SystemExit as e:
+            if e.code is None:
+                status = 0
+            elif isinstance(e.code, int):
+                status = e.code
+            else:
+                print >>stderr, e.code
+                status = 1
+        except _cmdline.NeedsLocalExecution as e:
+            logger.debug("Running in client: %s", e)
+            return dict(fallback=True)
+        except Exception:
+            traceback.print_exc()
+            status = 1
+    finally:
+        _cmdline.running_in_server = False
+        sys.argv = orig_argv
+        sys.stdin, sys.stdout, sys.stderr = (
+            orig_stdin, orig_stdout, orig_stderr)
+        logger.set_level(orig_level)
+        # The tool may have installed a SIGPIPE handler that exits, which
+        # would kill the server if a client disconnects early.
+        signal.signal(signal.SIGPIPE, signal.SIG_IGN)
+    return dict(status=status,
+                output=[(fd, _encode(data)) for fd, data in output])
+
+
+def serve(main, socket_path, idle_timeout=IDLE_TIMEOUT):
+    """
+    Run a server for the tool whose main function is C{main}, listening on
+    C{socket_path}, until it has been idle for C{idle_timeout} seconds.
+
+    If another server is already listening on C{socket_path}, then return
+    immediately.
+    """
+    import fcntl
+    import time
+    from   pyflyby import _file
+    from   pyflyby._log import logger
+    from   pyflyby._tidycache import _compute_code_fingerprint
+    lock_file = open(socket_path[:-len(".sock")] + ".lock", "a+")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        logger.info("Another server is running for %s", socket_path)
+        return
+    lock_file.truncate(0)
+    lock_file.write("%d\n" % (os.getpid(),))
+    lock_file.flush()
+    code_fingerprint = _compute_code_fingerprint()
+    _file.mmap_enabled = False
+    try:
+        os.unlink(socket_path)
+    except OSError:
+        pass
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(socket_path)
+    os.chmod(socket_path, 0o600)
+    sock.listen(16)
+    sock.settimeout(idle_timeout)
+    logger.info("Listening on %s", socket_path)
+    try:
+        while True:
+            try:
+                conn, _ = sock.accept()
+            except socket.timeout:
+                logger.info("Idle for %d seconds; exiting", idle_timeout)
+                break
+            conn.settimeout(None)
+            f = conn.makefile("r+")
+            stale = False
+            try:
+                start_time = time.time()
+                request = _receive(f)
+                if _compute_code_fingerprint() != code_fingerprint:
+                    logger.info("pyflyby code changed; exiting")
+                    stale = True
+                    response = dict(fallback=True)
+                else:
+                    response = _run_request(main, f, request)
+                _send(f, response)
+                logger.debug("Handled %r in %.3fs", request.get("argv"),
+                             time.time() - start_time)
+            except (EOFError, IOError, socket.error, ValueError) as e:
+                logger.debug("Lost client: %s", e)
+            finally:
+                f.close()
+                conn.close()
+            if stale:
+                break
+    finally:
+        try:
+            os.unlink(socket_path)
+        except OSError:
+            pass
+        sock.close()
+        lock_file.close()
+
+
+def run_main(main, argv=None):
+    """
+    Run the command-line tool whose main function is C{main}, as a server if
+    C{argv} is C{[script, SERVE_ARG]}, or via a server if C{argv} contains
+    C{CLIENT_ARG}.
+
+    @type argv:
+      C{list} of C{str}
+    """
+    if argv is None:
+        argv = sys.argv
+    if argv[1:] == [SERVE_ARG]:
+        sys.argv = argv[:1]
+        serve(main, server_socket_path(argv[0]))
+        return
+    args = argv[1:]
+    if "--" in args:
+        args = args[:args.index("--")]
+    if CLIENT_ARG in args:
+        status = run_client(argv)
+        if status is not None:
+            raise SystemExit(status)
+    main()
@@ -4,6 +4,9 @@
 
 from __future__ import absolute_import, division, with_statement
 
+from   array                    import array
+from   bisect                   import bisect_right
+import mmap
 import os
 import re
 import sys
@@ -209,6 +212,32 @@ def which(program):
 
 
 
+def get_cache_dir(subdir=None):
+    """
+    Return the directory in which pyflyby keeps on-disk caches.
+
+    This is C{$PYFLYBY_CACHE_DIR} if set, else C{$XDG_CACHE_HOME/pyflyby},
+    else C{~/.cache/pyflyby}.  The directory is not created.
+
+    @type subdir:
+      C{str}
+    @param subdir:
+      Optional subdirectory of the cache directory, e.g. C{"symindex"}.
+    @rtype:
+      L{Filename}
+    """
+    cache_dir = os.environ.get("PYFLYBY_CACHE_DIR")
+    if not cache_dir:
+        xdg_cache_home = (os.environ.get("XDG_CACHE_HOME") or
+                          os.path.expanduser("~/.cache"))
+        cache_dir = os.path.join(xdg_cache_home, "pyflyby")
+    result = Filename(cache_dir)
+    if subdir:
+        result = result / subdir
+    return result
+
+
+
 Filename.STDIN = Filename("/dev/stdin")
 
 
@@ -319,8 +348,30 @@ FilePos._ONE_ONE = FilePos._from_lc(1, 1)
 class FileText(object):
     """
     Represents a contiguous sequence of lines from a file.
+
+    A C{FileText} is a view of the characters C{[_start, _end)} of a buffer
+    string.  Slices and concatenations of adjacent slices share the buffer,
+    together with the offsets at which its lines start, so they don't copy
+    any text; L{joined} and L{lines} are only materialized when requested.
+    Converting between positions and offsets takes a binary search over the
+    line start offsets.
+
+    The buffer may also be a read-only C{mmap} of a large file (see
+    L{read_file}).  Concatenating unrelated texts is lazy: the result keeps
+    its pieces, and slices of it are slices of the pieces, until its text is
+    requested.  This way L{write_file} can stream unchanged regions straight
+    from their buffers.
     """
 
+    # Slices don't get an instance C{__dict__} until one of their cached
+    # attributes is computed, which keeps the many small slices of a large
+    # file cheap.  C{_root} is the C{FileText} whose C{_line_starts} index
+    # C{_buffer}, and C{_firstline} is the index of the line that contains
+    # C{_start}.  C{_pieces} is only set for lazy concatenations, whose other
+    # slots are filled in by L{_materialize} on first use.
+    __slots__ = ('_root', '_buffer', '_start', '_end', '_firstline',
+                 '_pieces', 'filename', 'startpos', '__dict__')
+
     def __new__(cls, arg, filename=None, startpos=None):
         """
         Return a new C{FileText} instance.
@@ -352,17 +403,32 @@ class FileText(object):
             return cls(read_file(arg), filename=filename, startpos=startpos)
         elif hasattr(arg, "__text__"):
             return FileText(arg.__text__(), filename=filename, startpos=startpos)
-        elif isinstance(arg, basestring):
-            self = object.__new__(cls)
-            self.joined = arg
+        elif isinstance(arg, (basestring, mmap.mmap)):
+            pass
         else:
             raise TypeError("%s: unexpected %s"
                             % (cls.__name__, type(arg).__name__))
         if filename is not None:
             filename = Filename(filename)
         startpos = FilePos(startpos)
-        self.filename = filename
-        self.startpos = startpos
+        return cls._from_buffer(arg, filename, startpos)
+
+    @classmethod
+    def _from_buffer(cls, data, filename, startpos):
+        """
+        Return a new C{FileText} for the whole of C{data}, a string or an
+        C{mmap}.
+        """
+        self = object.__new__(cls)
+        self._root      = self
+        self._buffer    = data
+        self._start     = 0
+        self._end       = len(data)
+        self._firstline = 0
+        self.filename   = filename
+        self.startpos   = startpos
+        if isinstance(data, basestring):
+            self.joined = data
         return self
 
     @classmethod
@@ -371,12 +437,103 @@ class FileText(object):
         assert len(lines) > 0
         assert type(lines[0]) is str
         assert not lines[-1].endswith("\n")
+        self = cls._from_buffer('\n'.join(lines), filename, startpos)
+        self.lines = lines
+        return self
+
+    @classmethod
+    def _from_pieces(cls, pieces, filename, startpos):
+        """
+        Return a new C{FileText} that lazily concatenates C{pieces}, which are
+        non-empty and not themselves lazy.
+        """
+        # Give each piece the positions it has in the concatenation.
+        aligned = []
+        pos = startpos
+        for piece in pieces:
+            if piece.startpos != pos:
+                piece = piece._view(piece._start, piece._end,
+                                    piece._firstline, pos, piece.filename)
+            aligned.append(piece)
+            pos = piece.endpos
         self = object.__new__(cls)
-        self.lines    = lines
+        self._pieces  = tuple(aligned)
         self.filename = filename
         self.startpos = startpos
+        self.endpos   = pos
         return self
 
+    def _view(self, start, end, firstline, startpos, filename):
+        """
+        Return a new C{FileText} for the characters C{[start, end)} of the
+        same buffer as C{self}.
+        """
+        result = object.__new__(type(self))
+        result._root      = self._root
+        result._buffer    = self._buffer
+        result._start     = start
+        result._end       = end
+        result._firstline = firstline
+        result.filename   = filename
+        result.startpos   = startpos
+        return result
+
+    def __getattr__(self, name):
+        # Only called for unset slots (and missing attributes).
+        if name == '_pieces':
+            return None
+        if (name in ('_root', '_buffer', '_start', '_end', '_firstline') and
+            self._pieces is not None):
+            self._materialize()
+            return getattr(self, name)
+        raise AttributeError("%r object has no attribute %r"
+                             % (type(self).__name__, name))
+
+    def _materialize(self):
+        """
+        Join the pieces of a lazy concatenation into a buffer.
+        """
+        data = ''.join([buf[start:end] for buf, start, end in self._ranges()])
+        self._root      = self
+        self._buffer    = data
+        self._start     = 0
+        self._end       = len(data)
+        self._firstline = 0
+        self._pieces    = None
+        self.joined     = data
+
+    def _ranges(self):
+        """
+        The C{(buffer, start, end)} ranges that make up this text, without
+        materializing a lazy concatenation.
+
+        @rtype:
+          C{list} of C{tuple}s
+        """
+        pieces = self._pieces
+        if pieces is None:
+            return [(self._buffer, self._start, self._end)]
+        return [(p._buffer, p._start, p._end) for p in pieces]
+
+    @cached_attribute
+    def _line_starts(self):
+        """
+        Offsets in C{_buffer} at which each line starts.
+
+        @rtype:
+          C{array} of C{int}
+        """
+        # Only computed for root C{FileText}s; slices use their root's.
+        result = array('l', [0])
+        find = self._buffer.find
+        append = result.append
+        offset = find('\n')
+        while offset >= 0:
+            offset += 1
+            append(offset)
+            offset = find('\n', offset)
+        return result
+
     @cached_attribute
     def lines(self):
         r"""
@@ -391,15 +548,14 @@ class FileText(object):
         @rtype:
           C{tuple} of C{str}
         """
-        # Used if only initialized with 'joined'.
         # We use str.split() instead of str.splitlines() because the latter
         # doesn't distinguish between strings that end in newline or not
         # (or requires extra work to process if we use splitlines(True)).
         return tuple(self.joined.split('\n'))
 
     @cached_attribute
-    def joined(self): # used if only initialized with 'lines'
-        return '\n'.join(self.lines)
+    def joined(self): # used by views
+        return self._buffer[self._start:self._end]
 
     @classmethod
     def from_filename(cls, filename):
@@ -416,13 +572,11 @@ class FileText(object):
             startpos = self.startpos
         if filename == self.filename and startpos == self.startpos:
             return self
+        elif self._pieces is not None:
+            return type(self)._from_pieces(self._pieces, filename, startpos)
         else:
-            result = object.__new__(type(self))
-            result.lines    = self.lines
-            result.joined   = self.joined
-            result.filename = filename
-            result.startpos = startpos
-            return result
+            return self._view(self._start, self._end, self._firstline,
+                              startpos, filename)
 
     @cached_attribute
     def endpos(self):
@@ -432,39 +586,77 @@ class FileText(object):
         @rtype:
           C{FilePos}
         """
+        return self._offset_to_pos(self._end)
+
+    def _offset_to_pos(self, offset):
+        """
+        Convert an offset in C{_buffer} to a position.
+
+        @rtype:
+          C{FilePos}
+        """
+        line_starts = self._root._line_starts
+        lineindex = bisect_right(line_starts, offset) - 1
         startpos = self.startpos
-        lines    = self.lines
-        lineno   = startpos.lineno + len(lines) - 1
-        if len(lines) == 1:
-            colno = startpos.colno + len(lines[-1])
-        else:
-            colno = 1 + len(lines[-1])
-        return FilePos(lineno, colno)
-
-    def _lineno_to_index(self, lineno):
-        lineindex = lineno - self.startpos.lineno
-        # Check that the lineindex is in range.  We don't allow pointing at
-        # the line after the last line because we already ensured that
-        # self.lines contains an extra empty string if necessary, to indicate
-        # a trailing newline in the file.
-        if not 0 <= lineindex < len(self.lines):
+        if lineindex == self._firstline:
+            return FilePos(startpos.lineno,
+                           startpos.colno + offset - self._start)
+        return FilePos(startpos.lineno + lineindex - self._firstline,
+                       1 + offset - line_starts[lineindex])
+
+    def _check_lineno(self, lineno):
+        # Check that the line number is in range.  We don't allow pointing at
+        # the line after the last line because the last line is empty if
+        # necessary, to indicate a trailing newline in the file.
+        if not self.startpos.lineno <= lineno <= self.endpos.lineno:
             raise IndexError(
                 "Line number %d out of range [%d, %d)"
                 % (lineno, self.startpos.lineno, self.endpos.lineno))
-        return lineindex
 
-    def _colno_to_index(self, lineindex, colno):
-        coloffset = self.startpos.colno if lineindex == 0 else 1
-        colindex = colno - coloffset
-        line = self.lines[lineindex]
-        # Check that the colindex is in range.  We do allow pointing at the
+    def _line_offsets(self, lineno):
+        """
+        Return the offsets in C{_buffer} of the start and end (excluding the
+        newline) of the part of line C{lineno} that's in this text.
+
+        @rtype:
+          C{tuple} of (C{int}, C{int})
+        """
+        self._check_lineno(lineno)
+        line_starts = self._root._line_starts
+        lineindex = lineno - self.startpos.lineno + self._firstline
+        start = line_starts[lineindex]
+        if start < self._start:
+            start = self._start
+        end = self._end
+        if lineindex + 1 < len(line_starts):
+            end = line_starts[lineindex + 1] - 1
+            if end > self._end:
+                end = self._end
+        return start, end
+
+    def _pos_to_offset(self, pos):
+        """
+        Convert a position in this text to an offset in C{_buffer}.
+
+        @type pos:
+          C{FilePos}
+        @rtype:
+          C{int}
+        """
+        linestart, lineend = self._line_offsets(pos.lineno)
+        if pos.lineno == self.startpos.lineno:
+            coloffset = self.startpos.colno
+        else:
+            coloffset = 1
+        offset = linestart + pos.colno - coloffset
+        # Check that the offset is in range.  We do allow pointing at the
         # character after the last (non-newline) character in the line.
-        if not 0 <= colindex <= len(line):
+        if not linestart <= offset <= lineend:
             raise IndexError(
                 "Column number %d on line %d out of range [%d, %d]"
-                % (colno, lineindex+self.startpos.lineno,
-                   coloffset, coloffset+len(line)))
-        return colindex
+                % (pos.colno, pos.lineno,
+                   coloffset, coloffset + lineend - linestart))
+        return offset
 
     def __getitem__(self, arg):
         """
@@ -495,65 +687,97 @@ class FileText(object):
         @rtype:
           C{str} or L{FileText}
         """
-        L = self._lineno_to_index
-        C = self._colno_to_index
+        if self._pieces is not None:
+            return self._getitem_pieces(arg)
         if isinstance(arg, slice):
             if arg.step is not None and arg.step != 1:
                 raise ValueError("steps not supported")
-            # Interpret start (lineno,colno) into indexes.
+            # Interpret start (lineno,colno) into an offset.
             if arg.start is None:
-                start_lineindex = 0
-                start_colindex = 0
+                start = self._start
+                startpos = self.startpos
             elif isinstance(arg.start, int):
-                start_lineindex = L(arg.start)
-                start_colindex = 0
+                start, _ = self._line_offsets(arg.start)
+                if arg.start == self.startpos.lineno:
+                    startpos = self.startpos
+                else:
+                    startpos = FilePos(arg.start, 1)
             else:
                 startpos = FilePos(arg.start)
-                start_lineindex = L(startpos.lineno)
-                start_colindex = C(start_lineindex, startpos.colno)
-            # Interpret stop (lineno,colno) into indexes.
+                start = self._pos_to_offset(startpos)
+            # Interpret stop (lineno,colno) into an offset.
             if arg.stop is None:
-                stop_lineindex = len(self.lines)
-                stop_colindex = len(self.lines[-1])
+                stop = self._end
             elif isinstance(arg.stop, int):
-                stop_lineindex = L(arg.stop)
-                stop_colindex = 0
+                stop, _ = self._line_offsets(arg.stop)
             else:
-                stoppos = FilePos(arg.stop)
-                stop_lineindex = L(stoppos.lineno)
-                stop_colindex = C(stop_lineindex, stoppos.colno)
-            # {start,stop}_{lineindex,colindex} are now 0-indexed
-            # [open,closed) ranges.
-            assert 0 <= start_lineindex <= stop_lineindex < len(self.lines)
-            assert 0 <= start_colindex <= len(self.lines[start_lineindex])
-            assert 0 <= stop_colindex <= len(self.lines[stop_lineindex])
+                stop = self._pos_to_offset(FilePos(arg.stop))
+            # [start, stop) is now a range of offsets into self._buffer.
+            assert self._start <= start <= self._end
+            assert self._start <= stop <= self._end
+            if stop < start:
+                stop = start
             # Optimization: return entire range
-            if (start_lineindex == 0 and
-                start_colindex == 0 and
-                stop_lineindex == len(self.lines)-1 and
-                stop_colindex == len(self.lines[-1])):
+            if start == self._start and stop == self._end:
                 return self
-            # Get the lines we care about.  We always include an extra entry
-            # at the end which we'll chop to the desired number of characters.
-            result_split = list(self.lines[start_lineindex:stop_lineindex+1])
-            # Clip the starting and ending strings.  We do the end clip first
-            # in case the result has only one line.
-            result_split[-1] = result_split[-1][:stop_colindex]
-            result_split[0] = result_split[0][start_colindex:]
-            # Compute the new starting line and column numbers.
-            result_lineno = start_lineindex + self.startpos.lineno
-            if start_lineindex == 0:
-                result_colno = start_colindex + self.startpos.colno
-            else:
-                result_colno = start_colindex + 1
-            result_startpos = FilePos(result_lineno, result_colno)
-            return FileText._from_lines(tuple(result_split),
-                                        filename=self.filename,
-                                        startpos=result_startpos)
+            firstline = (self._firstline +
+                         startpos.lineno - self.startpos.lineno)
+            return self._view(start, stop, firstline, startpos, self.filename)
         elif isinstance(arg, int):
             # Return a single line.
-            lineindex = L(arg)
-            return self.lines[lineindex]
+            start, end = self._line_offsets(arg)
+            return self._buffer[start:end]
+        else:
+            raise TypeError("bad type %r" % (type(arg),))
+
+    def _getitem_pieces(self, arg):
+        """
+        Implementation of L{__getitem__} for lazy concatenations, in terms of
+        the pieces.  A slice that spans several pieces is again a lazy
+        concatenation.
+        """
+        pieces = self._pieces
+        if isinstance(arg, slice):
+            if arg.step is not None and arg.step != 1:
+                raise ValueError("steps not supported")
+            def interpret(pos, default):
+                if pos is None:
+                    return default
+                if isinstance(pos, int):
+                    self._check_lineno(pos)
+                    if pos == self.startpos.lineno:
+                        return self.startpos
+                    return FilePos(pos, 1)
+                pos = FilePos(pos)
+                if not self.startpos <= pos <= self.endpos:
+                    raise IndexError("Position %s out of range [%s, %s]"
+                                     % (pos, self.startpos, self.endpos))
+                return pos
+            start = interpret(arg.start, self.startpos)
+            stop = max(start, interpret(arg.stop, self.endpos))
+            if start == self.startpos and stop == self.endpos:
+                return self
+            parts = []
+            for piece in pieces:
+                if stop < piece.startpos or piece.endpos < start:
+                    continue
+                part = piece[max(start, piece.startpos):
+                             min(stop, piece.endpos)]
+                if part._start < part._end or start == stop:
+                    parts.append(part._view(part._start, part._end,
+                                            part._firstline, part.startpos,
+                                            self.filename))
+                if start == stop:
+                    break
+            if len(parts) == 1:
+                return parts[0]
+            return type(self)._from_pieces(parts, self.filename, start)
+        elif isinstance(arg, int):
+            # Return a single line, which may be split across pieces.
+            self._check_lineno(arg)
+            return ''.join([
+                piece[arg] for piece in pieces
+                if piece.startpos.lineno <= arg <= piece.endpos.lineno])
         else:
             raise TypeError("bad type %r" % (type(arg),))
 
@@ -563,16 +787,103 @@ class FileText(object):
         Concatenate a bunch of L{FileText} arguments.  Uses the C{filename}
         and C{startpos} from the first argument.
 
+        Adjacent slices of the same text are merged without copying.  If any
+        other arguments remain, the result is a lazy concatenation of them.
+
         @rtype:
           L{FileText}
         """
         args = [FileText(x) for x in args]
         if len(args) == 1:
             return args[0]
-        return FileText(
-            ''.join([l.joined for l in args]),
-            filename=args[0].filename,
-            startpos=args[0].startpos)
+        first = args[0]
+        pieces = []
+        for arg in args:
+            for piece in (arg._pieces or [arg]):
+                if piece._start == piece._end:
+                    continue
+                if pieces:
+                    prev = pieces[-1]
+                    if (piece._buffer is prev._buffer and
+                        piece._start == prev._end):
+                        pieces[-1] = prev._view(
+                            prev._start, piece._end, prev._firstline,
+                            prev.startpos, prev.filename)
+                        continue
+                pieces.append(piece)
+        if not pieces:
+            return FileText('', filename=first.filename,
+                            startpos=first.startpos)
+        if len(pieces) == 1:
+            piece, = pieces
+            return piece._view(piece._start, piece._end, piece._firstline,
+                               first.startpos, first.filename)
+        return cls._from_pieces(pieces, first.filename, first.startpos)
+
+    def write_to(self, f):
+        """
+        Write this text to the file object C{f}, in chunks taken directly from
+        the underlying buffers.
+        """
+        for buf, start, end in self._ranges():
+            if isinstance(buf, unicode):
+                f.write(buf[start:end])
+                continue
+            for offset in xrange(start, end, _WRITE_CHUNK_SIZE):
+                f.write(buffer(buf, offset, min(_WRITE_CHUNK_SIZE, end-offset)))
+
+    def has_match(self, pattern, flags=0):
+        r"""
+        Return whether the regular expression C{pattern} matches anywhere in
+        this text, like C{re.search(pattern, self.joined, flags)}, but without
+        copying the text out of its buffer.
+
+          >>> text = FileText("a = 1\nimport os\n")
+          >>> text[2:3].has_match(r"^import\b", re.M)
+          True
+          >>> text[(1,2):2].has_match(r"^ =", re.M)
+          True
+
+        @rtype:
+          C{bool}
+        """
+        start = self._start
+        if start > 0 and self._buffer[start-1] != '\n':
+            # C{^} wouldn't match at C{start} when searching in place.
+            return re.search(pattern, self.joined, flags) is not None
+        regex = re.compile(pattern, flags)
+        return regex.search(self._buffer, start, self._end) is not None
+
+    def _text_equal(self, o):
+        """
+        Return whether C{self} and C{o} have the same text.  Identical ranges
+        of the same buffer aren't compared, and lazy concatenations aren't
+        materialized.
+
+        @rtype:
+          C{bool}
+        """
+        a = self._ranges()
+        b = o._ranges()
+        if (sum(end - start for _, start, end in a) !=
+            sum(end - start for _, start, end in b)):
+            return False
+        a.reverse()
+        b.reverse()
+        while a and b:
+            abuf, astart, aend = a.pop()
+            bbuf, bstart, bend = b.pop()
+            size = min(aend - astart, bend - bstart)
+            if not (abuf is bbuf and astart == bstart):
+                # Compare a chunk at a time, to avoid big copies.
+                size = min(size, _WRITE_CHUNK_SIZE)
+                if abuf[astart:astart+size] != bbuf[bstart:bstart+size]:
+                    return False
+            if astart + size < aend:
+                a.append((abuf, astart + size, aend))
+            if bstart + size < bend:
+                b.append((bbuf, bstart + size, bend))
+        return True
 
     def __repr__(self):
         r = "%s(%r" % (type(self).__name__, self.joined,)
@@ -592,8 +903,8 @@ class FileText(object):
         if not isinstance(o, FileText):
             return NotImplemented
         return (self.filename == o.filename and
-                self.joined   == o.joined   and
-                self.startpos == o.startpos)
+                self.startpos == o.startpos and
+                self._text_equal(o))
 
     def __ne__(self, o):
         if not isinstance(o, FileText):
@@ -614,20 +925,61 @@ class FileText(object):
         return h
 
 
+# Files at least this big are memory-mapped by L{read_file}.
+_MMAP_MIN_SIZE = 1 << 20
+
+# Whether L{read_file} may memory-map files.  Long-running processes (the
+# C{--server} server and C{--watch}) turn this off: their mappings could
+# outlive the file's contents, and reading a mapping of a file that has
+# since been truncated (e.g. when an editor saves it) kills the process with
+# SIGBUS.
+mmap_enabled = True
+
+# Maximum size of each write by L{FileText.write_to}.
+_WRITE_CHUNK_SIZE = 1 << 20
+
+
+def _mmap_file(filename):
+    """
+    Memory-map C{filename} for reading, if it's big enough to be worthwhile
+    and has no carriage returns (which universal newlines mode would
+    translate), and L{mmap_enabled} is set.
+
+    @rtype:
+      C{mmap.mmap} or C{None}
+    """
+    if not mmap_enabled:
+        return None
+    try:
+        with open(str(filename), 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < max(_MMAP_MIN_SIZE, 1):
+                return None
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (EnvironmentError, ValueError):
+        return None
+    if data.find('\r') >= 0:
+        data.close()
+        return None
+    return data
+
+
 def read_file(filename):
     filename = Filename(filename)
     if filename == Filename.STDIN:
         data = sys.stdin.read()
     else:
-        with open(str(filename), 'rU') as f:
-            data = f.read()
+        data = _mmap_file(filename)
+        if data is None:
+            with open(str(filename), 'rU') as f:
+                data = f.read()
     return FileText(data, filename=filename)
 
 def write_file(filename, data):
     filename = Filename(filename)
     data = FileText(data)
     with open(str(filename), 'w') as f:
-        f.write(data.joined)
+        data.write_to(f)
 
 def atomic_write_file(filename, data):
     filename = Filename(filename)
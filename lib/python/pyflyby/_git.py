@@ -0,0 +1,146 @@
+# pyflyby/_git.py.
+# Copyright (C) 2017 Karl Chen.
+# License: MIT http://opensource.org/licenses/MIT
+
+"""
+Queries of the local git repository, for selecting files to process.
+"""
+
+from __future__ import absolute_import, division, with_statement
+
+import subprocess
+
+from   pyflyby._file            import Filename
+from   pyflyby._log             import logger
+
+
+class GitError(Exception):
+    """
+    A git command failed.
+    """
+
+
+def _git(args, input=None):
+    """
+    Run C{git} with C{args} and return its output.
+
+    @type args:
+      C{list} of C{str}
+    @type input:
+      C{str}
+    @rtype:
+      C{str}
+    @raise GitError:
+      git couldn't be run or exited with an error.
+    """
+    command = ["git"] + list(args)
+    logger.debug("Running %s", ' '.join(command))
+    try:
+        proc = subprocess.Popen(command,
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+    except OSError as e:
+        raise GitError("Couldn't run git: %s" % (e,))
+    output, errors = proc.communicate(input)
+    if proc.returncode != 0:
+        raise GitError("'%s' failed: %s" % (' '.join(command), errors.strip()))
+    return output
+
+
+def _split_nul(output):
+    return [x for x in output.split("\0") if x]
+
+
+def git_toplevel():
+    """
+    Return the top-level directory of the working tree containing the
+    current directory.
+
+    @rtype:
+      L{Filename}
+    """
+    return Filename(_git(["rev-parse", "--show-toplevel"]).strip())
+
+
+def git_changed_py_files(ref=None, staged=False, paths=()):
+    """
+    Return the C{*.py} files that were added, copied, modified or renamed.
+
+    If C{staged}, then compare the index to C{ref} (default C{HEAD}).
+    Otherwise, compare the working tree to C{ref} (default: the index), and
+    also include untracked files that aren't ignored.
+
+    @type ref:
+      C{str}
+    @type staged:
+      C{bool}
+    @type paths:
+      sequence of C{str}
+    @param paths:
+      If nonempty, only consider files under these paths.
+    @rtype:
+      C{list} of L{Filename}s
+    """
+    toplevel = git_toplevel()
+    args = ["diff", "--name-only", "-z", "--no-renames", "--diff-filter=ACM"]
+    if staged:
+        args.append("--cached")
+    if ref:
+        args.append(ref)
+    args.append("--")
+    args.extend(paths)
+    names = _split_nul(_git(args))
+    if not staged:
+        names += _split_nul(_git(
+            ["ls-files", "-z", "--full-name", "--others", "--exclude-standard",
+             "--"] + list(paths)))
+    result = set()
+    for name in names:
+        if not name.endswith(".py"):
+            continue
+        filename = toplevel / name
+        if not staged and not filename.isfile:
+            continue
+        result.add(filename)
+    return sorted(result)
+
+
+def read_git_index(filenames):
+    """
+    Read the content of C{filenames} as staged in the index.
+
+    @type filenames:
+      sequence of L{Filename}s
+    @rtype:
+      C{dict}
+    @return:
+      Map from L{Filename} to content as C{str}.
+    @raise GitError:
+      A file is not in the index.
+    """
+    filenames = list(filenames)
+    if not filenames:
+        return {}
+    toplevel = git_toplevel()
+    specs = []
+    for filename in filenames:
+        if not filename.startswith(str(toplevel) + "/"):
+            raise GitError("%s is outside the repository %s"
+                           % (filename, toplevel))
+        specs.append(":" + str(filename)[len(str(toplevel))+1:])
+    output = _git(["cat-file", "--batch"], input="".join(
+        spec + "\n" for spec in specs))
+    result = {}
+    pos = 0
+    for filename in filenames:
+        eol = output.index("\n", pos)
+        header = output[pos:eol].split()
+        if len(header) != 3 or header[1] != "blob":
+            raise GitError("%s is not staged in the index" % (filename,))
+        size = int(header[2])
+        start = eol + 1
+        result[filename] = output[start:start+size]
+        # Each object is followed by a newline.
+        pos = start + size + 1
+    return result
@@ -5,8 +5,10 @@
 from __future__ import absolute_import, division, with_statement
 
 from   collections              import defaultdict
+import hashlib
 import os
 import re
+import time
 
 from   pyflyby._file            import Filename, expand_py_files_from_args
 from   pyflyby._idents          import dotted_prefixes
@@ -91,6 +93,35 @@ def _get_python_path(env_var_name, default_path, target_dirname):
     return tuple(pathnames)
 
 
+def _get_project_roots():
+    """
+    Get the project directories whose first-party definitions should be
+    indexed, as specified by C{$PYFLYBY_PROJECT_PATH}.
+
+    The variable is a colon-separated list of directories.  It is empty by
+    default, i.e. no project trees are indexed.
+
+    @rtype:
+      C{tuple} of C{Filename}s
+    """
+    pathnames = _get_env_var("PYFLYBY_PROJECT_PATH", [])
+    for p in pathnames:
+        if re.match("/|[.]/|~/", p):
+            continue
+        raise ValueError(
+            "PYFLYBY_PROJECT_PATH components should start with / or ./ or ~/.  "
+            "Use PYFLYBY_PROJECT_PATH=./{p} instead of PYFLYBY_PROJECT_PATH={p} "
+            "if you really want to use the current directory.".format(p=p))
+    result = []
+    for p in pathnames:
+        fn = Filename(os.path.expanduser(p))
+        if not fn.isdir:
+            logger.warning("PYFLYBY_PROJECT_PATH: %s is not a directory", fn)
+            continue
+        result.append(fn)
+    return tuple(stable_unique(result))
+
+
 # TODO: stop memoizing here after using StatCache.  Actually just inline into
 # _ancestors_on_same_partition
 @memoize
@@ -215,6 +246,8 @@ class ImportDB(object):
                 logger.debug("ImportDB: Clearing default cache of %d files",
                              nfiles)
             cls._default_cache.clear()
+        cls._default_cache_fingerprints.clear()
+        cls._fingerprint_cache.clear()
 
     @classmethod
     def get_default(cls, target_filename):
@@ -253,7 +286,8 @@ class ImportDB(object):
                                target_dirname,
                                os.getenv("PYFLYBY_PATH"),
                                os.getenv("PYFLYBY_KNOWN_IMPORTS_PATH"),
-                               os.getenv("PYFLYBY_MANDATORY_IMPORTS_PATH")))
+                               os.getenv("PYFLYBY_MANDATORY_IMPORTS_PATH"),
+                               os.getenv("PYFLYBY_PROJECT_PATH")))
             try:
                 return cls._default_cache[cache_keys[-1]]
             except KeyError:
@@ -267,11 +301,49 @@ class ImportDB(object):
                                target_dirname,
                                os.getenv("PYFLYBY_PATH"),
                                os.getenv("PYFLYBY_KNOWN_IMPORTS_PATH"),
-                               os.getenv("PYFLYBY_MANDATORY_IMPORTS_PATH")))
+                               os.getenv("PYFLYBY_MANDATORY_IMPORTS_PATH"),
+                               os.getenv("PYFLYBY_PROJECT_PATH")))
             try:
                 return cls._default_cache[cache_keys[-1]]
             except KeyError:
                 pass
+        filenames, mandatory_imports_filenames = (
+            cls._get_default_filenames(target_dirname))
+        project_roots = _get_project_roots()
+        cache_keys.append((2, filenames, mandatory_imports_filenames,
+                           project_roots))
+        try:
+            return cls._default_cache[cache_keys[-1]]
+        except KeyError:
+            pass
+        if project_roots:
+            # Update the project indexes first, so that the fingerprint
+            # reflects the definitions that we use.
+            from pyflyby._symindex import find_project_imports
+            project_imports = find_project_imports(project_roots)
+        # Take the fingerprint before reading the files, so that changes made
+        # while reading them are noticed by L{clear_default_cache_if_changed}.
+        fingerprint = cls.get_default_fingerprint(target_dirname)
+        result = cls._from_filenames(filenames, mandatory_imports_filenames)
+        if project_roots:
+            result = result._with_project_imports(project_imports,
+                                                  project_roots)
+        for k in cache_keys:
+            cls._default_cache[k] = result
+            if k[0] == 1:
+                cls._default_cache_fingerprints[k] = fingerprint
+        return result
+
+    @classmethod
+    def _get_default_filenames(cls, target_dirname):
+        """
+        Get the filenames that L{get_default} reads for C{target_dirname}.
+
+        @rtype:
+          C{tuple}
+        @return:
+          C{(filenames, mandatory_imports_filenames)}.
+        """
         DEFAULT_PYFLYBY_PATH = []
         etc_dir = _find_etc_dir()
         if etc_dir:
@@ -329,16 +401,118 @@ class ImportDB(object):
                 logger.debug(
                     "The environment variable PYFLYBY_MANDATORY_IMPORTS_PATH is deprecated.  "
                     "Use PYFLYBY_PATH and write __mandatory_imports__=['...'] in your files.")
-        cache_keys.append((2, filenames, mandatory_imports_filenames))
+        return filenames, mandatory_imports_filenames
+
+    _fingerprint_cache = {}
+
+    @classmethod
+    def get_default_fingerprint(cls, target_filename):
+        """
+        Return a string that changes whenever the import database that
+        L{get_default} would return for C{target_filename} may have changed.
+
+        This only looks at the names, sizes and mtimes of the files that the
+        database is read from, and at the L{SymbolIndex.digest} of the indexes
+        of C{$PYFLYBY_PROJECT_PATH} as they are in memory, so it is much
+        cheaper than loading the database.  It is memoized per directory, so
+        changes made during the lifetime of the process are not noticed; see
+        L{clear_default_cache_if_changed}.
+
+        @rtype:
+          C{str}
+        """
+        target_filename = Filename(target_filename or ".")
+        if target_filename.startswith("/dev"):
+            target_filename = Filename(".")
+        target_dirname = target_filename
+        while not target_dirname.isdir:
+            target_dirname = target_dirname.dir
+        target_dirname = target_dirname.real
+        cache_key = (target_dirname,
+                     os.getenv("PYFLYBY_PATH"),
+                     os.getenv("PYFLYBY_KNOWN_IMPORTS_PATH"),
+                     os.getenv("PYFLYBY_MANDATORY_IMPORTS_PATH"),
+                     os.getenv("PYFLYBY_PROJECT_PATH"))
         try:
-            return cls._default_cache[cache_keys[-1]]
+            return cls._fingerprint_cache[cache_key]
         except KeyError:
             pass
-        result = cls._from_filenames(filenames, mandatory_imports_filenames)
-        for k in cache_keys:
-            cls._default_cache[k] = result
+        filenames, mandatory_imports_filenames = (
+            cls._get_default_filenames(target_dirname))
+        h = hashlib.sha1()
+        for group in (filenames, mandatory_imports_filenames):
+            for filename in group:
+                try:
+                    st = os.stat(str(filename))
+                except OSError:
+                    st = None
+                h.update("%s\0%r\0%r\0" % (
+                    filename,
+                    st and st.st_size,
+                    st and st.st_mtime))
+            h.update("\1")
+        project_roots = _get_project_roots()
+        if project_roots:
+            from pyflyby._symindex import SymbolIndex
+            for root in project_roots:
+                h.update("%s\0%s\0" % (root, SymbolIndex(root).digest))
+        result = h.hexdigest()
+        cls._fingerprint_cache[cache_key] = result
         return result
 
+    # Map from type-1 keys of C{_default_cache} to the
+    # L{get_default_fingerprint} of the database when it was read.
+    _default_cache_fingerprints = {}
+
+    # Seconds after which L{clear_default_cache_if_changed} checks all files
+    # of the project trees for changes again.
+    PROJECT_RESCAN_INTERVAL = 60
+
+    @classmethod
+    def clear_default_cache_if_changed(cls, changed_filenames=()):
+        """
+        Clear the class cache of default ImportDBs if any of the files that
+        they were read from may have changed, according to
+        L{get_default_fingerprint}.
+
+        This lets a long-running process notice changes to the import database
+        without reloading it each time.  Walking the project trees of
+        C{$PYFLYBY_PROJECT_PATH} can be slow, so their indexes are only
+        updated from C{changed_filenames}, and from all files at most every
+        L{PROJECT_RESCAN_INTERVAL} seconds.
+
+        @type changed_filenames:
+          sequence of L{Filename}s
+        @param changed_filenames:
+          Files known to have changed, e.g. by a file watcher.
+        """
+        cls._fingerprint_cache.clear()
+        project_roots = _get_project_roots()
+        if project_roots:
+            from pyflyby._symindex import SymbolIndex
+            now = time.time()
+            for root in project_roots:
+                index = SymbolIndex(root)
+                if index.updated_at is None:
+                    # Not loaded yet; it will be up to date when it is.
+                    continue
+                if now - index.updated_at >= cls.PROJECT_RESCAN_INTERVAL:
+                    index.update()
+                elif changed_filenames:
+                    index.update(changed_filenames)
+        env = (os.getenv("PYFLYBY_PATH"),
+               os.getenv("PYFLYBY_KNOWN_IMPORTS_PATH"),
+               os.getenv("PYFLYBY_MANDATORY_IMPORTS_PATH"),
+               os.getenv("PYFLYBY_PROJECT_PATH"))
+        for key, old_fingerprint in cls._default_cache_fingerprints.items():
+            if key[2:] != env:
+                # L{get_default_fingerprint} uses the current environment.
+                continue
+            if cls.get_default_fingerprint(key[1]) != old_fingerprint:
+                logger.debug("ImportDB: %s changed", key[1])
+                cls.clear_default_cache()
+                return
+
     @classmethod
     def interpret_arg(cls, arg, target_filename):
         if arg is None:
@@ -494,6 +668,33 @@ class ImportDB(object):
         else:
             return cls._from_code(filenames)
 
+    def _with_project_imports(self, project_imports, project_roots):
+        """
+        Return a copy of this database that also knows the first-party names
+        in C{project_imports}, as found by L{find_project_imports} in
+        C{project_roots}.
+
+        Names that this database already knows take precedence.
+
+        @type project_imports:
+          L{ImportSet}
+        @type project_roots:
+          sequence of L{Filename}s
+        @rtype:
+          L{ImportDB}
+        """
+        known = self.known_imports.by_import_as
+        imports = [imp for imp in project_imports
+                   if imp.import_as not in known]
+        logger.debug("ImportDB: adding %d imports from project index of [%s]",
+                     len(imports), ', '.join(map(str, project_roots)))
+        if not imports:
+            return self
+        return self._from_data(self.known_imports.with_imports(imports),
+                               self.mandatory_imports,
+                               self.canonical_imports,
+                               self.forget_imports)
+
     @classmethod
     def _parse_import_set(cls, arg):
         if isinstance(arg, basestring):
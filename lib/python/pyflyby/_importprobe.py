@@ -0,0 +1,393 @@
+# pyflyby/_importprobe.py.
+# Copyright (C) 2017 Karl Chen.
+# License: MIT http://opensource.org/licenses/MIT
+
+"""
+Testing whether import statements work, in separate worker processes.
+
+Executing an import can have any side effect: it adds modules to
+C{sys.modules}, may print or read stdin, and a broken extension module can
+crash or hang the process.  L{ImportProber} therefore executes imports in a
+pool of worker processes, killing and replacing a worker when an import
+takes longer than the timeout or crashes it.
+
+Each distinct import statement is executed once per run: results are kept
+in memory, and also in a temporary directory shared with processes forked
+from the one that created the prober (e.g. by C{process_actions} with
+C{-j}).  A process claims a statement before executing it; the others wait
+for its result.  Results are keyed by the statement and a fingerprint of the
+environment that affects imports (python, C{sys.path} and the working
+directory).  They aren't kept across runs, since editing a module doesn't
+change anything that would be cheap to check.
+"""
+
+from __future__ import absolute_import, division, with_statement
+
+import atexit
+import errno
+import hashlib
+import json
+import os
+from   shutil                   import rmtree
+import subprocess
+import sys
+import tempfile
+import time
+
+from   pyflyby._log             import logger
+
+
+DEFAULT_TIMEOUT = 30
+
+
+# Code run by worker processes.  It reads JSON-encoded statements from its
+# original stdin, one per line, and writes C{null} or an error message for
+# each to its original stdout.  Stdin, stdout and stderr are then redirected
+# to /dev/null, so that imported code can't interfere with the protocol.
+_WORKER_CODE = r"""
+import json, os, sys
+sys.path[:] = json.loads(sys.argv[1])
+requests = os.fdopen(os.dup(0), "r")
+responses = os.fdopen(os.dup(1), "w")
+devnull = os.open(os.devnull, os.O_RDWR)
+for fd in (0, 1, 2):
+    os.dup2(devnull, fd)
+while True:
+    line = requests.readline()
+    if not line:
+        break
+    try:
+        exec json.loads(line) in {}
+        result = None
+    except BaseException as e:
+        try:
+            result = "%s: %s" % (type(e).__name__, e)
+        except BaseException:
+            result = type(e).__name__
+    responses.write(json.dumps(result) + "\n")
+    responses.flush()
+"""
+
+
+def _describe_exit(status):
+    if status < 0:
+        return "Worker process killed by signal %d" % (-status,)
+    return "Worker process exited with status %d" % (status,)
+
+
+class _Worker(object):
+    """
+    A worker process, and the statement it is executing, if any.
+    """
+
+    def __init__(self):
+        self.proc = subprocess.Popen(
+            [sys.executable, "-c", _WORKER_CODE, json.dumps(sys.path)],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True)
+        self.statement = None
+        self.deadline = None
+
+    def fileno(self):
+        return self.proc.stdout.fileno()
+
+    def send(self, statement, timeout):
+        self.proc.stdin.write(json.dumps(statement) + "\n")
+        self.proc.stdin.flush()
+        self.statement = statement
+        self.deadline = time.time() + timeout
+
+    def receive(self):
+        """
+        Read the result for C{self.statement}.
+
+        @rtype:
+          C{str} or C{None}
+        @raise EOFError:
+          The worker died.
+        """
+        line = self.proc.stdout.readline()
+        if not line:
+            raise EOFError
+        self.statement = None
+        self.deadline = None
+        return json.loads(line)
+
+    def close(self):
+        """
+        Close our ends of the pipes; an idle worker then exits.
+        """
+        for f in (self.proc.stdin, self.proc.stdout):
+            try:
+                f.close()
+            except IOError:
+                pass
+
+    def kill(self):
+        try:
+            self.proc.kill()
+        except OSError:
+            pass
+        self.close()
+        self.proc.wait()
+
+
+class ImportProber(object):
+    """
+    Pool of worker processes that test whether import statements work.
+
+    @iattr jobs:
+      Maximum number of worker processes.
+    @iattr timeout:
+      Seconds after which an import is considered broken.
+    """
+
+    def __init__(self, jobs=None, timeout=DEFAULT_TIMEOUT):
+        if not jobs:
+            import multiprocessing
+            jobs = multiprocessing.cpu_count()
+        self.jobs = jobs
+        self.timeout = timeout
+        self._pid = os.getpid()
+        self._workers = []
+        self._results = {}
+        # Create the cache directory now, so that processes forked later
+        # share it.
+        self._cache_dir = tempfile.mkdtemp(prefix="pyflyby-importprobe-")
+        self._owns_cache_dir = True
+        atexit.register(self.close)
+
+    _default = None
+
+    @classmethod
+    def get_default(cls):
+        """
+        Return the default prober for this process.
+
+        @rtype:
+          L{ImportProber}
+        """
+        if cls._default is None:
+            cls._default = cls()
+        return cls._default
+
+    def _environment_fingerprint(self):
+        h = hashlib.sha1()
+        h.update(json.dumps([sys.executable, sys.path, os.getcwd()]))
+        return h.hexdigest()
+
+    def _cache_filename(self, key):
+        return os.path.join(self._cache_dir, hashlib.sha1(
+            "\0".join(key)).hexdigest())
+
+    def _get_cached(self, key):
+        try:
+            return self._results[key]
+        except KeyError:
+            pass
+        if self._cache_dir is None:
+            raise KeyError(key)
+        try:
+            with open(self._cache_filename(key)) as f:
+                result = json.load(f)
+        except (IOError, ValueError):
+            raise KeyError(key)
+        self._results[key] = result
+        return result
+
+    def _set_cached(self, key, result):
+        self._results[key] = result
+        if self._cache_dir is None:
+            return
+        filename = self._cache_filename(key)
+        temp_filename = "%s.tmp.%d" % (filename, os.getpid())
+        try:
+            with open(temp_filename, "w") as f:
+                json.dump(result, f)
+            os.rename(temp_filename, filename)
+        except (IOError, OSError) as e:
+            logger.debug("Couldn't cache import result: %s", e)
+
+    def _check_forked(self):
+        # Workers and the cache directory belong to the process that created
+        # them.  After a fork, drop our references to the parent's workers,
+        # but keep sharing the cache directory.
+        if os.getpid() != self._pid:
+            self._close_workers()
+            self._pid = os.getpid()
+            self._owns_cache_dir = False
+
+    def probe(self, statements):
+        """
+        Execute each of C{statements} in a worker process.
+
+        @type statements:
+          sequence of C{str}
+        @rtype:
+          C{dict}
+        @return:
+          Map from each statement to C{None} if it worked, else an error
+          message.
+        """
+        self._check_forked()
+        fingerprint = self._environment_fingerprint()
+        results = {}
+        pending = []
+        claimed_elsewhere = []
+        for statement in statements:
+            if statement in results:
+                continue
+            key = (fingerprint, statement)
+            try:
+                results[statement] = self._get_cached(key)
+            except KeyError:
+                results[statement] = None
+                if self._claim(key):
+                    pending.append(statement)
+                else:
+                    claimed_elsewhere.append(statement)
+        if pending:
+            self._run(fingerprint, pending, results)
+        if claimed_elsewhere:
+            self._wait_for_others(fingerprint, claimed_elsewhere, results)
+        return results
+
+    def _claim(self, key):
+        """
+        Claim executing the statement of C{key} for this process, so that
+        other processes sharing the cache directory wait for our result
+        instead of executing it too.
+
+        @rtype:
+          C{bool}
+        @return:
+          Whether we should execute it; C{False} if another process claimed
+          it first.
+        """
+        if self._cache_dir is None:
+            return True
+        try:
+            os.close(os.open(self._cache_filename(key) + ".claim",
+                             os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600))
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                return False
+            logger.debug("Couldn't claim import: %s", e)
+        return True
+
+    def _wait_for_others(self, fingerprint, statements, results):
+        """
+        Wait for the results of C{statements}, which other processes claimed.
+        If no result arrives for longer than the timeout (e.g. because the
+        other process was killed), execute the rest here.
+        """
+        remaining = list(statements)
+        deadline = time.time() + self.timeout + 1
+        while remaining and time.time() < deadline:
+            time.sleep(0.01)
+            for statement in remaining[:]:
+                try:
+                    results[statement] = self._get_cached(
+                        (fingerprint, statement))
+                except KeyError:
+                    continue
+                remaining.remove(statement)
+                deadline = time.time() + self.timeout + 1
+        if remaining:
+            self._run(fingerprint, remaining, results)
+
+    def _run(self, fingerprint, statements, results):
+        """
+        Execute C{statements} in the worker processes, and record their
+        results in C{results} and the cache.
+        """
+        import select
+        pending = list(reversed(statements))
+        num_pending = len(pending)
+        start_time = time.time()
+        busy = []
+        idle = list(self._workers)
+        try:
+            while pending or busy:
+                while pending and (idle or len(busy) < self.jobs):
+                    worker = idle.pop() if idle else self._add_worker()
+                    worker.send(pending.pop(), self.timeout)
+                    busy.append(worker)
+                timeout = max(0, min(w.deadline for w in busy) - time.time())
+                ready, _, _ = select.select(busy, [], [], timeout)
+                for worker in busy[:]:
+                    statement = worker.statement
+                    if worker in ready:
+                        try:
+                            result = worker.receive()
+                        except EOFError:
+                            result = self._replace_worker(
+                                worker, _describe_exit(worker.proc.wait()))
+                    elif time.time() >= worker.deadline:
+                        result = self._replace_worker(
+                            worker, "Timed out after %s seconds" % (
+                                self.timeout,))
+                    else:
+                        continue
+                    busy.remove(worker)
+                    if worker in self._workers:
+                        idle.append(worker)
+                    results[statement] = result
+                    self._set_cached((fingerprint, statement), result)
+        except BaseException:
+            for worker in busy:
+                self._replace_worker(worker, None)
+            raise
+        logger.debug("Tested %d imports in %.2fs with %d workers",
+                     num_pending, time.time() - start_time, len(self._workers))
+
+    def _add_worker(self):
+        worker = _Worker()
+        self._workers.append(worker)
+        return worker
+
+    def _replace_worker(self, worker, message):
+        """
+        Kill C{worker}; it will be replaced when needed.
+
+        @return:
+          C{message}
+        """
+        worker.kill()
+        self._workers.remove(worker)
+        return message
+
+    def close(self):
+        """
+        Stop the worker processes, and remove the cache directory if this
+        process created it.
+        """
+        if os.getpid() != self._pid:
+            return
+        self._close_workers()
+        self._remove_cache_dir()
+
+    def _close_workers(self):
+        for worker in self._workers:
+            worker.close()
+        self._workers = []
+
+    def _remove_cache_dir(self):
+        if self._cache_dir is not None and self._owns_cache_dir:
+            try:
+                rmtree(self._cache_dir)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            self._cache_dir = None
+
+    def clear(self):
+        """
+        Forget all results, and stop the worker processes, which may have
+        imported modules that have changed since.
+        """
+        self._check_forked()
+        self._close_workers()
+        self._results.clear()
+        if self._owns_cache_dir:
+            self._remove_cache_dir()
+            self._cache_dir = tempfile.mkdtemp(prefix="pyflyby-importprobe-")
@@ -4,17 +4,24 @@
 
 from __future__ import absolute_import, division, with_statement
 
+import bisect
+import contextlib
 import re
+import time
 
+from   pyflyby._autoimp         import _UnusedAndMissingImportFinder
 from   pyflyby._file            import FileText, Filename
 from   pyflyby._flags           import CompilerFlags
-from   pyflyby._idents          import brace_identifiers
+from   pyflyby._idents          import dotted_prefixes
 from   pyflyby._importclns      import ImportSet, NoSuchImportError
 from   pyflyby._importdb        import ImportDB
+from   pyflyby._importprobe     import ImportProber
 from   pyflyby._importstmt      import ImportFormatParams, ImportStatement
 from   pyflyby._log             import logger
 from   pyflyby._parse           import PythonBlock
-from   pyflyby._util            import ImportPathCtx, Inf, NullCtx, memoize
+from   pyflyby._report          import (report_added, report_removed,
+                                        report_timing, report_unresolved)
+from   pyflyby._util            import ImportPathCtx, Inf, NullCtx
 
 
 class SourceToSourceTransformationBase(object):
@@ -46,7 +53,8 @@ class SourceToSourceTransformationBase(object):
         @rtype:
           L{PythonBlock}
         """
-        result = self.pretty_print(params=params)
+        with report_timing("format"):
+            result = self.pretty_print(params=params)
         result = PythonBlock(result, filename=self.input.filename)
         return result
 
@@ -61,7 +69,45 @@ class SourceToSourceTransformation(SourceToSourceTransformationBase):
 
 class SourceToSourceImportBlockTransformation(SourceToSourceTransformationBase):
     def preprocess(self):
-        self.importset = ImportSet(self.input, ignore_shadowed=True)
+        self.imports = [
+            imp
+            for statement in self.input.statements
+            if not statement.is_comment_or_blank
+            for imp in ImportStatement(statement).imports]
+
+    @property
+    def imports(self):
+        """
+        The imports of this block, in order.  Earlier imports may be shadowed
+        by later ones; the order matters for transformations that determine
+        what's shadowed, such as replacing star imports.
+
+        @rtype:
+          C{list} of L{Import}s
+        """
+        return self._imports
+
+    @imports.setter
+    def imports(self, imports):
+        self._imports = list(imports)
+        self._importset = None
+
+    @property
+    def importset(self):
+        """
+        The imports of this block, excluding shadowed imports.
+
+        @rtype:
+          L{ImportSet}
+        """
+        if self._importset is None:
+            self._importset = ImportSet(self._imports, ignore_shadowed=True)
+        return self._importset
+
+    @importset.setter
+    def importset(self, importset):
+        self._imports = list(importset.imports)
+        self._importset = importset
 
     def pretty_print(self, params=None):
         params = ImportFormatParams(params)
@@ -80,25 +126,196 @@ class NoImportBlockError(Exception):
 class ImportAlreadyExistsError(Exception):
     pass
 
+class _PrefixTrieNode(object):
+    __slots__ = ('children', 'counts')
+
+    def __init__(self):
+        # Map from the next component of a dotted name to a child node.
+        self.children = {}
+        # Map from import block to the number of its imports whose dotted
+        # name passes through this node.
+        self.counts = {}
+
+
+class _ImportBlockIndex(object):
+    """
+    Index of the import blocks of a L{SourceToSourceFileImportsTransformation}.
+
+    This finds the block containing a line number by bisecting the blocks'
+    line intervals, and the blocks whose imports share the longest prefix
+    with an import by walking a trie of the dotted names of their imports,
+    rather than scanning all imports of all blocks.
+
+    The index reflects the C{importset} of each block when it was indexed;
+    use L{is_current} to check whether it's still valid.
+    """
+
+    def __init__(self, blocks):
+        self._importsets = {}
+        self._spans = []
+        self._starts = []
+        self._max_ends = []
+        self._trie = _PrefixTrieNode()
+        for block in blocks:
+            self.add_block(block)
+
+    def add_block(self, block):
+        """
+        Add C{block} and its imports to the index.
+
+        @type block:
+          L{SourceToSourceImportBlockTransformation}
+        """
+        importset = block.importset
+        self._importsets[block] = importset
+        span = (block.input.startpos.lineno, block.input.endpos.lineno,
+                len(self._spans), block)
+        bisect.insort(self._spans, span)
+        self._starts = [start for start, _, _, _ in self._spans]
+        # Running maximum of the last lines, so that a lookup can stop at the
+        # first interval that can't reach the line number.
+        self._max_ends = []
+        max_end = -Inf
+        for _, end, _, _ in self._spans:
+            max_end = max(max_end, end)
+            self._max_ends.append(max_end)
+        for imp in importset.imports:
+            self.add_import(block, imp)
+
+    def is_current(self, blocks):
+        """
+        Return whether the index reflects the current imports of C{blocks}.
+        """
+        importsets = self._importsets
+        return (len(blocks) == len(importsets) and
+                all(importsets.get(block) is block.importset
+                    for block in blocks))
+
+    def update_importset(self, block):
+        """
+        Record that C{block.importset} was replaced by one with the imports
+        that were added to and removed from the index.
+        """
+        self._importsets[block] = block.importset
+
+    def add_import(self, block, imp):
+        node = self._trie
+        for part in imp.fullname.split('.'):
+            child = node.children.get(part)
+            if child is None:
+                child = node.children[part] = _PrefixTrieNode()
+            node = child
+            node.counts[block] = node.counts.get(block, 0) + 1
+
+    def remove_import(self, block, imp):
+        node = self._trie
+        for part in imp.fullname.split('.'):
+            node = node.children[part]
+            count = node.counts[block] - 1
+            if count:
+                node.counts[block] = count
+            else:
+                del node.counts[block]
+
+    def find_by_lineno(self, lineno):
+        """
+        Return the blocks whose line interval contains C{lineno}.
+
+        @rtype:
+          C{list} of L{SourceToSourceImportBlockTransformation}
+        """
+        results = []
+        i = bisect.bisect_right(self._starts, lineno) - 1
+        while i >= 0 and self._max_ends[i] >= lineno:
+            _, end, _, block = self._spans[i]
+            if end >= lineno:
+                results.append(block)
+            i -= 1
+        return results
+
+    def find_by_prefix_match(self, imp, max_lineno):
+        """
+        Find the block containing the import with the longest common prefix
+        with C{imp}, as computed by L{Import.prefix_match}.  Tie-break by
+        preferring later blocks.
+
+        @param max_lineno:
+          Only consider blocks that end by line C{max_lineno}.
+        @rtype:
+          C{tuple} of (C{int}, L{SourceToSourceImportBlockTransformation})
+        @return:
+          The length of the common prefix, and the block.
+        @raise NoImportBlockError:
+          There are no blocks before C{max_lineno}.
+        """
+        path = []
+        node = self._trie
+        for part in imp.fullname.split('.'):
+            node = node.children.get(part)
+            if node is None:
+                break
+            path.append(node)
+        endpos_lineno = lambda block: block.input.endpos.lineno
+        # The blocks at each node are a subset of those at its parent, so the
+        # deepest node with a block that ends early enough has the best one.
+        for depth in xrange(len(path), 0, -1):
+            candidates = [block for block in path[depth-1].counts
+                          if endpos_lineno(block) <= max_lineno]
+            if candidates:
+                return depth, max(candidates, key=endpos_lineno)
+        candidates = [block for block in self._importsets
+                      if endpos_lineno(block) <= max_lineno]
+        if not candidates:
+            raise NoImportBlockError()
+        return 0, max(candidates, key=endpos_lineno)
+
+
 class SourceToSourceFileImportsTransformation(SourceToSourceTransformationBase):
     def preprocess(self):
+        # Index for finding import blocks, built when needed.
+        self._index = None
+        # While in L{batch}, the current imports of blocks that were modified.
+        self._pending = None
         # Group into blocks of imports and non-imports.  Get a sequence of all
         # imports for the transformers to operate on.
         self.blocks = []
         self.import_blocks = []
-        for is_imports, subblock in self.input.groupby(lambda ps: ps.is_import):
+        # Usually all the top-level imports are in a header at the beginning
+        # of the file.  In that case, only parse the header, and keep the rest
+        # of the code as an unparsed block.
+        split = self.input.split_header()
+        if split:
+            header, rest = split
+        else:
+            header, rest = self.input, None
+        for is_imports, subblock in header.groupby(lambda ps: ps.is_import):
             if is_imports:
                 trans = SourceToSourceImportBlockTransformation(subblock)
                 self.import_blocks.append(trans)
             else:
                 trans = SourceToSourceTransformation(subblock)
             self.blocks.append(trans)
+        if rest is not None:
+            self.blocks.append(SourceToSourceTransformation(rest))
 
     def pretty_print(self, params=None):
         params = ImportFormatParams(params)
         result = [block.pretty_print(params=params) for block in self.blocks]
         return FileText.concatenate(result)
 
+    @property
+    def code_modified(self):
+        """
+        Whether code outside the import blocks has been modified, so that
+        C{self.input} no longer reflects it.
+
+        @rtype:
+          C{bool}
+        """
+        return any(type(block) is SourceToSourceTransformation and
+                   block.output is not block.input
+                   for block in self.blocks)
+
     def find_import_block_by_lineno(self, lineno):
         """
         Find the import block containing the given line number.
@@ -108,41 +325,82 @@ class SourceToSourceFileImportsTransformation(SourceToSourceTransformationBase):
         @rtype:
           L{SourceToSourceImportBlockTransformation}
         """
-        results = [
-            b
-            for b in self.import_blocks
-            if b.input.startpos.lineno <= lineno <= b.input.endpos.lineno]
+        results = self._get_index().find_by_lineno(lineno)
         if len(results) == 0:
             raise LineNumberNotFoundError(lineno)
         if len(results) > 1:
             raise LineNumberAmbiguousError(lineno)
         return results[0]
 
-    def remove_import(self, import_as, lineno):
+    def _get_index(self):
+        index = self._index
+        if index is None or not index.is_current(self.import_blocks):
+            index = self._index = _ImportBlockIndex(self.import_blocks)
+        return index
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Context manager that defers updating the blocks modified by
+        L{add_import} and L{remove_import} until the end, so that each
+        block's L{ImportSet} is rebuilt only once, however many imports are
+        added to or removed from it.
         """
-        Remove the given import.
+        if self._pending is not None:
+            # Already in a batch.
+            yield
+            return
+        self._pending = {}
+        try:
+            yield
+        finally:
+            pending, self._pending = self._pending, None
+            index = self._index
+            for block, imports in pending.iteritems():
+                block.importset = ImportSet(list(imports))
+                if index is not None:
+                    index.update_importset(block)
+
+    def _current_imports(self, block):
+        # Return the mutable set of imports of C{block}, during a batch.
+        imports = self._pending.get(block)
+        if imports is None:
+            imports = self._pending[block] = set(block.importset.imports)
+        return imports
+
+    def remove_import(self, imp, lineno):
+        """
+        Remove the given import from the import block containing line
+        C{lineno}.
 
-        @type import_as:
-          C{str}
+        As with L{ImportSet.without_imports}, removing a star import also
+        removes imports from that module and its submodules.
+
+        @type imp:
+          L{Import}
         @type lineno:
           C{int}
+        @raise NoSuchImportError:
+          The block doesn't contain C{imp}.
+        @raise LineNumberNotFoundError:
+          C{lineno} isn't in a top-level import block.
         """
-        # Given a statement 'from foo import bar', older versions of pyflakes
-        # report 'bar', while newer ones report 'foo.bar'.  Handle both.
-        # TODO: once we move from pyflakes to our own parser, simplify this
-        # logic to always take an Import or ImportStatement.
-        import_as = import_as.rsplit(".", 1)[-1]
-        block = self.find_import_block_by_lineno(lineno)
-        try:
-            imports = block.importset.by_import_as[import_as]
-        except KeyError:
-            raise NoSuchImportError
-        assert len(imports)
-        if len(imports) > 1:
-            raise Exception("Multiple imports to remove: %r" % (imports,))
-        imp = imports[0]
-        block.importset = block.importset.without_imports([imp])
-        return imp
+        with self.batch():
+            block = self.find_import_block_by_lineno(lineno)
+            imports = self._current_imports(block)
+            if imp not in imports:
+                raise NoSuchImportError
+            removals = [imp]
+            if imp.split.member_name == "*":
+                module_name = imp.split.module_name
+                removals.extend(
+                    oimp for oimp in imports
+                    if oimp != imp and oimp.split.module_name and
+                    module_name in dotted_prefixes(oimp.split.module_name))
+            index = self._get_index()
+            for oimp in removals:
+                imports.remove(oimp)
+                index.remove_import(block, oimp)
 
     def select_import_block_by_closest_prefix_match(self, imp, max_lineno):
         """
@@ -157,26 +415,15 @@ class SourceToSourceFileImportsTransformation(SourceToSourceTransformationBase):
         @rtype:
           L{SourceToSourceImportBlockTransformation}
         """
-        # Create a data structure that annotates blocks with data by which
-        # we'll sort.
-        annotated_blocks = [
-            ( (max([0] + [len(imp.prefix_match(oimp))
-                          for oimp in block.importset.imports]),
-               block.input.endpos.lineno),
-              block )
-            for block in self.import_blocks
-            if block.input.endpos.lineno <= max_lineno ]
-        if not annotated_blocks:
-            raise NoImportBlockError()
-        annotated_blocks.sort()
+        score, block = self._get_index().find_by_prefix_match(imp, max_lineno)
         if imp.split.module_name == '__future__':
             # For __future__ imports, only add to an existing block that
             # already contains __future__ import(s).  If there are no existing
             # import blocks containing __future__, don't return any result
             # here, so that we will add a new one at the top.
-            if not annotated_blocks[-1][0][0] > 0:
+            if not score > 0:
                 raise NoImportBlockError
-        return annotated_blocks[-1][1]
+        return block
 
     def insert_new_blocks_after_comments(self, blocks):
         blocks = [SourceToSourceTransformationBase(block) for block in blocks]
@@ -222,6 +469,8 @@ class SourceToSourceFileImportsTransformation(SourceToSourceTransformationBase):
         sepblock.output = PythonBlock("\n")
         self.insert_new_blocks_after_comments([block, sepblock])
         self.import_blocks.insert(0, block)
+        if self._index is not None:
+            self._index.add_block(block)
         return block
 
     def add_import(self, imp, lineno=Inf):
@@ -235,14 +484,17 @@ class SourceToSourceFileImportsTransformation(SourceToSourceTransformationBase):
         @param lineno:
           Line before which to add the import.  C{Inf} means no constraint.
         """
-        try:
-            block = self.select_import_block_by_closest_prefix_match(
-                imp, lineno)
-        except NoImportBlockError:
-            block = self.insert_new_import_block()
-        if imp in block.importset.imports:
-            raise ImportAlreadyExistsError(imp)
-        block.importset = block.importset.with_imports([imp])
+        with self.batch():
+            try:
+                block = self.select_import_block_by_closest_prefix_match(
+                    imp, lineno)
+            except NoImportBlockError:
+                block = self.insert_new_import_block()
+            imports = self._current_imports(block)
+            if imp in imports:
+                raise ImportAlreadyExistsError(imp)
+            imports.add(imp)
+            self._get_index().add_import(block, imp)
 
 
 def reformat_import_statements(codeblock, params=None):
@@ -295,73 +547,48 @@ def ImportPathForRelativeImportsCtx(codeblock):
     return ImportPathCtx(str(codeblock.filename.dir))
 
 
-def _pyflakes_version():
-    import pyflakes
-    m = re.match("([0-9]+[.][0-9]+)", pyflakes.__version__)
-    if not m:
-        raise Exception(
-            "Can't get pyflakes version from %r" % (pyflakes.__version__,))
-    return float(m.group(1))
-
-
-def _pyflakes_checker(codeblock):
-    from pyflakes.checker import Checker
-    codeblock = PythonBlock(codeblock)
-    version = _pyflakes_version()
-    if version <= 0.4:
-        # pyflakes 0.4 uses the 'compiler' module.
-        return Checker(codeblock.parse_tree)
-    elif version >= 0.5:
-        # pyflakes 0.5 uses the 'ast' module.
-        return Checker(codeblock.ast_node)
-    else:
-        raise Exception("Unknown pyflakes version %r" % (version,))
-
-
-def _pyflakes_find_unused_and_missing_imports(codeblock):
+def _find_unused_and_missing_imports(codeblock, import_blocks=()):
     """
-    Find unused imports and missing imports, using Pyflakes to statically
-    analyze for unused and missing imports.
-
-    'bar' is unused and 'blah' is undefined:
-
-      >>> find_unused_and_missing_imports("import foo as bar\\nblah\\n")
-      ([('bar', 1)], [('blah', 2)])
+    Find unused imports and missing imports.  Helper function for
+    L{find_unused_and_missing_imports} and
+    L{fix_unused_and_missing_imports}.
 
     @type codeblock:
       L{PythonBlock} or convertible
+    @param import_blocks:
+      Current imports of top-level import blocks, to use instead of the
+      import statements in C{codeblock}.  See
+      L{_UnusedAndMissingImportFinder.scan}.
     @return:
-      C{(unused_imports, missing_imports)} where C{unused_imports} and
-      C{missing_imports} each are sequences of C{(import_as, lineno)} tuples.
+      C{(unused_imports, missing_imports)} where C{unused_imports} is a
+      sequence of C{(}L{Import}C{, lineno)} tuples and C{missing_imports} is a
+      sequence of C{(name, lineno)} tuples.
     """
-    from pyflakes import messages as M
     codeblock = PythonBlock(codeblock)
-    messages = _pyflakes_checker(codeblock).messages
-    unused_imports = []
-    missing_imports = []
-    for message in messages:
-        if isinstance(message, M.RedefinedWhileUnused):
-            # Ignore redefinitions in inner scopes.
-            if codeblock.text[message.lineno].startswith(" "):
-                continue
-            import_as, orig_lineno = message.message_args
-            unused_imports.append( (import_as, orig_lineno) )
-        elif isinstance(message, M.UnusedImport):
-            import_as, = message.message_args
-            unused_imports.append( (import_as, message.lineno) )
-        elif isinstance(message, M.UndefinedName):
-            import_as, = message.message_args
-            missing_imports.append( (import_as, message.lineno) )
-    return unused_imports, missing_imports
+    finder = _UnusedAndMissingImportFinder()
+    finder.scan(codeblock.ast_node, import_blocks)
+    # Doctests could only make imports used, so only look at them if there
+    # are unused imports.
+    if finder.has_unused_imports:
+        doctest_block = codeblock.get_doctests_block()
+        if doctest_block is not None:
+            finder.scan_soft(doctest_block.ast_node)
+    return finder.unused_imports, finder.missing_imports
 
 
 def find_unused_and_missing_imports(codeblock):
     """
     Find unused imports and missing imports, taking docstrings into account.
 
-    Pyflakes is used to statically analyze for unused and missing imports.
-    Doctests in docstrings are analyzed as code and epydoc references in
-    docstrings also prevent removal.
+    The code is statically analyzed in a single pass over its AST.  Doctests
+    in docstrings are analyzed as code and epydoc references in docstrings
+    also prevent removal.  Uses in doctests and string literals never cause
+    missing imports.
+
+    'bar' is unused and 'blah' is undefined:
+
+      >>> find_unused_and_missing_imports("import foo as bar\\nblah\\n")
+      ([('bar', 1)], [('blah', 2)])
 
     In the following example, 'bar' is not considered unused because there is
     a string that references it in braces:
@@ -375,48 +602,10 @@ def find_unused_and_missing_imports(codeblock):
       C{(unused_imports, missing_imports)} where C{unused_imports} and
       C{missing_imports} each are sequences of C{(import_as, lineno)} tuples.
     """
-    # TODO: rewrite this using our own AST parser.
-    # Once we do that we can also process doctests and literal brace
-    # identifiers at the proper scope level.  We should treat both doctests
-    # and literal brace identifiers as "soft" uses that don't trigger missing
-    # imports but do trigger as used imports.
-    codeblock = PythonBlock(codeblock)
-    # Run pyflakes on the main code.
-    unused_imports, missing_imports = (
-        _pyflakes_find_unused_and_missing_imports(codeblock))
-    # Find doctests.
-    doctest_blocks = codeblock.get_doctests()
-    if doctest_blocks:
-        # There are doctests.  Re-run pyflakes on main code + doctests.  Don't
-        # report missing imports in doctests, but do treat existing imports as
-        # 'used' if they are used in doctests.
-        # Create one data structure to pass to pyflakes.  This is going to
-        # screw up linenos but we won't use them, so it doesn't matter.
-        bigblock = PythonBlock.concatenate([codeblock] + doctest_blocks,
-                                           assume_contiguous=True)
-        wdt_unused_imports, _ = ( # wdt = with doc tests
-            _pyflakes_find_unused_and_missing_imports(bigblock))
-        wdt_unused_asimports = set(
-            import_as for import_as, lineno in wdt_unused_imports)
-        # Keep only the intersection of unused imports.
-        unused_imports = [
-            (import_as, lineno) for import_as, lineno in unused_imports
-            if import_as in wdt_unused_asimports ]
-    # Find literal brace identifiers like "... L{Foo} ...".
-    # TODO: merge this into our own AST-based missing/unused-import-finder
-    # (replacing pyflakes).
-    literal_brace_identifiers = set(
-        iden
-        for f in codeblock.string_literals()
-        for iden in brace_identifiers(f.s))
-    if literal_brace_identifiers:
-        # Pyflakes doesn't look at docstrings containing references like
-        # "L{foo}" which require an import, nor at C{str.format} strings like
-        # '''"{foo}".format(...)'''.  Don't remove supposedly-unused imports
-        # which match a string literal brace identifier.
-        unused_imports = [
-            (import_as, lineno) for import_as, lineno in unused_imports
-            if import_as not in literal_brace_identifiers ]
+    unused_imports, missing_imports = _find_unused_and_missing_imports(
+        codeblock)
+    unused_imports = [(imp.import_as, lineno)
+                      for imp, lineno in unused_imports]
     return unused_imports, missing_imports
 
 
@@ -427,8 +616,7 @@ def fix_unused_and_missing_imports(codeblock,
                                    db=None,
                                    params=None):
     r"""
-    Using C{pyflakes}, check for unused and missing imports, and fix them
-    automatically.
+    Check for unused and missing imports, and fix them automatically.
 
     Also formats imports.
 
@@ -454,6 +642,40 @@ def fix_unused_and_missing_imports(codeblock,
       L{PythonBlock}
     """
     codeblock = PythonBlock(codeblock)
+    params = ImportFormatParams(params)
+    transformer = SourceToSourceFileImportsTransformation(codeblock)
+    transformer = _fix_unused_and_missing_imports(
+        transformer, add_missing=add_missing, remove_unused=remove_unused,
+        add_mandatory=add_mandatory, db=db, params=params)
+    return transformer.output(params=params)
+
+
+def _fix_unused_and_missing_imports(transformer,
+                                    add_missing=True,
+                                    remove_unused="AUTOMATIC",
+                                    add_mandatory=True,
+                                    db=None,
+                                    params=None):
+    """
+    Fix unused and missing imports in C{transformer}.  Helper function for
+    L{fix_unused_and_missing_imports} and L{tidy_imports}.
+
+    The analysis uses the AST of C{transformer.input}, with the current
+    imports of its import blocks.  If code outside the import blocks was
+    modified, then the code is rendered and parsed again first.
+
+    @type transformer:
+      L{SourceToSourceFileImportsTransformation}
+    @rtype:
+      L{SourceToSourceFileImportsTransformation}
+    @return:
+      C{transformer}, or the new transformation if the code was parsed
+      again.
+    """
+    if transformer.code_modified:
+        transformer = SourceToSourceFileImportsTransformation(
+            transformer.output(params=params))
+    codeblock = transformer.input
     if remove_unused == "AUTOMATIC":
         fn = codeblock.filename
         remove_unused = not (fn and
@@ -463,112 +685,123 @@ def fix_unused_and_missing_imports(codeblock,
         pass
     else:
         raise ValueError("Invalid remove_unused=%r" % (remove_unused,))
-    params = ImportFormatParams(params)
     db = ImportDB.interpret_arg(db, target_filename=codeblock.filename)
-    # Do a first pass reformatting the imports to get rid of repeated or
-    # shadowed imports.  This is a kludge to deal with pyflakes complaining
-    # about L1 here:
-    #   import foo  # L1
-    #   import foo  # L2
-    #   foo         # L3
-    # TODO: use our own AST parser which will have many benefits including
-    # avoiding this kludge.
-    codeblock = reformat_import_statements(codeblock, params=params)
-
     filename = codeblock.filename
-    transformer = SourceToSourceFileImportsTransformation(codeblock)
-    unused_imports, missing_imports = find_unused_and_missing_imports(codeblock)
-
-    if remove_unused and unused_imports:
-        # Go through imports to remove.  [This used to be organized by going
-        # through import blocks and removing all relevant blocks from there,
-        # but if one removal caused problems the whole thing would fail.  The
-        # CPU cost of calling without_imports() multiple times isn't worth
-        # that.]
-        # TODO: don't remove unused mandatory imports.  [This isn't
-        # implemented yet because this isn't necessary for __future__ imports
-        # since they aren't reported as unused, and those are the only ones we
-        # have by default right now.]
-        unused_imports.sort(key=lambda (import_as, lineno): (lineno, import_as))
-        for import_as, lineno in unused_imports:
-            try:
-                imp = transformer.remove_import(import_as, lineno)
-            except NoSuchImportError:
-                logger.error(
-                    "%s: couldn't remove import %r", filename, import_as,)
-            except LineNumberNotFoundError as e:
-                logger.error(
-                    "%s: unused import %r on line %d not global",
-                    filename, import_as, e.args[0])
-            else:
-                logger.info("%s: removed unused '%s'", filename, imp)
-
-    if add_missing and missing_imports:
-        missing_imports.sort(key=lambda (import_as, lineno): (lineno, import_as))
-        known = db.known_imports.by_import_as
-        # Decide on where to put each import to be added.  Find the import
-        # block with the longest common prefix.  Tie-break by preferring later
-        # blocks.
-        added_imports = set()
-        for import_as, lineno in missing_imports:
-            try:
-                imports = known[import_as]
-            except KeyError:
-                logger.warning(
-                    "%s:%s: undefined name %r and no known import for it",
-                    filename, lineno, import_as)
-                continue
-            if len(imports) != 1:
-                logger.error("%s: don't know which of %r to use",
-                             filename, imports)
-                continue
-            imp_to_add = imports[0]
-            if imp_to_add in added_imports:
-                continue
-            transformer.add_import(imp_to_add, lineno)
-            added_imports.add(imp_to_add)
-            logger.info("%s: added %r", filename,
-                        imp_to_add.pretty_print().strip())
-
-    if add_mandatory:
-        # Todo: allow not adding to empty __init__ files?
-        mandatory = db.mandatory_imports.imports
-        for imp in mandatory:
-            try:
-                transformer.add_import(imp)
-            except ImportAlreadyExistsError:
-                pass
-            else:
-                logger.info("%s: added mandatory %r",
-                            filename, imp.pretty_print().strip())
+    import_blocks = [
+        (block.input.startpos.lineno, block.input.endpos.lineno,
+         block.importset.imports)
+        for block in transformer.import_blocks]
+    unused_imports, missing_imports = _find_unused_and_missing_imports(
+        codeblock, import_blocks)
+
+    # Go through imports to remove and add one at a time, so that if one
+    # causes problems the rest still work.  In a batch, each import block is
+    # only rebuilt once at the end.
+    with transformer.batch():
+        if remove_unused and unused_imports:
+            # TODO: don't remove unused mandatory imports.  [This isn't
+            # implemented yet because this isn't necessary for __future__
+            # imports since they aren't reported as unused, and those are the
+            # only ones we have by default right now.]
+            for imp, lineno in unused_imports:
+                try:
+                    transformer.remove_import(imp, lineno)
+                except NoSuchImportError:
+                    logger.error("%s: couldn't remove import %r",
+                                 filename, imp.import_as)
+                except LineNumberNotFoundError as e:
+                    logger.error(
+                        "%s: unused import %r on line %d not global",
+                        filename, imp.import_as, e.args[0])
+                else:
+                    logger.info("%s: removed unused '%s'", filename, imp)
+                    report_removed(imp)
+
+        if add_missing and missing_imports:
+            missing_imports.sort(
+                key=lambda (import_as, lineno): (lineno, import_as))
+            known = db.known_imports.by_import_as
+            # Decide on where to put each import to be added.  Find the import
+            # block with the longest common prefix.  Tie-break by preferring
+            # later blocks.
+            added_imports = set()
+            for import_as, lineno in missing_imports:
+                try:
+                    imports = known[import_as]
+                except KeyError:
+                    logger.warning(
+                        "%s:%s: undefined name %r and no known import for it",
+                        filename, lineno, import_as)
+                    report_unresolved(import_as, lineno)
+                    continue
+                if len(imports) != 1:
+                    logger.error("%s: don't know which of %r to use",
+                                 filename, imports)
+                    report_unresolved(import_as, lineno)
+                    continue
+                imp_to_add = imports[0]
+                if imp_to_add in added_imports:
+                    continue
+                transformer.add_import(imp_to_add, lineno)
+                added_imports.add(imp_to_add)
+                logger.info("%s: added %r", filename,
+                            imp_to_add.pretty_print().strip())
+                report_added(imp_to_add)
+
+        if add_mandatory:
+            # Todo: allow not adding to empty __init__ files?
+            mandatory = db.mandatory_imports.imports
+            for imp in mandatory:
+                try:
+                    transformer.add_import(imp)
+                except ImportAlreadyExistsError:
+                    pass
+                else:
+                    logger.info("%s: added mandatory %r",
+                                filename, imp.pretty_print().strip())
+                    report_added(imp)
 
-    return transformer.output(params=params)
+    return transformer
 
 
-def remove_broken_imports(codeblock, params=None):
+def remove_broken_imports(codeblock, params=None, prober=None):
     """
     Try to execute each import, and remove the ones that don't work.
 
+    Imports are executed in worker processes (see L{ImportProber}), so
+    they can't affect this process, and an import that hangs or crashes
+    counts as broken.  Each distinct import is executed once per run.
+
     Also formats imports.
 
     @type codeblock:
       L{PythonBlock} or convertible (C{str})
+    @type prober:
+      L{ImportProber}
+    @param prober:
+      Prober to use.  Defaults to L{ImportProber.get_default}.
     @rtype:
       L{PythonBlock}
     """
     codeblock = PythonBlock(codeblock)
     params = ImportFormatParams(params)
+    if prober is None:
+        prober = ImportProber.get_default()
     filename = codeblock.filename
     transformer = SourceToSourceFileImportsTransformation(codeblock)
+    statements = {}
+    for block in transformer.import_blocks:
+        for imp in block.importset.imports:
+            statements[imp] = imp.pretty_print()
+    errors = prober.probe(sorted(set(statements.values())))
     for block in transformer.import_blocks:
         broken = []
         for imp in list(block.importset.imports):
-            ns = {}
-            try:
-                exec imp.pretty_print() in ns
-            except Exception as e:
-                logger.info("%s: Could not import %r; removing it: %s: %s",
-                            filename, imp.fullname, type(e).__name__, e)
+            error = errors[statements[imp]]
+            if error is not None:
+                logger.info("%s: Could not import %r; removing it: %s",
+                            filename, imp.fullname, error)
+                report_removed(imp)
                 broken.append(imp)
         block.importset = block.importset.without_imports(broken)
     return transformer.output(params=params)
@@ -604,24 +837,34 @@ def replace_star_imports(codeblock, params=None):
     @rtype:
       L{PythonBlock}
     """
-    from pyflyby._modules import ModuleHandle
     params = ImportFormatParams(params)
-    codeblock = PythonBlock(codeblock)
-    filename = codeblock.filename
     transformer = SourceToSourceFileImportsTransformation(codeblock)
+    transformer = _replace_star_imports(transformer)
+    return transformer.output(params=params)
+
+
+def _replace_star_imports(transformer):
+    """
+    Replace star imports in C{transformer}.  Helper function for
+    L{replace_star_imports} and L{tidy_imports}.
+
+    @type transformer:
+      L{SourceToSourceFileImportsTransformation}
+    @rtype:
+      L{SourceToSourceFileImportsTransformation}
+    """
+    from pyflyby._modules import ModuleHandle
+    codeblock = transformer.input
+    filename = codeblock.filename
     for block in transformer.import_blocks:
-        # Iterate over the import statements in C{block.input}.  We do this
-        # instead of using C{block.importset} because the latter doesn't
-        # preserve the order of inputs.  The order is important for
-        # determining what's shadowed.
-        imports = [
-            imp
-            for s in block.input.statements
-            for imp in ImportStatement(s).imports
-        ]
+        # Iterate over C{block.imports} rather than C{block.importset},
+        # because the latter doesn't preserve the order of inputs.  The order
+        # is important for determining what's shadowed.
+        if not any(imp.split.member_name == "*" for imp in block.imports):
+            continue
         # Process "from ... import *" statements.
         new_imports = []
-        for imp in imports:
+        for imp in block.imports:
             if imp.split.member_name != "*":
                 new_imports.append(imp)
             elif imp.split.module_name.startswith("."):
@@ -660,8 +903,155 @@ def replace_star_imports(codeblock, params=None):
                     new_imports.extend(exports)
                     logger.info("%s: replaced %r with %d imports", filename,
                                 imp.pretty_print().strip(), len(exports))
-        block.importset = ImportSet(new_imports, ignore_shadowed=True)
-    return transformer.output(params=params)
+                    report_removed(imp)
+                    for export in exports:
+                        report_added(export)
+        block.imports = new_imports
+    return transformer
+
+
+class _CompiledImportTransformations(object):
+    """
+    A map of import prefix replacements, compiled once so that it can be
+    applied quickly to many files.
+
+    Imports are rewritten by looking up the longest matching prefix of their
+    dotted name in a trie.  Other code is rewritten by a single regular
+    expression pass that only stops at dotted names starting with the first
+    component of some prefix; each such name is then rewritten by the same
+    trie lookup at each component, left to right.  This gives the same
+    result as doing one C{re.sub(r"\\bPREFIX\\b", ...)} per prefix,
+    except that when prefixes overlap, the longest one wins and replaced
+    text is not rewritten again.
+    """
+
+    # Sentinel key in trie nodes for the replacement of the prefix ending
+    # there.
+    _VALUE = object()
+
+    _DOTTED_NAME_RE = r"\w+(?:\.\w+)*"
+
+    def __init__(self, transformations):
+        self._trie = {}
+        # Prefixes that aren't dotted identifiers are replaced by one
+        # C{re.sub} each.
+        self._other = []
+        for k, v in sorted(transformations.iteritems()):
+            if not re.match(r"\A%s\Z" % (self._DOTTED_NAME_RE,), k):
+                self._other.append(
+                    (re.compile(r"\b%s\b" % (re.escape(k),)), v))
+                continue
+            node = self._trie
+            for part in k.split("."):
+                node = node.setdefault(part, {})
+            node[self._VALUE] = (k, v)
+        if self._trie:
+            first_parts = sorted(self._trie, key=lambda x: (-len(x), x))
+            self._text_re = re.compile(r"\b(?:%s)\b(?:\.\w+)*" % (
+                "|".join(re.escape(x) for x in first_parts),))
+        else:
+            self._text_re = None
+        self._import_cache = {}
+
+    def _longest_match(self, parts, start):
+        """
+        Find the longest prefix in the trie matching C{parts[start:]}.
+
+        @rtype:
+          C{tuple}
+        @return:
+          C{(end, (prefix, replacement))}, or C{(start, None)} if there is no
+          match.
+        """
+        node = self._trie
+        result = (start, None)
+        for i in xrange(start, len(parts)):
+            node = node.get(parts[i])
+            if node is None:
+                break
+            value = node.get(self._VALUE)
+            if value is not None:
+                result = (i + 1, value)
+        return result
+
+    def transform_import(self, imp):
+        """
+        Apply the replacement of the longest prefix of C{imp.fullname}.
+
+        @type imp:
+          L{Import}
+        @rtype:
+          L{Import}
+        """
+        try:
+            return self._import_cache[imp]
+        except KeyError:
+            pass
+        result = imp
+        _, value = self._longest_match(imp.fullname.split("."), 0)
+        if value is not None:
+            result = imp.replace(*value)
+        self._import_cache[imp] = result
+        return result
+
+    def _replace_dotted_name(self, match):
+        token = match.group(0)
+        parts = token.split(".")
+        result = []
+        changed = False
+        i = 0
+        while i < len(parts):
+            end, value = self._longest_match(parts, i)
+            if value is None:
+                result.append(parts[i])
+                i += 1
+            else:
+                result.append(value[1])
+                changed = True
+                i = end
+        if not changed:
+            return token
+        return ".".join(result)
+
+    def transform_text(self, text):
+        """
+        Do a crude textual replacement of prefixes in C{text}.
+
+        @type text:
+          C{str}
+        @rtype:
+          C{str}
+        """
+        if self._text_re is not None:
+            text = self._text_re.sub(self._replace_dotted_name, text)
+        for regexp, replacement in self._other:
+            text = regexp.sub(replacement, text)
+        return text
+
+
+_compiled_import_transformations = {}
+
+def _compile_import_transformations(transformations):
+    """
+    Return a L{_CompiledImportTransformations} for C{transformations}.  The
+    result is cached, so that a run that applies the same transformations to
+    many files only compiles them once.
+
+    @type transformations:
+      C{dict} or L{ImportMap}
+    @rtype:
+      L{_CompiledImportTransformations}
+    """
+    key = frozenset(transformations.iteritems())
+    try:
+        return _compiled_import_transformations[key]
+    except KeyError:
+        pass
+    result = _CompiledImportTransformations(transformations)
+    if len(_compiled_import_transformations) >= 16:
+        _compiled_import_transformations.clear()
+    _compiled_import_transformations[key] = result
+    return result
 
 
 def transform_imports(codeblock, transformations, params=None):
@@ -689,33 +1079,50 @@ def transform_imports(codeblock, transformations, params=None):
     @rtype:
       L{PythonBlock}
     """
-    codeblock = PythonBlock(codeblock)
     params = ImportFormatParams(params)
     transformer = SourceToSourceFileImportsTransformation(codeblock)
-    @memoize
+    transformer = _transform_imports(transformer, transformations)
+    return transformer.output(params=params)
+
+
+def _transform_imports(transformer, transformations):
+    """
+    Transform imports in C{transformer}.  Helper function for
+    L{transform_imports}, L{canonicalize_imports} and L{tidy_imports}.
+
+    Code outside import blocks is only replaced if the textual replacement
+    changes it.
+
+    @type transformer:
+      L{SourceToSourceFileImportsTransformation}
+    @rtype:
+      L{SourceToSourceFileImportsTransformation}
+    """
+    if not transformations:
+        return transformer
+    compiled = _compile_import_transformations(transformations)
     def transform_import(imp):
-        # Transform a block of imports.
-        # TODO: optimize
-        # TODO: handle transformations containing both a.b=>x and a.b.c=>y
-        for k, v in transformations.iteritems():
-            imp = imp.replace(k, v)
-        return imp
+        result = compiled.transform_import(imp)
+        if result != imp:
+            report_removed(imp)
+            report_added(result)
+        return result
     def transform_block(block):
         # Do a crude string replacement in the PythonBlock.
         block = PythonBlock(block)
-        s = block.text.joined
-        for k, v in transformations.iteritems():
-            s = re.sub("\\b%s\\b" % (re.escape(k)), v, s)
+        orig = block.text.joined
+        s = compiled.transform_text(orig)
+        if s == orig:
+            return block
         return PythonBlock(s, flags=block.flags)
     # Loop over transformer blocks.
     for block in transformer.blocks:
         if isinstance(block, SourceToSourceImportBlockTransformation):
-            input_imports = block.importset.imports
-            output_imports = [ transform_import(imp) for imp in input_imports ]
-            block.importset = ImportSet(output_imports, ignore_shadowed=True)
+            block.imports = [ transform_import(imp)
+                              for imp in block.imports ]
         else:
-            block.output = transform_block(block.input)
-    return transformer.output(params=params)
+            block.output = transform_block(block.output)
+    return transformer
 
 
 def canonicalize_imports(codeblock, params=None, db=None):
@@ -728,8 +1135,98 @@ def canonicalize_imports(codeblock, params=None, db=None):
     @rtype:
       L{PythonBlock}
     """
+    params = ImportFormatParams(params)
+    transformer = SourceToSourceFileImportsTransformation(codeblock)
+    transformer = _canonicalize_imports(transformer, db=db)
+    return transformer.output(params=params)
+
+
+def _canonicalize_imports(transformer, db=None):
+    """
+    Canonicalize imports in C{transformer}.  Helper function for
+    L{canonicalize_imports} and L{tidy_imports}.
+
+    @type transformer:
+      L{SourceToSourceFileImportsTransformation}
+    @rtype:
+      L{SourceToSourceFileImportsTransformation}
+    """
+    db = ImportDB.interpret_arg(db, target_filename=transformer.input.filename)
+    return _transform_imports(transformer, db.canonical_imports)
+
+
+def tidy_imports(codeblock,
+                 canonicalize=True,
+                 transformations=None,
+                 replace_star=False,
+                 add_missing=True,
+                 remove_unused="AUTOMATIC",
+                 add_mandatory=True,
+                 db=None,
+                 params=None):
+    r"""
+    Canonicalize imports, transform imports, replace star imports, and fix
+    unused and missing imports, as the C{tidy-imports} command does.
+
+    This gives the same result as chaining L{canonicalize_imports},
+    L{transform_imports}, L{replace_star_imports} and
+    L{fix_unused_and_missing_imports}, but all stages operate on one
+    L{SourceToSourceFileImportsTransformation}: the code is parsed once
+    (unless a transformation modifies code outside the import blocks), and
+    the output is rendered only at the end.  The time taken by each stage is
+    logged at debug level.
+
+      >>> codeblock = PythonBlock(
+      ...     'from foo import m1, m2\n'
+      ...     'm2, np.foo', filename="/tmp/foo.py")
+
+      >>> print tidy_imports(codeblock, add_mandatory=False)
+      [PYFLYBY] /tmp/foo.py: removed unused 'from foo import m1'
+      [PYFLYBY] /tmp/foo.py: added 'import numpy as np'
+      import numpy as np
+      from foo import m2
+      m2, np.foo
+
+    @type codeblock:
+      L{PythonBlock} or convertible (C{str})
+    @param canonicalize:
+      Whether to apply C{__canonical_imports__} from the import database.
+    @type transformations:
+      C{dict} from C{str} to C{str}
+    @param transformations:
+      Import prefixes to replace, as for L{transform_imports}.
+    @param replace_star:
+      Whether to replace star imports, as for L{replace_star_imports}.
+    @rtype:
+      L{PythonBlock}
+    """
     codeblock = PythonBlock(codeblock)
     params = ImportFormatParams(params)
     db = ImportDB.interpret_arg(db, target_filename=codeblock.filename)
-    transformations = db.canonical_imports
-    return transform_imports(codeblock, transformations, params=params)
+    stages = []
+    if canonicalize:
+        stages.append(("canonicalize",
+                       lambda t: _canonicalize_imports(t, db=db)))
+    if transformations:
+        stages.append(("transform",
+                       lambda t: _transform_imports(t, transformations)))
+    if replace_star:
+        stages.append(("replace_star", _replace_star_imports))
+    stages.append(("fix_unused_and_missing", lambda t:
+                   _fix_unused_and_missing_imports(
+                       t, add_missing=add_missing, remove_unused=remove_unused,
+                       add_mandatory=add_mandatory, db=db, params=params)))
+    timings = []
+    start = time.time()
+    transformer = SourceToSourceFileImportsTransformation(codeblock)
+    timings.append(("preprocess", time.time() - start))
+    for name, stage in stages:
+        start = time.time()
+        transformer = stage(transformer)
+        timings.append((name, time.time() - start))
+    start = time.time()
+    result = transformer.output(params=params)
+    timings.append(("output", time.time() - start))
+    logger.debug("%s: tidy_imports timings: %s", codeblock.filename,
+                 ", ".join("%s %.4fs" % (name, t) for name, t in timings))
+    return result
@@ -4,10 +4,14 @@
 
 from __future__ import absolute_import, division, with_statement
 
+from   collections              import namedtuple
+import imp
 import os
 import re
+import stat
 import sys
 import types
+import zipimport
 
 from   pyflyby._file            import FileText, Filename
 from   pyflyby._idents          import DottedIdentifier, is_identifier
@@ -74,37 +78,186 @@ def import_module(module_name):
 
 def _my_iter_modules(path, prefix=''):
     # Modified version of pkgutil.ImpImporter.iter_modules(), patched to
-    # handle inaccessible subdirectories.
+    # handle inaccessible subdirectories, and to use cached directory
+    # listings (see L{_cached_listdir}).
     if path is None:
         return
-    try:
-        filenames = os.listdir(path)
-    except OSError:
+    candidates = _module_candidates(path)
+    if candidates is None:
         return # silently ignore inaccessible paths
-    filenames.sort()  # handle packages before same-named modules
-    yielded = {}
+    yielded = set()
+    for modname, is_dir in candidates:
+        if modname in yielded:
+            continue
+        if is_dir:
+            if not _is_package_listing(_cached_listdir(
+                    os.path.join(path, modname))):
+                continue # not a package, or inaccessible
+        yielded.add(modname)
+        yield prefix + modname, is_dir
+
+
+_module_candidates_cache = {}
+
+def _module_candidates(dirname):
+    """
+    Compute the names in directory C{dirname} that could be modules or
+    packages, in the order C{pkgutil} would yield them (packages before
+    same-named modules).
+
+    The result is cached alongside the directory listing, and revalidated by
+    the directory's mtime.  Whether a subdirectory is really a package depends
+    on its own contents, so callers still need to check that.
+
+    @rtype:
+      C{tuple} of C{(str, bool)}, or C{None}
+    @return:
+      C{(name, is_dir)} tuples, or C{None} if C{dirname} is not a readable
+      directory.
+    """
     import inspect
-    for fn in filenames:
+    names = _cached_listdir(dirname)
+    if names is None:
+        return None
+    try:
+        cached_names, result = _module_candidates_cache[dirname]
+    except KeyError:
+        pass
+    else:
+        if cached_names is names:
+            return result
+    result = []
+    for fn in sorted(names):
         modname = inspect.getmodulename(fn)
-        if modname=='__init__' or modname in yielded:
+        if modname == '__init__':
+            continue
+        if modname:
+            if '.' not in modname:
+                result.append((modname, False))
+        elif '.' not in fn:
+            result.append((fn, True))
+    result = tuple(result)
+    _module_candidates_cache[dirname] = (names, result)
+    return result
+
+
+def _is_package_listing(names):
+    """
+    Return whether a directory listing contains an C{__init__} module.
+
+    @type names:
+      C{frozenset} of C{str}, or C{None}
+    """
+    if not names:
+        return False
+    return any("__init__" + suffix in names
+               for suffix, _, _ in imp.get_suffixes())
+
+
+_zip_modules_cache = {}
+
+def _iter_zip_modules(path_entry, prefix=''):
+    """
+    Enumerate the modules in a zip file C{sys.path} entry (or a package
+    directory inside a zip file).
+
+    The modules of every directory in the archive are indexed in one pass
+    over the archive's table of contents.  Like L{_my_iter_modules}, results
+    are cached and revalidated by the mtime of the archive.
+    """
+    try:
+        importer = zipimport.zipimporter(path_entry)
+    except zipimport.ZipImportError:
+        return
+    archive = importer.archive
+    try:
+        mtime = os.stat(archive).st_mtime
+    except OSError:
+        return
+    try:
+        cached_mtime, index = _zip_modules_cache[archive]
+    except KeyError:
+        cached_mtime = index = None
+    if cached_mtime != mtime:
+        if cached_mtime is not None:
+            # The archive changed.  Make zipimport re-read its directory.
+            zipimport._zip_directory_cache.pop(archive, None)
+            importer = zipimport.zipimporter(path_entry)
+        index = _index_zip_archive(
+            zipimport._zip_directory_cache[importer.archive])
+        _zip_modules_cache[archive] = (mtime, index)
+    for modname, ispkg in index.get(importer.prefix, ()):
+        yield prefix + modname, ispkg
+
+
+def _index_zip_archive(filenames):
+    """
+    Compute the modules in each directory of a zip archive, in the order
+    C{pkgutil} would yield them.
+
+      >>> index = _index_zip_archive(['a.py', 'p/__init__.py', 'p/b.pyc',
+      ...                             'p/q/__init__.py', 'p/c.txt'])
+      >>> index[''], index['p/']
+      ((('a', False), ('p', True)), (('b', False), ('q', True)))
+
+    @param filenames:
+      Archive member names, using C{os.sep} as the separator.
+    @rtype:
+      C{dict} from C{str} to C{tuple} of C{(str, bool)}
+    @return:
+      Map from directory prefix within the archive (either C{''} or ending
+      with C{os.sep}) to C{(name, ispkg)} tuples.
+    """
+    import inspect
+    index = {}
+    yielded = {}
+    def add(dirprefix, modname, ispkg):
+        seen = yielded.setdefault(dirprefix, set())
+        if modname not in seen:
+            seen.add(modname)
+            index.setdefault(dirprefix, []).append((modname, ispkg))
+    for fn in sorted(filenames):
+        parts = fn.split(os.sep)
+        if len(parts) >= 2 and parts[-1].startswith('__init__.py'):
+            add(os.sep.join(parts[:-2] + ['']), parts[-2], True)
+            continue
+        modname = inspect.getmodulename(parts[-1])
+        if modname == '__init__':
+            continue
+        if modname and '.' not in modname:
+            add(os.sep.join(parts[:-1] + ['']), modname, False)
+    return dict((k, tuple(v)) for k, v in index.iteritems())
+
+
+def _iter_modules(path):
+    """
+    Enumerate the modules in a sequence of C{sys.path}-style entries, like
+    C{pkgutil.iter_modules(path)}, yielding C{(name, ispkg)} tuples.
+
+    Directories and zip files are enumerated using cached listings.  Entries
+    handled by other import hooks are delegated to C{pkgutil}.
+    """
+    import pkgutil
+    for entry in path:
+        if not isinstance(entry, basestring):
+            continue
+        importer = sys.path_importer_cache.get(entry)
+        if isinstance(importer, imp.NullImporter):
+            continue
+        dirname = entry or os.getcwd()
+        if importer is None and _cached_listdir(dirname) is not None:
+            for t in _my_iter_modules(dirname):
+                yield t
+            continue
+        if importer is None or isinstance(importer, zipimport.zipimporter):
+            for t in _iter_zip_modules(entry):
+                yield t
             continue
-        subpath = os.path.join(path, fn)
-        ispkg = False
         try:
-            if not modname and os.path.isdir(path) and '.' not in fn:
-                modname = fn
-                for fn in os.listdir(subpath):
-                    subname = inspect.getmodulename(fn)
-                    if subname=='__init__':
-                        ispkg = True
-                        break
-                else:
-                    continue    # not a package
+            for _, name, ispkg in pkgutil.iter_modules([entry]):
+                yield name, ispkg
         except OSError:
-            continue # silently ignore inaccessible subdirectories
-        if modname and '.' not in modname:
-            yielded[modname] = 1
-            yield prefix + modname, ispkg
+            continue
 
 
 def pyc_to_py(filename):
@@ -113,6 +266,170 @@ def pyc_to_py(filename):
     return filename
 
 
+_listdir_cache = {}
+
+def _cached_listdir(dirname):
+    """
+    Return the entries of directory C{dirname}, as a C{frozenset} of
+    basenames, or C{None} if C{dirname} is not a readable directory.
+
+    Results are cached, and revalidated by the directory's mtime, so that
+    repeated lookups in the same directory cost one C{stat} instead of one
+    C{stat} per candidate filename.
+
+    @type dirname:
+      C{str}
+    @rtype:
+      C{frozenset} of C{str}, or C{None}
+    """
+    try:
+        st = os.stat(dirname)
+    except OSError:
+        return None
+    if not stat.S_ISDIR(st.st_mode):
+        return None
+    try:
+        mtime, names = _listdir_cache[dirname]
+    except KeyError:
+        pass
+    else:
+        if mtime == st.st_mtime:
+            return names
+    try:
+        names = frozenset(os.listdir(dirname))
+    except OSError:
+        names = None
+    _listdir_cache[dirname] = (st.st_mtime, names)
+    return names
+
+
+_ModuleLocation = namedtuple("_ModuleLocation", "filename path")
+"""
+Where a module lives.  C{filename} is the module's file (C{None} for builtin
+modules), and C{path} is the package's C{__path__} (C{None} for non-package
+modules).
+"""
+
+_UNKNOWN = object()
+"""
+Result of L{_find_module_location} meaning that the module can only be found
+by an import hook, so the caller needs to fall back to C{pkgutil}.
+"""
+
+_PACKAGE_INIT_SUFFIXES = (".py", ".pyc", ".pyo")
+
+
+def _find_module_in_directory(dirname, base):
+    """
+    Find module C{base} in directory C{dirname}, using the same precedence as
+    the built-in importer: a package directory first, then modules by suffix.
+
+    @rtype:
+      L{_ModuleLocation} or C{None}
+    """
+    names = _cached_listdir(dirname)
+    if not names:
+        return None
+    if base in names:
+        pkgdir = os.path.join(dirname, base)
+        subnames = _cached_listdir(pkgdir)
+        if subnames:
+            for suffix in _PACKAGE_INIT_SUFFIXES:
+                if "__init__" + suffix in subnames:
+                    return _ModuleLocation(
+                        os.path.join(pkgdir, "__init__" + suffix), [pkgdir])
+    for suffix, _, _ in imp.get_suffixes():
+        if base + suffix in names:
+            return _ModuleLocation(os.path.join(dirname, base + suffix), None)
+    return None
+
+
+def _may_extend_path(init_filename):
+    """
+    Return whether the package C{__init__} file C{init_filename} may modify
+    its C{__path__}, e.g. via C{pkgutil.extend_path} or
+    C{pkg_resources.declare_namespace}.
+    """
+    if not init_filename or not init_filename.endswith(".py"):
+        return True
+    try:
+        with open(init_filename) as f:
+            data = f.read()
+    except IOError:
+        return True
+    return "__path__" in data or "declare_namespace" in data
+
+
+def _find_module_location(fullname):
+    """
+    Find where module C{fullname} lives, without importing it or any of its
+    parent packages.
+
+    Modules are looked up in cached directory listings of C{sys.path} entries
+    and package C{__path__}s.  Parent packages that are already imported
+    contribute their real C{__path__}; other parent packages are located the
+    same way, recursively.
+
+    @type fullname:
+      C{str}
+    @return:
+      A L{_ModuleLocation}; C{None} if the module doesn't exist; or
+      L{_UNKNOWN} if the module is only known to (or the search goes through)
+      an import hook other than the built-in filesystem importer.
+    """
+    module = sys.modules.get(fullname)
+    if module is not None:
+        filename = getattr(module, "__file__", None)
+        return _ModuleLocation(filename and pyc_to_py(filename),
+                               getattr(module, "__path__", None))
+    parent_name, _, base = fullname.rpartition(".")
+    if parent_name:
+        parent = _find_module_location(parent_name)
+        if parent is None or parent is _UNKNOWN:
+            return parent
+        search_path = parent.path
+        if not search_path:
+            return None
+    else:
+        if imp.is_builtin(base) or imp.is_frozen(base):
+            return _ModuleLocation(None, None)
+        search_path = sys.path
+    for entry in search_path:
+        if not isinstance(entry, basestring):
+            continue
+        importer = sys.path_importer_cache.get(entry)
+        if isinstance(importer, imp.NullImporter):
+            # Nothing importable here (e.g. a nonexistent directory).
+            continue
+        if importer is not None:
+            # Custom path hook, e.g. zipimport.
+            return _UNKNOWN
+        dirname = entry or os.getcwd()
+        if _cached_listdir(dirname) is None:
+            if os.path.exists(dirname):
+                # E.g. a zip file not yet seen by the import system.
+                return _UNKNOWN
+            continue
+        location = _find_module_in_directory(dirname, base)
+        if location is not None:
+            return location
+    if (parent_name and parent_name not in sys.modules and
+        _may_extend_path(parent.filename)):
+        # The parent package's __init__ may add directories to its __path__
+        # (namespace packages), which we can only know by importing it.
+        return _UNKNOWN
+    # Not found on the filesystem.  Let meta path finders have a say.
+    for finder in sys.meta_path:
+        try:
+            loader = finder.find_module(
+                fullname, search_path if parent_name else None)
+        except Exception:
+            continue
+        if loader is not None:
+            return _UNKNOWN
+    return None
+
+
 
 class ModuleHandle(object):
     """
@@ -190,15 +507,20 @@ class ModuleHandle(object):
     @cached_attribute
     def exists(self):
         """
-        Return whether the module exists, according to pkgutil.
-        Note that this doesn't work for things that are only known by using
-        sys.meta_path.
+        Return whether the module exists.
+
+        The module and its parent packages are not imported, except when the
+        module can only be found through an import hook, in which case we
+        fall back to pkgutil (which may import parent packages).
         """
         name = str(self.name)
         if name in sys.modules:
             return True
         if self.parent and not self.parent.exists:
             return False
+        location = _find_module_location(name)
+        if location is not _UNKNOWN:
+            return location is not None
         import pkgutil
         try:
             loader = pkgutil.find_loader(name)
@@ -214,16 +536,22 @@ class ModuleHandle(object):
         """
         Return the filename, if appropriate.
 
-        The module itself will not be imported, but if the module is not a
-        top-level module/package, accessing this attribute may cause the
-        parent package to be imported.
+        Neither the module itself nor its parent packages will be imported,
+        unless the module can only be found through an import hook.
 
         @rtype:
           L{Filename}
         """
-        # Use the loader mechanism to find the filename.  We do so instead of
-        # using self.module.__file__, because the latter forces importing a
-        # module, which may be undesirable.
+        # Find the module in directory listings, so that we don't force
+        # importing it (or its parents), which may be undesirable.
+        location = _find_module_location(str(self.name))
+        if location is None:
+            return None
+        if location is not _UNKNOWN:
+            if not location.filename:
+                return None
+            return Filename(pyc_to_py(location.filename))
+        # Use the loader mechanism to find the filename.
         import pkgutil
         try:
             loader = pkgutil.get_loader(str(self.name))
@@ -260,8 +588,7 @@ class ModuleHandle(object):
         @rtype:
           C{tuple} of L{ModuleHandle}s
         """
-        import pkgutil
-        # Get the list of top-level packages/modules using pkgutil.
+        # Get the list of top-level packages/modules using _iter_modules.
         # We exclude "." from sys.path while doing so.  Python includes "." in
         # sys.path by default, but this is undesirable for autoimporting.  If
         # we autoimported random python scripts in the current directory, we
@@ -270,12 +597,11 @@ class ModuleHandle(object):
         # causes problems, because there are typically directories there not
         # readable by the current user.
         with ExcludeImplicitCwdFromPathCtx():
-            modlist = pkgutil.iter_modules(None)
-            module_names = [t[1] for t in modlist]
-        # pkgutil includes all *.py even if the name isn't a legal python
-        # module name, e.g. if a directory in $PYTHONPATH has files named
-        # "try.py" or "123.py", pkgutil will return entries named "try" or
-        # "123".  Filter those out.
+            module_names = [t[0] for t in _iter_modules(sys.path)]
+        # Like pkgutil, _iter_modules includes all *.py even if the name isn't
+        # a legal python module name, e.g. if a directory in $PYTHONPATH has
+        # files named "try.py" or "123.py", it will return entries named
+        # "try" or "123".  Filter those out.
         module_names = [m for m in module_names if is_identifier(m)]
         # Canonicalize.
         return tuple(ModuleHandle(m) for m in sorted(set(module_names)))
@@ -291,19 +617,16 @@ class ModuleHandle(object):
         @rtype:
           C{tuple} of L{ModuleHandle}s
         """
-        import pkgutil
         module = self.module
         try:
             path = module.__path__
         except AttributeError:
             return ()
-        # Enumerate the modules at a given path.  Prefer to use C{pkgutil} if
-        # we can.  However, if it fails due to OSError, use our own version
-        # which is robust to that.
-        try:
-            submodule_names = [t[1] for t in pkgutil.iter_modules(path)]
-        except OSError:
-            submodule_names = [t[0] for p in path for t in _my_iter_modules(p)]
+        # Enumerate the modules at a given path, using cached directory
+        # listings.
+        submodule_names = [t[0] for t in _iter_modules(path)]
+        # As in L{list}, filter out files that aren't legal module names.
+        submodule_names = [m for m in submodule_names if is_identifier(m)]
         return tuple(ModuleHandle("%s.%s" % (self.name,m))
                      for m in sorted(set(submodule_names)))
 
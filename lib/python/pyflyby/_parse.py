@@ -5,8 +5,10 @@
 from __future__ import absolute_import, division, with_statement
 
 import ast
+import bisect
 from   collections              import namedtuple
 from   itertools                import groupby
+import keyword
 import re
 import sys
 from   textwrap                 import dedent
@@ -14,7 +16,12 @@ import types
 
 from   pyflyby._file            import FilePos, FileText, Filename
 from   pyflyby._flags           import CompilerFlags
+from   pyflyby._idents          import brace_identifiers
 from   pyflyby._log             import logger
+from   pyflyby._parsecache      import (load_parse_cache_entry,
+                                        parse_cache_enabled, parse_cache_key,
+                                        save_parse_cache_entry)
+from   pyflyby._report          import report_timing
 from   pyflyby._util            import cached_attribute
 
 
@@ -115,12 +122,207 @@ def _walk_ast_nodes_in_order(node):
         todo.extend(reversed(list(_iter_child_nodes_in_order(node))))
 
 
+def _walk_ast_statements_in_order(node):
+    """
+    Recursively yield C{node} and all statement nodes nested in it, in the same
+    order that they appear in the source.
+
+    This is like L{_walk_ast_nodes_in_order}, but doesn't descend into
+    expressions.
+    """
+    todo = [node]
+    while todo:
+        node = todo.pop()
+        yield node
+        children = []
+        for field in ('body', 'handlers', 'orelse', 'finalbody'):
+            value = getattr(node, field, None)
+            if isinstance(value, list):
+                children.extend(value)
+        todo.extend(reversed(children))
+
+
+def _scan_string_literals(module_node):
+    """
+    Find all string literals and docstrings in C{module_node} in a single
+    traversal, without needing position annotations.
+
+    Statements are visited in source order, as by
+    L{_walk_ast_statements_in_order}.  The expressions within each statement
+    are visited in an arbitrary order, which is cheaper than
+    L{_walk_ast_nodes_in_order}; callers can sort the string literals by
+    position once they are annotated.
+
+    @type module_node:
+      C{ast.Module}
+    @return:
+      C{(str_nodes, docstring_nodes, brace_idents)}.  C{str_nodes} and
+      C{docstring_nodes} are C{list}s of C{(toplevel_node, str_node)} pairs;
+      C{toplevel_node} is the statement in C{module_node.body} to annotate for
+      C{str_node}'s position.  C{docstring_nodes} is in the order described in
+      L{PythonBlock._get_docstring_nodes}.  C{brace_idents} is a C{frozenset}
+      of the L{brace_identifiers} in any string literal.
+    """
+    AST = ast.AST
+    Str = ast.Str
+    Expr = ast.Expr
+    Assign = ast.Assign
+    docstring_containers = (ast.FunctionDef, ast.ClassDef, ast.Module)
+    statement_fields = ('body', 'handlers', 'orelse', 'finalbody')
+    str_nodes = []
+    docstring_nodes = []
+    brace_idents = set()
+    def add_docstrings(toplevel_node, node):
+        body = node.body
+        if not body:
+            return
+        # If the first body item is a literal string, then it's a docstring.
+        n1 = body[0]
+        if isinstance(n1, Expr) and isinstance(n1.value, Str):
+            docstring_nodes.append((toplevel_node or n1, n1.value))
+        for i in xrange(1, len(body)-1):
+            # If a body item is an assignment and the next one is a literal
+            # string, then the literal string is a docstring.
+            n1, n2 = body[i], body[i+1]
+            if (isinstance(n1, Assign) and
+                isinstance(n2, Expr) and isinstance(n2.value, Str)):
+                docstring_nodes.append((toplevel_node or n2, n2.value))
+    add_docstrings(None, module_node)
+    for toplevel_node in module_node.body:
+        statements = [toplevel_node]
+        while statements:
+            node = statements.pop()
+            if isinstance(node, docstring_containers):
+                add_docstrings(toplevel_node, node)
+            children = []
+            expressions = []
+            for field in node._fields:
+                value = getattr(node, field, None)
+                if isinstance(value, list):
+                    if field in statement_fields:
+                        children.extend(value)
+                    else:
+                        expressions.extend(value)
+                elif isinstance(value, AST):
+                    expressions.append(value)
+            statements.extend(reversed(children))
+            while expressions:
+                expr = expressions.pop()
+                if isinstance(expr, Str):
+                    str_nodes.append((toplevel_node, expr))
+                    if '{' in expr.s:
+                        brace_idents.update(brace_identifiers(expr.s))
+                    continue
+                if not isinstance(expr, AST):
+                    # e.g. the names of a C{Global} statement.
+                    continue
+                for field in expr._fields:
+                    value = getattr(expr, field, None)
+                    if isinstance(value, list):
+                        expressions.extend(value)
+                    elif isinstance(value, AST):
+                        expressions.append(value)
+    return str_nodes, docstring_nodes, frozenset(brace_idents)
+
+
+# Lexical elements that L{_prescan_print_usage} needs to see: the
+# "print_function" future import, "print" itself, and string literals and
+# comments (only to skip over them).  Every alternative starts with a literal
+# character, which lets the regexp engine skip quickly to candidates.
+_PRINT_PRESCAN_RE = re.compile(r"""
+    from[ \t]+__future__[ \t]+import\b(?:[ \t]*\([^)]*\)|[^\n;\#]*)
+  | print\b
+  | '''[^'\\]*(?:(?:\\.|'(?!''))[^'\\]*)*'''
+  | \"\"\"[^"\\]*(?:(?:\\.|"(?!""))[^"\\]*)*\"\"\"
+  | '[^'\\\n]*(?:\\.[^'\\\n]*)*'
+  | "[^"\\\n]*(?:\\.[^"\\\n]*)*"
+  | \#[^\n]*
+""", re.S | re.X)
+
+# What follows "print".  A name, number or string means it's a print
+# statement.
+_PRINT_FOLLOWER_RE = re.compile(
+    r"[ \t]*(?:(?P<name>[A-Za-z_]\w*)|(?P<literal>\d|[uUbBrR]{0,2}['\"]))")
+
+# A print() call that uses star-args or keyword arguments.
+_PRINT_FUNCTION_CALL_RE = re.compile(r"""
+    print[ \t]*\(
+    (?: \s*\*
+      | (?: [^()'"\#] | \([^()]*\)
+          | '(?:[^'\\\n]|\\.)*' | "(?:[^"\\\n]|\\.)*" )*?
+        ,\s*(?:sep|end|file)\s*=(?!=) )
+""", re.S | re.X)
+
+
+def _prescan_print_usage(source):
+    r"""
+    Cheaply determine, without parsing, whether C{source} requires the
+    print_function feature.
+
+      >>> _prescan_print_usage("print 'hello'\n")
+      'statement'
+      >>> _prescan_print_usage("x = 1; print(x, file=sys.stderr)\n")
+      'function'
+      >>> _prescan_print_usage("f = print\n")
+      'function'
+      >>> _prescan_print_usage("from __future__ import print_function\n")
+      'future'
+      >>> print _prescan_print_usage("print(x) # print y\n'''\nprint z\n'''\n")
+      None
+
+    Only unambiguous evidence counts: a print statement such as C{print x}
+    can't be parsed with print_function, and C{print(x, file=f)} or any use
+    of C{print} other than at the start of a statement can't be parsed
+    without it.
+
+    @type source:
+      C{str}
+    @return:
+      C{"future"} if the code has a C{from __future__ import print_function};
+      C{"statement"} if it uses print as a statement; C{"function"} if it
+      uses print as a function; C{None} if we can't tell.
+    """
+    for m in _PRINT_PRESCAN_RE.finditer(source):
+        start = m.start()
+        kind = source[start]
+        if kind not in "fp":
+            # String literal or comment.
+            continue
+        prev = source[start-1:start]
+        if kind == "f":
+            if prev in ("", "\n") and re.search(r"\bprint_function\b",
+                                                m.group()):
+                return "future"
+        elif not (prev.isalnum() or prev == "_"):
+            follower = _PRINT_FOLLOWER_RE.match(source, m.end())
+            if follower:
+                name = follower.group("name")
+                if not (name and keyword.iskeyword(name)):
+                    return "statement"
+            call = _PRINT_FUNCTION_CALL_RE.match(source, start)
+            if call and "lambda" not in call.group():
+                return "function"
+            linestart = source.rfind("\n", 0, start) + 1
+            before = source[linestart:start].rstrip()
+            if not before:
+                # At the start of a line, so probably the start of a
+                # statement (unless the previous line ends with a backslash).
+                continue
+            if before.endswith(";") or before.endswith(":"):
+                # Start of a statement, or e.g. a dict value.
+                continue
+            return "function"
+    return None
+
+
 def _flags_to_try(source, flags, auto_flags, mode):
     """
     Flags to try for C{auto_flags}.
 
     If C{auto_flags} is False, then only yield C{flags}.
-    If C{auto_flags} is True, then yield C{flags} and C{flags ^ print_function}.
+    If C{auto_flags} is True, then yield C{flags} and C{flags ^ print_function},
+    in the order suggested by L{_prescan_print_usage}, so that usually only
+    the first one needs to be tried.
     """
     flags = CompilerFlags(flags)
     if not auto_flags:
@@ -134,9 +336,27 @@ def _flags_to_try(source, flags, auto_flags, mode):
             flags = flags | CompilerFlags("print_function")
         yield flags
         return
+    if not re.search(r"\bprint\b", source):
+        yield flags
+        return
+    print_function = CompilerFlags("print_function")
+    usage = _prescan_print_usage(source)
+    if usage == "future":
+        # Toggling the input flags wouldn't make any difference.
+        yield flags
+        return
+    if usage == "statement":
+        flags = (flags | print_function) ^ print_function
+    elif usage == "function":
+        flags = flags | print_function
     yield flags
-    if re.search(r"\bprint\b", source):
-        yield flags ^ CompilerFlags("print_function")
+    yield flags ^ print_function
+
+
+# Number of times L{_parse_ast_nodes} had to compile a second time with
+# different flags, i.e. the prescan in L{_flags_to_try} was inconclusive (or
+# the code doesn't parse at all).
+auto_flags_fallback_count = 0
 
 
 def _parse_ast_nodes(text, flags, auto_flags, mode):
@@ -169,7 +389,11 @@ def _parse_ast_nodes(text, flags, auto_flags, mode):
         # Ensure that the last line ends with a newline (C{ast} barfs
         # otherwise).
         source += "\n"
-    for flags in _flags_to_try(source, flags, auto_flags, mode):
+    global auto_flags_fallback_count
+    for i, flags in enumerate(_flags_to_try(source, flags, auto_flags, mode)):
+        if i:
+            auto_flags_fallback_count += 1
+            logger.debug("%s: retrying parse with flags=%s", filename, flags)
         cflags = ast.PyCF_ONLY_AST | int(flags)
         try:
             result = compile(
@@ -205,15 +429,88 @@ def _test_parse_string_literal(text, flags):
     return body.s
 
 
+def _find_string_positions(text):
+    """
+    Find the positions of all multiline string literals in C{text}, using a
+    single C{tokenize} pass.
+
+    Adjacent string tokens (which the compiler concatenates into a single
+    C{ast.Str}) are combined.  The result is keyed by the line number on which
+    the I{first} token of each literal ends, relative to the start of C{text},
+    because that is what the compiler uses as C{lineno} for multiline strings.
+    Only literals whose first token spans multiple lines are included, since
+    those are the only ones whose position the compiler doesn't report.
+
+      >>> _find_string_positions(FileText("x = 1\\ny = '''a\\nb''' 'c'\\n"))
+      {3: [(FilePos(2,5), FilePos(3,9))]}
+
+    @type text:
+      L{FileText}
+    @rtype:
+      C{dict} from C{int} to C{list} of C{(FilePos, FilePos)}
+    @return:
+      Map from line number to C{(startpos, endpos)} tuples, in order; or
+      C{None} if C{text} can't be tokenized.
+    """
+    import tokenize
+    startpos = text.startpos
+    result = {}
+    run = None # [first_token_end_row, startpos, endpos] of current literal
+    readline = iter(text.joined.splitlines(True)).next
+    try:
+        for toktype, _, (srow, scol), (erow, ecol), _ in (
+                tokenize.generate_tokens(readline)):
+            if toktype == tokenize.STRING:
+                endpos = startpos + (erow-1, ecol)
+                if run is None:
+                    key = erow if erow != srow else None
+                    run = [key, startpos + (srow-1, scol), endpos]
+                else:
+                    run[2] = endpos
+            elif toktype in (tokenize.NL, tokenize.COMMENT):
+                # Adjacent strings can be separated by newlines and comments
+                # within brackets.
+                pass
+            elif run is not None:
+                if run[0] is not None:
+                    result.setdefault(run[0], []).append((run[1], run[2]))
+                run = None
+    except (tokenize.TokenError, IndentationError):
+        return None
+    if run is not None and run[0] is not None:
+        result.setdefault(run[0], []).append((run[1], run[2]))
+    return result
+
+
 AstNodeContext = namedtuple("AstNodeContext", "parent field index")
 
 
+class _LazyStringPositions(object):
+    """
+    The result of L{_find_string_positions}, computed on first use.
+    """
+
+    def __init__(self, text):
+        self.text = text
+
+    @cached_attribute
+    def _positions(self):
+        return _find_string_positions(self.text) or {}
+
+    def get(self, lineno, default=None):
+        return self._positions.get(lineno, default)
+
+
 def _annotate_ast_nodes(ast_node):
     """
     Annotate AST with:
       - startpos and endpos
       - [disabled for now: context as L{AstNodeContext}]
 
+    Only the top-level nodes are annotated right away, since that's all that
+    is needed to split code into statements.  The descendants of each
+    top-level node are annotated on demand by L{_annotate_ast_subtree}.
+
     @type ast_node:
       C{ast.AST}
     @param ast_node:
@@ -223,25 +520,171 @@ def _annotate_ast_nodes(ast_node):
     """
     text = ast_node.text
     flags = ast_node.flags
-    startpos = text.startpos
-    _annotate_ast_startpos(ast_node, None, startpos, text, flags)
+    string_positions = _LazyStringPositions(text)
+    minpos = text.startpos
+    for child_node in ast_node.body:
+        if child_node.col_offset >= 0:
+            _annotate_ast_node_startpos(child_node, ast_node, minpos, None,
+                                        text, flags, string_positions)
+            child_node._pending_annotation = (
+                minpos, text, flags, string_positions)
+        else:
+            # The leftmost leaf is a multiline string, so we need to look at
+            # the descendants anyway to find the start position.
+            _annotate_ast_startpos(child_node, ast_node, minpos, text, flags,
+                                   string_positions)
+        _check_ast_child_order(ast_node, child_node, minpos)
+        minpos = child_node.startpos
     # Not used for now:
     #   ast_node.context = AstNodeContext(None, None, None)
     #   _annotate_ast_context(ast_node)
 
 
-def _annotate_ast_startpos(ast_node, parent_ast_node, minpos, text, flags):
+def _annotate_ast_subtree(ast_node):
+    """
+    Annotate the descendants of a top-level node that was annotated by
+    L{_annotate_ast_nodes}, if that hasn't been done yet.
+
+    @type ast_node:
+      C{ast.AST}
+    @return:
+      C{None}
+    """
+    try:
+        minpos, text, flags, string_positions = ast_node._pending_annotation
+    except AttributeError:
+        return
+    _annotate_ast_startpos(ast_node, None, minpos, text, flags,
+                           string_positions)
+    del ast_node._pending_annotation
+
+
+def _annotate_ast_str_startpos(str_node, toplevel_node):
+    """
+    Make sure that C{str_node}, a string literal within C{toplevel_node}, is
+    annotated with C{startpos}.
+
+    The position of a single-line string is given directly by its C{lineno}
+    and C{col_offset}, so we avoid annotating the rest of C{toplevel_node}.
+
+    @type str_node:
+      C{ast.Str}
+    @type toplevel_node:
+      C{ast.AST}
+    @return:
+      C{None}
+    """
+    if hasattr(str_node, 'startpos'):
+        return
+    pending = getattr(toplevel_node, '_pending_annotation', None)
+    if pending is not None and str_node.col_offset >= 0:
+        minpos, text, flags, string_positions = pending
+        _annotate_ast_node_startpos(str_node, None, minpos, None,
+                                    text, flags, string_positions)
+    else:
+        _annotate_ast_subtree(toplevel_node)
+
+
+def _annotate_ast_startpos(ast_node, parent_ast_node, minpos, text, flags,
+                           string_positions=None):
+    """
+    Annotate C{ast_node} and all its descendants with C{startpos}, as
+    described in L{_annotate_ast_node_startpos}.
+
+    The nodes are visited iteratively rather than recursively, so that deeply
+    nested code doesn't hit the recursion limit.
+
+    @return:
+      C{True} if this node is a multiline string literal or the first child is
+      such a node (recursively); C{False} otherwise.
+    """
+    # Each entry on the stack is a generator from L{_annotate_ast_startpos_1}.
+    # It yields a tuple to request annotating a child node, to which we reply
+    # with the child's result; and finally yields its own (C{bool}) result.
+    stack = [_annotate_ast_startpos_1(
+        ast_node, parent_ast_node, minpos, text, flags, string_positions)]
+    result = None
+    while stack:
+        request = stack[-1].send(result)
+        if isinstance(request, tuple):
+            child_node, parent_node, child_minpos = request
+            stack.append(_annotate_ast_startpos_1(
+                child_node, parent_node, child_minpos,
+                text, flags, string_positions))
+            result = None
+        else:
+            stack.pop().close()
+            result = request
+    return result
+
+
+def _annotate_ast_startpos_1(ast_node, parent_ast_node, minpos, text, flags,
+                             string_positions):
+    # Helper for L{_annotate_ast_startpos}; see there.
+    # First, traverse child nodes.  If the first child node (recursively) is a
+    # multiline string, then we need to transfer its information to this node.
+    # Walk all nodes/fields of the AST.  We implement this as a custom
+    # depth-first search instead of using ast.walk() or ast.NodeVisitor
+    # so that we can easily keep track of the preceding node's lineno.
+    child_minpos = minpos
+    is_first_child = True
+    leftstr_node = None
+    for child_node in _iter_child_nodes_in_order(ast_node):
+        leftstr = yield (child_node, ast_node, child_minpos)
+        if is_first_child and leftstr:
+            leftstr_node = child_node
+        if hasattr(child_node, 'lineno'):
+            _check_ast_child_order(ast_node, child_node, child_minpos)
+            child_minpos = child_node.startpos
+        is_first_child = False
+    yield _annotate_ast_node_startpos(ast_node, parent_ast_node, minpos,
+                                      leftstr_node, text, flags,
+                                      string_positions)
+
+
+def _check_ast_child_order(ast_node, child_node, child_minpos):
     """
-    Annotate C{ast_node}.  Set C{ast_node.startpos} to the starting position
-    of the node within C{text}.
+    Check that C{child_node}, a child of C{ast_node}, doesn't start before
+    C{child_minpos}.
+
+    @raise AssertionError:
+      The node is out of order.
+    """
+    if child_node.startpos < child_minpos:
+        raise AssertionError(
+            "Got out-of-order AST node(s):\n"
+            "  child minpos=%s\n" % child_minpos +
+            "    node: %s\n" % ast.dump(ast_node) +
+            "      fields: %s\n" % (" ".join(ast_node._fields)) +
+            "      children:\n" +
+            ''.join(
+                "        %s %9s: %s\n" % (
+                    ("==>" if cn is child_node else "   "),
+                    getattr(cn, 'startpos', ""),
+                    ast.dump(cn))
+                for cn in _iter_child_nodes_in_order(ast_node)) +
+            "\n"
+            "This indicates a bug in pyflyby._\n"
+            "\n"
+            "pyflyby developer: Check if there's a bug or missing ast node handler in "
+            "pyflyby._parse._iter_child_nodes_in_order() - "
+            "probably the handler for ast.%s." % type(ast_node).__name__)
+
+
+def _annotate_ast_node_startpos(ast_node, parent_ast_node, minpos, leftstr_node,
+                                text, flags, string_positions=None):
+    """
+    Annotate C{ast_node}, whose children have already been annotated.  Set
+    C{ast_node.startpos} to the starting position of the node within C{text}.
 
     For "typical" nodes, i.e. those other than multiline strings, this is
     simply FilePos(ast_node.lineno, ast_node.col_offset+1), but taking
     C{text.startpos} into account.
 
-    For multiline string nodes, this function works by trying to parse all
-    possible subranges of lines until finding the range that is syntactically
-    valid and matches C{value}.  The candidate range is
+    For multiline string nodes, this function looks up the position found by
+    the tokenizer in C{string_positions}.  If that fails, it falls back to
+    trying to parse all possible subranges of lines until finding the range
+    that is syntactically valid and matches C{value}.  The candidate range is
     text[min_start_lineno:lineno+text.startpos.lineno+1].
 
     This function is unfortunately necessary because of a flaw in the output
@@ -262,6 +705,12 @@ def _annotate_ast_startpos(ast_node, parent_ast_node, minpos, text, flags):
       L{FilePos}
     @param minpos:
       Earliest position to check, in the number space of C{text}.
+    @type leftstr_node:
+      C{ast.AST}
+    @param leftstr_node:
+      The first child of C{ast_node}, if that child is a multiline string
+      literal or its own first child is such a node (recursively); else
+      C{None}.
     @type text:
       L{FileText}
     @param text:
@@ -272,47 +721,17 @@ def _annotate_ast_startpos(ast_node, parent_ast_node, minpos, text, flags):
       C{CompilerFlags}
     @param flags:
       Compiler flags to use when re-compiling code.
+    @type string_positions:
+      L{_LazyStringPositions}
+    @param string_positions:
+      Positions of multiline string literals in C{text}, or C{None} to always
+      search.
     @return:
       C{True} if this node is a multiline string literal or the first child is
       such a node (recursively); C{False} otherwise.
     @raise ValueError:
       Could not find the starting line number.
     """
-    # First, traverse child nodes.  If the first child node (recursively) is a
-    # multiline string, then we need to transfer its information to this node.
-    # Walk all nodes/fields of the AST.  We implement this as a custom
-    # depth-first search instead of using ast.walk() or ast.NodeVisitor
-    # so that we can easily keep track of the preceding node's lineno.
-    child_minpos = minpos
-    is_first_child = True
-    leftstr_node = None
-    for child_node in _iter_child_nodes_in_order(ast_node):
-        leftstr = _annotate_ast_startpos(child_node, ast_node,
-                                         child_minpos, text, flags)
-        if is_first_child and leftstr:
-            leftstr_node = child_node
-        if hasattr(child_node, 'lineno'):
-            if child_node.startpos < child_minpos:
-                raise AssertionError(
-                    "Got out-of-order AST node(s):\n"
-                    "  parent minpos=%s\n" % minpos +
-                    "    node: %s\n" % ast.dump(ast_node) +
-                    "      fields: %s\n" % (" ".join(ast_node._fields)) +
-                    "      children:\n" +
-                    ''.join(
-                        "        %s %9s: %s\n" % (
-                            ("==>" if cn is child_node else "   "),
-                            getattr(cn, 'startpos', ""),
-                            ast.dump(cn))
-                        for cn in _iter_child_nodes_in_order(ast_node)) +
-                    "\n"
-                    "This indicates a bug in pyflyby._\n"
-                    "\n"
-                    "pyflyby developer: Check if there's a bug or missing ast node handler in "
-                    "pyflyby._parse._iter_child_nodes_in_order() - "
-                    "probably the handler for ast.%s." % type(ast_node).__name__)
-            child_minpos = child_node.startpos
-        is_first_child = False
     # If the node has no lineno at all, then skip it.  This should only happen
     # for nodes we don't care about, e.g. C{ast.Module} or C{ast.alias}.
     if not hasattr(ast_node, 'lineno'):
@@ -384,6 +803,22 @@ def _annotate_ast_startpos(ast_node, parent_ast_node, minpos, text, flags):
     if not isinstance(ast_node, ast.Str):
         raise ValueError(
             "got a non-string col_offset=-1: %s" % (ast.dump(ast_node)))
+    target_str = ast_node.s
+    # Usually the tokenizer already found the string.  Verify that candidate
+    # by re-parsing just its range.
+    if string_positions is not None:
+        for startpos, endpos in string_positions.get(ast_node.lineno, ()):
+            if startpos < minpos:
+                continue
+            subtext = text[startpos:endpos]
+            if _test_parse_string_literal(subtext, flags) == target_str:
+                ast_node.startpos = startpos
+                ast_node.endpos   = endpos
+                return True
+            break
+        logger.debug("Couldn't use tokenized position of multiline string "
+                     "ending at line %d; searching",
+                     text.startpos.lineno + ast_node.lineno - 1)
     # The C{lineno} attribute gives the ending line number of the multiline
     # string ... unless it's multiple multiline strings that are concatenated
     # by adjacency, in which case it's merely the end of the first one of
@@ -402,7 +837,6 @@ def _annotate_ast_startpos(ast_node, parent_ast_node, minpos, text, flags):
         startpos_candidates.extend([
             (m.group()[-1], FilePos(start_lineno, m.start()+start_line_colno))
             for m in re.finditer("[bBrRuU]*[\"\']", start_line)])
-    target_str = ast_node.s
     # Loop over possible end_linenos.  The first one we've identified is the
     # by far most likely one, but in theory it could be anywhere later in the
     # file.  This could be because of a dastardly concatenated string like
@@ -635,6 +1069,29 @@ def _ast_node_is_in_docstring_position(ast_node):
     return False
 
 
+def _str_nodes_from_cache_entry(items):
+    """
+    Construct C{ast.Str} nodes, annotated with C{startpos}, from the
+    C{(s, lineno, colno)} tuples of a L{_parsecache} entry.
+
+    @rtype:
+      C{list} of C{ast.Str}
+    """
+    result = []
+    for s, lineno, colno in items:
+        node = ast.Str(s=s)
+        node.startpos = FilePos(lineno, colno)
+        result.append(node)
+    return result
+
+
+def _warn_unparsable_doctest(text):
+    blob = text.joined
+    if len(blob) > 60:
+        blob = blob[:60] + '...'
+    logger.warning("Can't parse doctest; ignoring: %r", blob)
+
+
 def infer_compile_mode(arg):
     """
     Infer the mode needed to compile C{arg}.
@@ -674,6 +1131,10 @@ class PythonStatement(object):
     top-level AST node.
     """
 
+    # The kind of statement (one of L{_parsecache.STATEMENT_KINDS}), if known
+    # without parsing, i.e. if this statement came from the parse cache.
+    _kind = None
+
     def __new__(cls, arg, filename=None, startpos=None, flags=None):
         if isinstance(arg, cls):
             if filename is startpos is flags is None:
@@ -751,17 +1212,35 @@ class PythonStatement(object):
 
     @property
     def is_comment_or_blank(self):
+        if self._kind is not None:
+            return self._kind == "blank"
         return self.ast_node is None
 
     @property
     def is_comment_or_blank_or_string_literal(self):
+        if self._kind is not None:
+            return self._kind in ("blank", "string")
         return (self.is_comment_or_blank
                 or _ast_str_literal_value(self.ast_node) is not None)
 
     @property
     def is_import(self):
+        if self._kind is not None:
+            return self._kind == "import"
         return isinstance(self.ast_node, (ast.Import, ast.ImportFrom))
 
+    @property
+    def _statement_kind(self):
+        # The kind of this statement, for L{_parsecache}.
+        if self.is_comment_or_blank:
+            return "blank"
+        elif self.is_import:
+            return "import"
+        elif self.is_comment_or_blank_or_string_literal:
+            return "string"
+        else:
+            return "code"
+
     @property
     def is_single_assign(self):
         n = self.ast_node
@@ -906,6 +1385,18 @@ class PythonBlock(object):
         self.text                         = text
         self.flags                        = self._input_flags = flags
         self._auto_flags                  = False
+        self._parse_cache_entry           = None
+        return self
+
+    @classmethod
+    def __construct_from_cached_statement(cls, text, flags):
+        # Constructor for internal use by statements(), when the statement
+        # boundaries come from the parse cache.  The AST is parsed lazily.
+        self = object.__new__(cls)
+        self.text                         = text
+        self.flags                        = self._input_flags = flags
+        self._auto_flags                  = False
+        self._parse_cache_entry           = None
         return self
 
     @classmethod
@@ -927,6 +1418,11 @@ class PythonBlock(object):
             return blocks[0]
         assert blocks
         text = FileText.concatenate([b.text for b in blocks])
+        if not all('ast_node' in b.__dict__ for b in blocks):
+            # Some blocks haven't been parsed (e.g. statements from the parse
+            # cache).  Don't parse them individually; the concatenation will
+            # be parsed lazily if needed.
+            return cls.__construct_from_cached_statement(text, blocks[0].flags)
         # The contiguous assumption is important here because C{ast_node}
         # contains line information that would otherwise be wrong.
         ast_nodes = [n for b in blocks for n in b.annotated_ast_node.body]
@@ -957,8 +1453,9 @@ class PythonBlock(object):
         # This attribute may also be set by __construct_from_annotated_ast(),
         # in which case this code does not run.
         try:
-            return _parse_ast_nodes(
-                self.text, self._input_flags, self._auto_flags, "exec")
+            with report_timing("parse"):
+                return _parse_ast_nodes(
+                    self.text, self._input_flags, self._auto_flags, "exec")
         except Exception as e:
             # Add the filename to the exception message to be nicer.
             if self.text.filename:
@@ -1014,8 +1511,8 @@ class PythonBlock(object):
         """
         Return C{self.ast_node}, annotated in place with positions.
 
-        All nodes are annotated with C{startpos}.
-        All top-level nodes are annotated with C{endpos}.
+        All top-level nodes are annotated with C{startpos}.  Their descendants
+        are annotated on demand by L{_annotate_ast_subtree}.
 
         @rtype:
           C{ast.Module}
@@ -1098,6 +1595,17 @@ class PythonBlock(object):
         @rtype:
           C{tuple} of L{PythonStatement}s
         """
+        entry = self._parse_cache_entry
+        if entry is not None and "statements" in entry:
+            return self._statements_from_cache_entry(entry)
+        statements = self._statements_from_ast
+        self._add_to_parse_cache_entry("statements", tuple(
+            (s.startpos.lineno, s.startpos.colno, s._statement_kind)
+            for s in statements))
+        return statements
+
+    @cached_attribute
+    def _statements_from_ast(self):
         node = self.annotated_ast_node
         nodes_subtexts = list(_split_code_lines(node.body, self.text))
         if nodes_subtexts == [(self.ast_node.body, self.text)]:
@@ -1119,6 +1627,78 @@ class PythonBlock(object):
             b.statements = (statement,)
         return tuple(statements)
 
+    def _statements_from_cache_entry(self, entry):
+        text = self.text
+        flags = self.flags
+        startposes = [FilePos(lineno, colno)
+                      for lineno, colno, _ in entry["statements"]]
+        endposes = startposes[1:] + [text.endpos]
+        if len(startposes) == 1:
+            statement = PythonStatement._construct_from_block(self)
+            statement._kind = entry["statements"][0][2]
+            return (statement,)
+        cls = type(self)
+        statements = []
+        for (_, _, kind), startpos, endpos in zip(
+                entry["statements"], startposes, endposes):
+            b = cls.__construct_from_cached_statement(
+                text[startpos:endpos], flags)
+            statement = PythonStatement._construct_from_block(b)
+            statement._kind = kind
+            statements.append(statement)
+            b.statements = (statement,)
+        return tuple(statements)
+
+    @cached_attribute
+    def _parse_cache_key(self):
+        """
+        The L{_parsecache} key for this block, or C{None} if the parse cache
+        is disabled.  Only whole files are cached.
+
+        @rtype:
+          C{str} or C{None}
+        """
+        if (self.text.filename is None or self.startpos != FilePos() or
+            not parse_cache_enabled()):
+            return None
+        return parse_cache_key(self.text.joined, self._input_flags,
+                               self._auto_flags)
+
+    @cached_attribute
+    def _parse_cache_entry(self):
+        """
+        The L{_parsecache} entry for this block, or C{None} if the parse cache
+        is disabled.
+
+        On a cache miss, this is an empty entry.  Each parse product is only
+        added to it, and saved for the next process, once it has been
+        computed from the AST because it was needed.  That way a cold cache
+        doesn't make us annotate positions that nothing uses.
+
+        @rtype:
+          C{dict} or C{None}
+        """
+        key = self._parse_cache_key
+        if key is None:
+            return None
+        entry = load_parse_cache_entry(key)
+        if entry is None:
+            entry = {}
+        return entry
+
+    def _add_to_parse_cache_entry(self, name, value):
+        """
+        Add the parse product C{name}, computed from the AST, to the parse
+        cache entry, and save the entry.
+        """
+        entry = self._parse_cache_entry
+        if entry is None or name in entry:
+            return
+        entry[name] = value
+        entry["flags"] = int(self.ast_node.flags)
+        entry["source_flags"] = int(self.ast_node.source_flags)
+        save_parse_cache_entry(self._parse_cache_key, entry)
+
     @cached_attribute
     def source_flags(self):
         """
@@ -1133,6 +1713,9 @@ class PythonBlock(object):
         @rtype:
           L{CompilerFlags}
         """
+        entry = self._parse_cache_entry
+        if entry is not None and "source_flags" in entry:
+            return CompilerFlags(entry["source_flags"])
         return self.ast_node.source_flags
 
     @cached_attribute
@@ -1145,6 +1728,9 @@ class PythonBlock(object):
         @rtype:
           L{CompilerFlags}
         """
+        entry = self._parse_cache_entry
+        if entry is not None and "flags" in entry:
+            return CompilerFlags(entry["flags"])
         return self.ast_node.flags
 
     @cached_attribute
@@ -1163,6 +1749,84 @@ class PythonBlock(object):
             joined += "\n"
         return compiler.parse(joined)
 
+    def split_header(self):
+        r"""
+        Split off the header of this block: the leading imports, comments,
+        blank lines and string literals (e.g. the module docstring).
+
+        Only the header is parsed.  The rest of the code is returned as a
+        L{PythonBlock} that hasn't been parsed yet.
+
+          >>> header, rest = PythonBlock(
+          ...     "'''doc'''\nimport os\n\nx = os.sep\n").split_header()
+          >>> header
+          PythonBlock("'''doc'''\nimport os\n\n")
+          >>> rest
+          PythonBlock('x = os.sep\n', startpos=(4,1))
+
+        @rtype:
+          C{tuple} of two L{PythonBlock}s, or C{None}
+        @return:
+          C{(header, rest)}, or C{None} if the header can't be determined
+          cheaply, or if the rest of the code may contain top-level import
+          statements.
+        """
+        text = self.text
+        if text.startpos.colno != 1:
+            return None
+        # Find the first line that starts a statement at column 0 that isn't
+        # an import or a string literal.  Lines inside triple-quoted strings
+        # (e.g. a long module docstring) are skipped: a line is inside one if
+        # an odd number of the string's quotes precede it.  A line starting
+        # with a closing bracket, e.g. the ")" ending a wrapped
+        # "from m import (", never starts a statement.
+        # A candidate could still be inside a bracket or a string that this
+        # doesn't notice (escaped quotes), in which case the text before it
+        # won't parse.  Each failed candidate costs a parse of the header, so
+        # give up after a few; that only loses the fast path, for code that
+        # is laid out unusually.
+        candidates = 0
+        string_quote = None
+        for lineno in xrange(text.startpos.lineno, text.endpos.lineno + 1):
+            line = text[lineno]
+            if string_quote is not None:
+                if line.count(string_quote) % 2:
+                    string_quote = None
+                continue
+            if not line or line[0] in " \t#\\)]}":
+                continue
+            m = re.match(r"(import|from)\b|[bBrRuU]*('''|\"\"\"|['\"])", line)
+            if m:
+                quote = m.group(2)
+                if quote and len(quote) == 3 and line.count(quote) % 2:
+                    string_quote = quote
+                continue
+            if (lineno > text.startpos.lineno and
+                text[lineno-1].endswith("\\")):
+                continue # continuation line
+            candidates += 1
+            if candidates > 20:
+                return None
+            endpos = FilePos(lineno, 1)
+            header = PythonBlock(text[text.startpos:endpos],
+                                 flags=self._input_flags,
+                                 auto_flags=self._auto_flags)
+            if not header.parsable:
+                continue
+            if not all(s.is_import or s.is_comment_or_blank_or_string_literal
+                       for s in header.statements):
+                return None
+            rest_text = text[endpos:text.endpos]
+            # Top-level imports in the rest would not be found.  Be
+            # conservative: any unindented "import" counts, even in strings.
+            if rest_text.has_match(
+                    r"^(?:import|from)\b|;[ \t]*(?:import|from)\b", re.M):
+                return None
+            rest = PythonBlock(rest_text, flags=header.flags,
+                               auto_flags=self._auto_flags)
+            return header, rest
+        return None
+
     def groupby(self, predicate):
         """
         Partition this block of code into smaller blocks of code which
@@ -1191,10 +1855,49 @@ class PythonBlock(object):
         @return:
           Iterable of C{ast.Str} nodes
         """
-        for node in _walk_ast_nodes_in_order(self.annotated_ast_node):
-            if isinstance(node, ast.Str):
-                assert hasattr(node, 'startpos')
-                yield node
+        entry = self._parse_cache_entry
+        if entry is not None and "string_literals" in entry:
+            return _str_nodes_from_cache_entry(entry["string_literals"])
+        result = self._string_literals_from_ast()
+        self._add_to_parse_cache_entry("string_literals", tuple(
+            (n.s, n.startpos.lineno, n.startpos.colno) for n in result))
+        return result
+
+    def _string_literals_from_ast(self):
+        str_nodes, _, _ = self._string_literal_scan
+        for toplevel_node, node in str_nodes:
+            _annotate_ast_str_startpos(node, toplevel_node)
+        return sorted((node for _, node in str_nodes),
+                      key=lambda node: node.startpos)
+
+    @cached_attribute
+    def _string_literal_scan(self):
+        """
+        The string literals, docstrings, and brace identifiers of this block,
+        found in one traversal of the AST.  See L{_scan_string_literals}.
+        """
+        return _scan_string_literals(self.annotated_ast_node)
+
+    @cached_attribute
+    def literal_brace_identifiers(self):
+        """
+        The identifiers in braces, such as C{"L{foo}"} or C{"{foo}".format},
+        in any string literal in this block.
+
+          >>> block = PythonBlock("x = 'L{foo}'\ny = '{bar} {0}'.format(3)\n")
+          >>> sorted(block.literal_brace_identifiers)
+          ['bar', 'foo']
+
+        @rtype:
+          C{frozenset} of C{str}
+        """
+        entry = self._parse_cache_entry
+        if entry is not None and "string_literals" in entry:
+            return frozenset(
+                iden
+                for s, _, _ in entry["string_literals"]
+                for iden in brace_identifiers(s))
+        return self._string_literal_scan[2]
 
     def _get_docstring_nodes(self):
         """
@@ -1206,8 +1909,17 @@ class PythonBlock(object):
           - Literal strings after assignments, per Epydoc
 
         @rtype:
-          Generator of C{ast.Str} nodes
+          Iterable of C{ast.Str} nodes
         """
+        entry = self._parse_cache_entry
+        if entry is not None and "docstrings" in entry:
+            return _str_nodes_from_cache_entry(entry["docstrings"])
+        result = list(self._docstring_nodes_from_ast())
+        self._add_to_parse_cache_entry("docstrings", tuple(
+            (n.s, n.startpos.lineno, n.startpos.colno) for n in result))
+        return result
+
+    def _docstring_nodes_from_ast(self):
         # This is similar to C{ast.get_docstring}, but:
         #   - This function is recursive
         #   - This function yields the node object, rather than the string
@@ -1219,40 +1931,25 @@ class PythonBlock(object):
         #    if _ast_node_is_in_docstring_position(n)]
         # However, the method we now use is more straightforward, and doesn't
         # require first annotating each node with context information.
-        docstring_containers = (ast.FunctionDef, ast.ClassDef, ast.Module)
-        for node in _walk_ast_nodes_in_order(self.annotated_ast_node):
-            if not isinstance(node, docstring_containers):
-                continue
-            if not node.body:
-                continue
-            # If the first body item is a literal string, then yield the node.
-            if (isinstance(node.body[0], ast.Expr) and
-                isinstance(node.body[0].value, ast.Str)):
-                yield node.body[0].value
-            for i in xrange(1, len(node.body)-1):
-                # If a body item is an assignment and the next one is a
-                # literal string, then yield the node for the literal string.
-                n1, n2 = node.body[i], node.body[i+1]
-                if (isinstance(n1, ast.Assign) and
-                    isinstance(n2, ast.Expr) and
-                    isinstance(n2.value, ast.Str)):
-                    yield n2.value
-
-    def get_doctests(self):
-        r"""
-        Return doctests in this code.
-
-          >>> PythonBlock("x\n'''\n >>> foo(bar\n ...     + baz)\n'''\n").get_doctests()
-          [PythonBlock('foo(bar\n    + baz)\n', startpos=(3,2))]
+        # Only the docstring nodes themselves need to be annotated with
+        # positions.
+        _, docstring_nodes, _ = self._string_literal_scan
+        for toplevel_node, node in docstring_nodes:
+            _annotate_ast_str_startpos(node, toplevel_node)
+            yield node
+
+    def _iter_doctest_examples(self):
+        """
+        Yield the source of each doctest example in this code, without parsing
+        it.
 
-        @rtype:
-          C{list} of L{PythonStatement}s
+        @return:
+          Iterable of L{FileText}s, positioned where the examples are in this
+          code.
         """
         import doctest
         parser = doctest.DocTestParser()
-        doctest_blocks = []
         filename = self.filename
-        flags = self.flags
         for ast_node in self._get_docstring_nodes():
             try:
                 examples = parser.get_examples(ast_node.s)
@@ -1266,20 +1963,77 @@ class PythonBlock(object):
             for example in examples:
                 lineno = ast_node.startpos.lineno + example.lineno
                 colno = ast_node.startpos.colno + example.indent # dubious
-                text = FileText(example.source, filename=filename,
-                                startpos=(lineno,colno))
-                try:
-                    block = PythonBlock(text, flags=flags)
-                    block.ast_node # make sure we can parse
-                except Exception:
-                    blob = text.joined
-                    if len(blob) > 60:
-                        blob = blob[:60] + '...'
-                    logger.warning("Can't parse doctest; ignoring: %r", blob)
-                    continue
-                doctest_blocks.append(block)
+                yield FileText(example.source, filename=filename,
+                               startpos=(lineno,colno))
+
+    def get_doctests(self):
+        r"""
+        Return doctests in this code.
+
+          >>> PythonBlock("x\n'''\n >>> foo(bar\n ...     + baz)\n'''\n").get_doctests()
+          [PythonBlock('foo(bar\n    + baz)\n', startpos=(3,2))]
+
+        @rtype:
+          C{list} of L{PythonStatement}s
+        """
+        doctest_blocks = []
+        flags = self.flags
+        for text in self._iter_doctest_examples():
+            try:
+                block = PythonBlock(text, flags=flags)
+                block.ast_node # make sure we can parse
+            except Exception:
+                _warn_unparsable_doctest(text)
+                continue
+            doctest_blocks.append(block)
         return doctest_blocks
 
+    def get_doctests_block(self):
+        r"""
+        Return all doctests in this code as a single block.
+
+          >>> PythonBlock("'''\n >>> x = 1\n'''\ndef f():\n  '''\n  >>> f(x)\n  '''\n").get_doctests_block()
+          PythonBlock('x = 1\nf(x)\n')
+
+        This is like concatenating the result of L{get_doctests}, but the
+        examples are parsed together with a single C{compile} rather than one
+        at a time.  If that fails, the example at the position of the error is
+        skipped (with a warning) and the rest are parsed again.
+
+        The result doesn't have meaningful positions; it's meant for analyzing
+        the names that doctests use.
+
+        @rtype:
+          L{PythonBlock} or C{None}
+        @return:
+          The doctests, or C{None} if there are none.
+        """
+        texts = list(self._iter_doctest_examples())
+        flags = self.flags
+        while texts:
+            # Line number in the concatenation at which each example starts.
+            startlines = []
+            lineno = 1
+            for text in texts:
+                startlines.append(lineno)
+                lineno += len(text.lines) - 1
+            block = PythonBlock(''.join(t.joined for t in texts), flags=flags)
+            try:
+                block.ast_node
+                return block
+            except SyntaxError as e:
+                lineno = e.lineno or lineno
+            idx = max(bisect.bisect_right(startlines, lineno) - 1, 0)
+            # The error might be due to an earlier example, e.g. one with an
+            # unclosed bracket.  Find the last one that doesn't parse by
+            # itself, if any.
+            for i in xrange(idx, -1, -1):
+                if not PythonBlock(texts[i], flags=flags).parsable:
+                    idx = i
+                    break
+            _warn_unparsable_doctest(texts.pop(idx))
+        return None
+
     def __repr__(self):
         r = "%s(%r" % (type(self).__name__, self.text.joined)
         if self.filename:
@@ -0,0 +1,121 @@
+# pyflyby/_parsecache.py.
+# Copyright (C) 2017 Karl Chen.
+# License: MIT http://opensource.org/licenses/MIT
+
+"""
+On-disk cache of parse products of source files, shared across processes.
+
+Entries are addressed by a hash of the source text, the compiler flags and
+the interpreter version, so they never need to be invalidated: a changed file
+simply gets a new key.  The cache is only used if C{$PYFLYBY_PARSE_CACHE} is
+set to a nonempty value other than C{0}.
+
+An entry is a C{dict} with the following keys:
+  - C{flags}, C{source_flags}: the resolved compiler flags of the file, as
+    C{int}s.
+  - C{statements}: C{tuple} of C{(lineno, colno, kind)} for the start of each
+    top-level statement, where C{kind} is one of L{STATEMENT_KINDS}.
+  - C{string_literals}, C{docstrings}: C{tuple}s of C{(s, lineno, colno)}.
+Only C{flags} and C{source_flags} are always present; the other products are
+added to the entry as they're first needed.
+"""
+
+from __future__ import absolute_import, division, with_statement
+
+import cPickle
+import hashlib
+import os
+import sys
+
+from   pyflyby._file            import get_cache_dir
+from   pyflyby._log             import logger
+
+
+# Bump this whenever the format of cache entries changes.
+_CACHE_VERSION = 2
+
+STATEMENT_KINDS = ("blank", "import", "string", "code")
+
+
+def parse_cache_enabled():
+    """
+    Return whether the on-disk parse cache is enabled, i.e. whether
+    C{$PYFLYBY_PARSE_CACHE} is set to something other than C{""} or C{"0"}.
+
+    @rtype:
+      C{bool}
+    """
+    return os.environ.get("PYFLYBY_PARSE_CACHE", "") not in ("", "0")
+
+
+def parse_cache_key(joined, flags, auto_flags):
+    """
+    Compute the cache key for source text C{joined} parsed with the given
+    input flags.
+
+      >>> parse_cache_key("x = 1\\n", 0, False) == parse_cache_key("x = 1\\n", 0, False)
+      True
+      >>> parse_cache_key("x = 1\\n", 0, False) == parse_cache_key("x = 1\\n", 0, True)
+      False
+
+    @type joined:
+      C{str}
+    @type flags:
+      C{int}
+    @type auto_flags:
+      C{bool}
+    @rtype:
+      C{str}
+    """
+    h = hashlib.sha1()
+    h.update("%d\0%s\0%d\0%d\0" % (_CACHE_VERSION, sys.version, int(flags),
+                                   bool(auto_flags)))
+    h.update(joined)
+    return h.hexdigest()
+
+
+def _cache_filename(key):
+    return get_cache_dir("parse") / key[:2] / (key[2:] + ".pickle")
+
+
+def load_parse_cache_entry(key):
+    """
+    Load the cache entry for C{key}.
+
+    @rtype:
+      C{dict} or C{None}
+    @return:
+      The entry, or C{None} if there is no usable entry.
+    """
+    filename = _cache_filename(key)
+    try:
+        with open(str(filename), 'rb') as f:
+            entry = cPickle.load(f)
+    except (IOError, OSError):
+        return None
+    except Exception as e:
+        logger.debug("Parse cache: ignoring bad entry %s: %s: %s",
+                     filename, type(e).__name__, e)
+        return None
+    if not isinstance(entry, dict) or entry.get("version") != _CACHE_VERSION:
+        return None
+    return entry
+
+
+def save_parse_cache_entry(key, entry):
+    """
+    Save C{entry} as the cache entry for C{key}.  Failures are logged and
+    otherwise ignored, since the cache is only an optimization.
+    """
+    entry = dict(entry, version=_CACHE_VERSION)
+    filename = _cache_filename(key)
+    dirname = str(filename.dir)
+    temp_filename = "%s.tmp.%s" % (filename, os.getpid())
+    try:
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        with open(temp_filename, 'wb') as f:
+            cPickle.dump(entry, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(temp_filename, str(filename))
+    except (IOError, OSError) as e:
+        logger.debug("Parse cache: couldn't write %s: %s", filename, e)
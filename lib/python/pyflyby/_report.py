@@ -0,0 +1,177 @@
+# pyflyby/_report.py.
+# Copyright (C) 2017 Karl Chen.
+# License: MIT http://opensource.org/licenses/MIT
+
+"""
+Machine-readable reports of what a tool did to each file.
+
+While a file is processed with reporting enabled (C{--report}), its
+L{FileReport} is the current report.  The code that adds, removes or can't
+resolve imports records that with L{report_added}, L{report_removed} and
+L{report_unresolved}, and phases are timed with L{report_timing}.  These do
+nothing when no report is current, so the hooks cost next to nothing when
+reporting is off, and little more when it is on.
+
+L{ReportWriter} writes one JSON object per file and line, like::
+
+  {"filename": "a.py", "changed": true, "cached": false,
+   "added": ["import os"], "removed": ["from foo import bar"],
+   "unresolved": [{"name": "baz", "lineno": 7}], "error": null,
+   "timings": {"read": 0.0001, "parse": 0.0021, "analysis": 0.0034,
+               "format": 0.0005, "write": 0.0002, "total": 0.0063}}
+
+This module only imports the standard library, so that low-level modules
+such as L{pyflyby._parse} can use it.
+"""
+
+from __future__ import absolute_import, division, with_statement
+
+from   contextlib               import contextmanager
+import json
+import time
+
+
+# Phases of processing a file, in the order they're reported.  C{parse} is
+# the time spent compiling code to ASTs, C{format} the time spent rendering
+# output, and C{analysis} the rest of the time spent modifying the file.
+PHASES = ("read", "parse", "analysis", "format", "write")
+
+
+class FileReport(object):
+    """
+    What was done to one file, and how long each phase took.
+    """
+
+    def __init__(self, filename):
+        # Kept as a C{str} so that reports can be pickled, e.g. to send them
+        # from the worker processes of C{process_actions}.
+        self.filename = str(filename)
+        self.changed = None
+        self.cached = False
+        self.added = []
+        self.removed = []
+        self.unresolved = []
+        self.error = None
+        self.timings = {}
+
+    def add_time(self, phase, seconds):
+        self.timings[phase] = self.timings.get(phase, 0.0) + seconds
+
+    def to_dict(self):
+        """
+        Return this report as a JSON-serializable C{dict}.
+
+        @rtype:
+          C{dict}
+        """
+        timings = {}
+        for phase in PHASES:
+            timings[phase] = round(self.timings.get(phase, 0.0), 6)
+        timings["total"] = round(sum(timings.values()), 6)
+        return dict(
+            filename=self.filename,
+            changed=self.changed,
+            cached=self.cached,
+            added=self.added,
+            removed=self.removed,
+            unresolved=[dict(name=name, lineno=lineno)
+                        for name, lineno in self.unresolved],
+            error=self.error,
+            timings=timings)
+
+
+# The report for the file being processed, if any.
+_current = None
+
+
+@contextmanager
+def reporting_to(report):
+    """
+    Context manager that makes C{report} the current report.
+
+    @type report:
+      L{FileReport} or C{None}
+    """
+    global _current
+    orig = _current
+    _current = report
+    try:
+        yield
+    finally:
+        _current = orig
+
+
+# For each L{report_timing} in progress, the seconds spent in phases nested
+# in it so far.
+_nested_times = []
+
+
+@contextmanager
+def report_timing(phase):
+    """
+    Context manager that adds the time spent in it to C{phase} of the
+    current report.  Time spent in a nested L{report_timing} is only added to
+    the nested phase, so that no time is counted twice.
+    """
+    report = _current
+    if report is None:
+        yield
+        return
+    start = time.time()
+    _nested_times.append(0.0)
+    try:
+        yield
+    finally:
+        elapsed = time.time() - start
+        report.add_time(phase, elapsed - _nested_times.pop())
+        if _nested_times:
+            _nested_times[-1] += elapsed
+
+
+def report_added(imp):
+    """
+    Record that the import C{imp} was added to the current file.
+    """
+    if _current is not None:
+        _current.added.append(str(imp))
+
+
+def report_removed(imp):
+    """
+    Record that the import C{imp} was removed from the current file.
+    """
+    if _current is not None:
+        _current.removed.append(str(imp))
+
+
+def report_unresolved(name, lineno):
+    """
+    Record that C{name}, used on line C{lineno} of the current file, is
+    undefined and couldn't be imported.
+    """
+    if _current is not None:
+        _current.unresolved.append((str(name), lineno))
+
+
+class ReportWriter(object):
+    """
+    Writer of L{FileReport}s to a JSON-lines file.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._f = open(str(filename), "w")
+
+    def write(self, report):
+        """
+        Write C{report} as one line, and flush it so that the report can be
+        followed while a long run is in progress.
+
+        @type report:
+          L{FileReport}
+        """
+        self._f.write(json.dumps(report.to_dict(), sort_keys=True) + "\n")
+        self._f.flush()
+
+    def close(self):
+        self._f.close()
@@ -0,0 +1,316 @@
+# pyflyby/_symindex.py.
+# Copyright (C) 2017 Karl Chen.
+# License: MIT http://opensource.org/licenses/MIT
+
+from __future__ import absolute_import, division, with_statement
+
+import ast
+import cPickle
+from   collections              import defaultdict
+import hashlib
+import os
+import time
+
+from   pyflyby._file            import (FileText, Filename,
+                                        expand_py_files_from_args,
+                                        get_cache_dir)
+from   pyflyby._idents          import is_identifier
+from   pyflyby._importclns      import ImportSet
+from   pyflyby._importstmt      import Import
+from   pyflyby._log             import logger
+from   pyflyby._parse           import PythonBlock
+from   pyflyby._util            import cached_attribute
+
+
+# Bump this whenever the format of snapshot entries changes.
+_SNAPSHOT_VERSION = 1
+
+
+def _module_name_for_filename(filename, root, _is_package_dir):
+    """
+    Return the module name under which C{filename} is importable.
+
+    The module name is computed by walking up through package directories
+    (directories containing an C{__init__.py}).  Files that are not inside a
+    package are only considered importable if they live directly in C{root}.
+
+    @type filename:
+      L{Filename}
+    @type root:
+      L{Filename}
+    @param _is_package_dir:
+      Memoized function from L{Filename} to C{bool}.
+    @rtype:
+      C{str} or C{None}
+    @return:
+      The dotted module name, or C{None} if C{filename} doesn't look
+      importable.
+    """
+    if filename.ext != ".py":
+        return None
+    parts = [filename.base[:-3]]
+    if parts[0] == "__init__":
+        parts = []
+    dir = filename.dir
+    while _is_package_dir(dir):
+        parts.insert(0, dir.base)
+        parent = dir.dir
+        if parent == dir:
+            break
+        dir = parent
+    if dir == filename.dir and dir != root:
+        # Not in a package, and not a top-level module of the project.
+        return None
+    if not parts or not all(is_identifier(p) for p in parts):
+        return None
+    return ".".join(parts)
+
+
+def _find_toplevel_definitions(text):
+    """
+    Find the names defined at the top level of a module.
+
+      >>> _find_toplevel_definitions(FileText(
+      ...     'def f(): pass\\nclass C: pass\\nx, (y, _z) = 1, (2, 3)\\n'))
+      ('C', 'f', 'x', 'y')
+
+    Private names (starting with an underscore) are excluded.
+
+    @type text:
+      L{FileText}
+    @rtype:
+      C{tuple} of C{str}
+    """
+    block = PythonBlock(text, auto_flags=True)
+    names = set()
+    def add_targets(target):
+        if isinstance(target, ast.Name):
+            names.add(target.id)
+        elif isinstance(target, (ast.Tuple, ast.List)):
+            for elt in target.elts:
+                add_targets(elt)
+    for node in block.ast_node.body:
+        if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+            names.add(node.name)
+        elif isinstance(node, ast.Assign):
+            for target in node.targets:
+                add_targets(target)
+    return tuple(sorted(n for n in names if not n.startswith("_")))
+
+
+class SymbolIndex(object):
+    """
+    Index of top-level definitions in the modules of a project tree.
+
+    The index is kept up to date incrementally: on L{update}, only files
+    whose mtime or size changed since the last update are re-read, and only
+    those whose content hash changed are re-parsed.  The index is persisted
+    as a snapshot file so that subsequent processes can load it quickly.
+
+    @iattr root:
+      Root directory of the project.
+    @iattr snapshot_filename:
+      Where the snapshot of the index is stored.
+    @iattr updated_at:
+      Time of the last update of all files, or C{None} if the index hasn't
+      been loaded.
+    """
+
+    _cls_cache = {}
+
+    def __new__(cls, root, snapshot_filename=None):
+        root = Filename(root)
+        if snapshot_filename is not None:
+            snapshot_filename = Filename(snapshot_filename)
+        key = (root, snapshot_filename)
+        try:
+            return cls._cls_cache[key]
+        except KeyError:
+            pass
+        self = object.__new__(cls)
+        self.root = root
+        if snapshot_filename is None:
+            digest = hashlib.sha1(str(root)).hexdigest()
+            snapshot_filename = get_cache_dir("symindex") / (digest + ".pickle")
+        self.snapshot_filename = snapshot_filename
+        self._entries = None
+        self.num_parsed = 0
+        self.updated_at = None
+        cls._cls_cache[key] = self
+        return self
+
+    def _load_snapshot(self):
+        """
+        Load the previously saved entries, or an empty C{dict} if there is no
+        usable snapshot.
+        """
+        try:
+            with open(str(self.snapshot_filename), 'rb') as f:
+                data = cPickle.load(f)
+        except (IOError, OSError):
+            return {}
+        except Exception as e:
+            logger.debug("SymbolIndex: ignoring bad snapshot %s: %s: %s",
+                         self.snapshot_filename, type(e).__name__, e)
+            return {}
+        if (not isinstance(data, dict) or
+            data.get("version") != _SNAPSHOT_VERSION or
+            data.get("root") != str(self.root)):
+            return {}
+        return data["entries"]
+
+    def _save_snapshot(self):
+        data = dict(version=_SNAPSHOT_VERSION,
+                    root=str(self.root),
+                    entries=self._entries)
+        dirname = str(self.snapshot_filename.dir)
+        temp_filename = "%s.tmp.%s" % (self.snapshot_filename, os.getpid())
+        try:
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            with open(temp_filename, 'wb') as f:
+                cPickle.dump(data, f, cPickle.HIGHEST_PROTOCOL)
+            os.rename(temp_filename, str(self.snapshot_filename))
+        except (IOError, OSError) as e:
+            # The snapshot is only an optimization, so don't fail.
+            logger.debug("SymbolIndex: couldn't write %s: %s",
+                         self.snapshot_filename, e)
+
+    def update(self, filenames=None):
+        """
+        Bring the index up to date with the files on disk.
+
+        @type filenames:
+          sequence of L{Filename}s
+        @param filenames:
+          If not C{None}, then only check these files (those of them that
+          are under C{root}), e.g. because they are known to have changed.
+          This doesn't walk the project tree.  If the index hasn't been
+          loaded yet, all files are checked anyway.
+        @return:
+          C{self}
+        """
+        old_entries = self._entries
+        if old_entries is None:
+            old_entries = self._load_snapshot()
+            filenames = None
+        package_dirs = {}
+        def is_package_dir(dir):
+            try:
+                return package_dirs[dir]
+            except KeyError:
+                result = package_dirs[dir] = (dir / "__init__.py").isfile
+                return result
+        if filenames is None:
+            new_entries = {}
+            filenames = expand_py_files_from_args([self.root])
+            start_time = time.time()
+        else:
+            new_entries = dict(old_entries)
+            prefix = str(self.root).rstrip("/") + "/"
+            filenames = [Filename(f) for f in filenames
+                         if str(Filename(f)).startswith(prefix)]
+            start_time = None
+        num_parsed = 0
+        for filename in filenames:
+            key = str(filename)
+            new_entries.pop(key, None)
+            module_name = _module_name_for_filename(
+                filename, self.root, is_package_dir)
+            if module_name is None:
+                continue
+            try:
+                st = os.stat(key)
+            except OSError:
+                continue
+            old = old_entries.get(key)
+            if (old is not None and old[3] == module_name and
+                old[0] == st.st_mtime and old[1] == st.st_size):
+                new_entries[key] = old
+                continue
+            try:
+                with open(key, 'rU') as f:
+                    data = f.read()
+            except IOError:
+                continue
+            digest = hashlib.sha1(data).hexdigest()
+            if (old is not None and old[3] == module_name and
+                old[2] == digest):
+                names = old[4]
+            else:
+                try:
+                    names = _find_toplevel_definitions(
+                        FileText(data, filename=filename))
+                except Exception as e:
+                    logger.debug("SymbolIndex: can't parse %s: %s: %s",
+                                 filename, type(e).__name__, e)
+                    names = ()
+                num_parsed += 1
+            new_entries[key] = (st.st_mtime, st.st_size, digest,
+                                module_name, names)
+        logger.debug("SymbolIndex(%s): %d files, %d parsed",
+                     self.root, len(new_entries), num_parsed)
+        self.num_parsed = num_parsed
+        if start_time is not None:
+            self.updated_at = start_time
+        changed = (new_entries != old_entries)
+        self._entries = new_entries
+        if changed:
+            self._save_snapshot()
+            self.__dict__.pop("definitions", None)
+            self.__dict__.pop("digest", None)
+        return self
+
+    @cached_attribute
+    def definitions(self):
+        """
+        Map from top-level name to the names of modules that define it.
+
+        @rtype:
+          C{dict} from C{str} to C{tuple} of C{str}
+        """
+        if self._entries is None:
+            self.update()
+        d = defaultdict(set)
+        for entry in self._entries.itervalues():
+            module_name, names = entry[3], entry[4]
+            for name in names:
+                d[name].add(module_name)
+        return dict((k, tuple(sorted(v))) for k, v in d.iteritems())
+
+    @cached_attribute
+    def digest(self):
+        """
+        A string that changes whenever L{definitions} changes.  Unlike the
+        mtimes of the files, it doesn't change when a file is rewritten
+        without changing its top-level definitions.
+
+        @rtype:
+          C{str}
+        """
+        return hashlib.sha1(repr(sorted(self.definitions.items()))).hexdigest()
+
+
+def find_project_imports(roots):
+    """
+    Compute imports for the first-party names defined in the given project
+    trees, updating their indexes as necessary.
+
+    Names that are defined in more than one module are ambiguous, so they are
+    left out.
+
+    @type roots:
+      sequence of L{Filename}s
+    @rtype:
+      L{ImportSet}
+    """
+    d = defaultdict(set)
+    for root in roots:
+        for name, module_names in SymbolIndex(root).update().definitions.iteritems():
+            d[name].update(module_names)
+    imports = [
+        Import.from_parts("%s.%s" % (module_name, name), name)
+        for name, module_names in d.iteritems()
+        if len(module_names) == 1
+        for module_name in module_names ]
+    return ImportSet(imports)
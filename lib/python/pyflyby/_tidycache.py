@@ -0,0 +1,179 @@
+# pyflyby/_tidycache.py.
+# Copyright (C) 2017 Karl Chen.
+# License: MIT http://opensource.org/licenses/MIT
+
+"""
+On-disk record of source files that a command-line tool left unchanged.
+
+An entry is an empty file whose name is a hash of the source text, the
+tool's options, the import database fingerprint and the pyflyby code.  If
+the entry exists, then running the tool on that text with those inputs is
+known to produce the text unchanged, so the tool can skip the file without
+parsing it.  Entries never need to be invalidated, since any change to the
+inputs gives a new key; instead the least recently used entries are pruned
+when there are more than C{max_entries}.
+
+Entries are created atomically and lookups only C{stat} and touch them, so
+the cache can be shared by concurrent processes.
+"""
+
+from __future__ import absolute_import, division, with_statement
+
+import errno
+import hashlib
+import os
+import sys
+
+from   pyflyby._file            import Filename, get_cache_dir
+from   pyflyby._importdb        import ImportDB
+from   pyflyby._log             import logger
+from   pyflyby._util            import memoize
+
+
+# Bump this whenever the meaning of cache entries changes.
+_CACHE_VERSION = 1
+
+DEFAULT_MAX_ENTRIES = 100000
+
+
+def _compute_code_fingerprint():
+    """
+    Return a string that changes whenever the pyflyby library code or the
+    running script changes.
+
+    @rtype:
+      C{str}
+    """
+    h = hashlib.sha1()
+    h.update("%d\0%s\0" % (_CACHE_VERSION, sys.version))
+    lib_dir = Filename(__file__).real.dir
+    filenames = sorted(
+        str(lib_dir / f) for f in os.listdir(str(lib_dir)) if f.endswith(".py"))
+    filenames.append(os.path.realpath(sys.argv[0]))
+    for filename in filenames:
+        try:
+            st = os.stat(filename)
+        except OSError:
+            st = None
+        h.update("%s\0%r\0%r\0" % (filename,
+                                   st and st.st_size, st and st.st_mtime))
+    return h.hexdigest()
+
+
+_code_fingerprint = memoize(_compute_code_fingerprint)
+
+
+class TidyCache(object):
+    """
+    Cache of source texts that a tool leaves unchanged.
+
+    @iattr directory:
+      Directory in which entries are stored.
+    @iattr max_entries:
+      Number of entries to keep when pruning.
+    @iattr tool_key:
+      String identifying the tool and its options.
+    """
+
+    def __init__(self, tool_key, directory=None,
+                 max_entries=DEFAULT_MAX_ENTRIES):
+        if directory is None:
+            directory = get_cache_dir("tidy")
+        self.directory = Filename(directory)
+        self.max_entries = max_entries
+        self.tool_key = tool_key
+        self.num_added = 0
+
+    def key(self, text, filename):
+        """
+        Compute the key for running the tool on source text C{text} of
+        C{filename}.
+
+        @type text:
+          L{FileText}
+        @rtype:
+          C{str}
+        """
+        h = hashlib.sha1()
+        h.update("%s\0%s\0%s\0" % (
+            _code_fingerprint(),
+            ImportDB.get_default_fingerprint(filename),
+            self.tool_key))
+        for buf, start, end in text._ranges():
+            h.update(buffer(buf, start, end - start))
+        return h.hexdigest()
+
+    def _entry_filename(self, key):
+        return os.path.join(str(self.directory), key[:2], key[2:])
+
+    def __contains__(self, key):
+        """
+        Return whether there is an entry for C{key}.  If so, mark it as
+        recently used.
+        """
+        try:
+            os.utime(self._entry_filename(key), None)
+        except OSError:
+            return False
+        return True
+
+    def add(self, key):
+        """
+        Record that the tool leaves the text for C{key} unchanged.  Failures
+        are logged and otherwise ignored, since the cache is only an
+        optimization.
+        """
+        filename = self._entry_filename(key)
+        dirname = os.path.dirname(filename)
+        try:
+            if not os.path.isdir(dirname):
+                try:
+                    os.makedirs(dirname)
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+            os.close(os.open(filename, os.O_WRONLY|os.O_CREAT, 0o666))
+        except (IOError, OSError) as e:
+            logger.debug("Tidy cache: couldn't write %s: %s", filename, e)
+            return
+        self.num_added += 1
+
+    def prune(self):
+        """
+        If there are more than C{max_entries} entries, remove the least
+        recently used ones.  Entries removed concurrently by another process
+        are ignored.
+
+        This lists the whole cache, so it is only done if entries were added.
+        """
+        if not self.num_added:
+            return
+        entries = []
+        directory = str(self.directory)
+        try:
+            subdirs = os.listdir(directory)
+        except OSError:
+            return
+        for subdir in subdirs:
+            subdir = os.path.join(directory, subdir)
+            try:
+                names = os.listdir(subdir)
+            except OSError:
+                continue
+            entries.extend(os.path.join(subdir, name) for name in names)
+        excess = len(entries) - self.max_entries
+        if excess <= 0:
+            return
+        def mtime(filename):
+            try:
+                return os.stat(filename).st_mtime
+            except OSError:
+                return 0
+        entries.sort(key=mtime)
+        logger.debug("Tidy cache: removing %d of %d entries in %s",
+                     excess, len(entries), directory)
+        for filename in entries[:excess]:
+            try:
+                os.unlink(filename)
+            except OSError:
+                pass
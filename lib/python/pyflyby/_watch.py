@@ -0,0 +1,362 @@
+# pyflyby/_watch.py.
+# Copyright (C) 2017 Karl Chen.
+# License: MIT http://opensource.org/licenses/MIT
+
+"""
+Watching trees of python files for changes.
+
+On Linux, changes are reported by inotify, so after the initial listing
+nothing is rescanned: only new directories are listed, and only the files
+named in events are stat'ed.  Elsewhere, files and directories are polled
+with C{stat}.
+"""
+
+from __future__ import absolute_import, division, with_statement
+
+import errno
+import os
+import select
+import struct
+import time
+
+from   pyflyby._file            import Filename, UnsafeFilenameError
+from   pyflyby._log             import logger
+
+
+def _signature(filename):
+    """
+    Return something that changes when C{filename} is modified or replaced,
+    or C{None} if it doesn't exist.
+    """
+    try:
+        st = os.stat(str(filename))
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime)
+
+
+def _is_watched_dir_entry(filename):
+    # Same criteria as L{pyflyby._file.expand_py_files_from_args} uses for
+    # recursion.
+    return not (filename.base.startswith(".") or
+                filename.base == "__pycache__")
+
+
+class _FileWatcherBase(object):
+    """
+    Common code for L{_InotifyFileWatcher} and L{_PollingFileWatcher}.
+
+    Subclasses implement C{_watch_dir(dirname)}, and
+    C{_wait_for_events(timeout)}, which returns the files that may have
+    changed.
+    """
+
+    def __init__(self, pathnames):
+        # Map from each watched *.py file to its L{_signature}.
+        self._signatures = {}
+        # Files that were given explicitly, and their directories.  Only
+        # those files are watched in such directories, unless the
+        # directories are also watched recursively.
+        self._explicit_files = set()
+        self._dirs = set()
+        for pathname in pathnames:
+            pathname = Filename(pathname)
+            if pathname.isdir:
+                for f in self._add_dir(pathname):
+                    self._signatures[f] = _signature(f)
+            elif pathname.isfile:
+                self._explicit_files.add(pathname)
+                self._signatures[pathname] = _signature(pathname)
+                self._watch_dir(pathname.dir)
+            else:
+                raise OSError(errno.ENOENT, "No such file or directory: %s"
+                              % (pathname,))
+
+    @property
+    def filenames(self):
+        """
+        The files currently being watched.
+
+        @rtype:
+          C{list} of L{Filename}s
+        """
+        return sorted(self._signatures)
+
+    def _add_dir(self, dirname):
+        """
+        Watch C{dirname} recursively.
+
+        @return:
+          The *.py files in it.  These are not recorded as reported, so
+          files in directories created after startup are reported.
+        """
+        if dirname in self._dirs:
+            return []
+        self._dirs.add(dirname)
+        self._watch_dir(dirname)
+        result = []
+        try:
+            entries = dirname.list()
+        except OSError:
+            return []
+        for f in entries:
+            if not _is_watched_dir_entry(f):
+                continue
+            if f.isdir:
+                result.extend(self._add_dir(f))
+            elif f.ext == ".py" and f.isfile:
+                result.append(f)
+        return result
+
+    def _is_watched_file(self, filename):
+        if filename in self._explicit_files:
+            return True
+        return (filename.ext == ".py" and filename.dir in self._dirs and
+                _is_watched_dir_entry(filename))
+
+    def refresh(self, filename):
+        """
+        Record the current state of C{filename}, so that changes up to now
+        (e.g. our own) are not reported.
+        """
+        if filename in self._signatures:
+            self._signatures[filename] = _signature(filename)
+
+    def _changed(self, candidates):
+        """
+        Return the files among C{candidates} that have been created or
+        modified since they were last reported, and record them as reported.
+        """
+        result = []
+        for filename in candidates:
+            signature = _signature(filename)
+            if signature is None:
+                self._signatures.pop(filename, None)
+                continue
+            if self._signatures.get(filename) != signature:
+                self._signatures[filename] = signature
+                result.append(filename)
+        return result
+
+    def wait(self, delay):
+        """
+        Wait until some watched files have changed, and then until none have
+        changed for C{delay} seconds.
+
+        @rtype:
+          C{list} of L{Filename}s
+        @return:
+          The changed files, sorted.
+        """
+        changed = set()
+        deadline = None
+        while True:
+            if deadline is None:
+                timeout = None
+            else:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    return sorted(changed)
+            new = self._changed(self._wait_for_events(timeout))
+            if new:
+                changed.update(new)
+                deadline = time.time() + delay
+
+    def close(self):
+        pass
+
+
+class _PollingFileWatcher(_FileWatcherBase):
+    """
+    Watcher that stats all watched files and directories every
+    C{poll_interval} seconds.
+    """
+
+    def __init__(self, pathnames, poll_interval=1.0):
+        self._poll_interval = poll_interval
+        self._dir_mtimes = {}
+        _FileWatcherBase.__init__(self, pathnames)
+
+    def _watch_dir(self, dirname):
+        try:
+            self._dir_mtimes[dirname] = os.stat(str(dirname)).st_mtime
+        except OSError:
+            pass
+
+    def _wait_for_events(self, timeout):
+        if timeout is None:
+            timeout = self._poll_interval
+        time.sleep(min(timeout, self._poll_interval))
+        candidates = []
+        for dirname, mtime in self._dir_mtimes.items():
+            try:
+                new_mtime = os.stat(str(dirname)).st_mtime
+            except OSError:
+                del self._dir_mtimes[dirname]
+                self._dirs.discard(dirname)
+                continue
+            if new_mtime == mtime:
+                continue
+            self._dir_mtimes[dirname] = new_mtime
+            # Entries were added or removed; look for new files and
+            # directories.
+            try:
+                entries = dirname.list()
+            except OSError:
+                continue
+            for f in entries:
+                if f in self._dirs:
+                    continue
+                if self._is_watched_file(f):
+                    candidates.append(f)
+                elif (dirname in self._dirs and _is_watched_dir_entry(f)
+                      and f.isdir):
+                    candidates.extend(self._add_dir(f))
+        candidates.extend(self._signatures)
+        return candidates
+
+
+# Constants from <sys/inotify.h>.
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM  = 0x00000040
+_IN_MOVED_TO    = 0x00000080
+_IN_CREATE      = 0x00000100
+_IN_DELETE      = 0x00000200
+_IN_Q_OVERFLOW  = 0x00004000
+_IN_IGNORED     = 0x00008000
+_IN_ONLYDIR     = 0x01000000
+_IN_ISDIR       = 0x40000000
+_IN_NONBLOCK    = 0x00000800
+_IN_CLOEXEC     = 0x00080000
+
+_INOTIFY_MASK = (_IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_MOVED_FROM | _IN_CREATE
+                 | _IN_DELETE | _IN_ONLYDIR)
+
+_INOTIFY_EVENT = struct.Struct("iIII")
+
+
+def _load_libc_inotify():
+    """
+    Return the C library, if it has inotify functions.
+
+    @raise OSError:
+      inotify is not available.
+    """
+    import ctypes
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError) as e:
+        raise OSError(errno.ENOSYS, "inotify is not available: %s" % (e,))
+    return libc
+
+
+class _InotifyFileWatcher(_FileWatcherBase):
+    """
+    Watcher that uses Linux inotify.
+    """
+
+    def __init__(self, pathnames):
+        import ctypes
+        self._libc = _load_libc_inotify()
+        self._fd = self._libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self._fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, "inotify_init1: %s" % (os.strerror(e),))
+        self._wd_to_dir = {}
+        try:
+            _FileWatcherBase.__init__(self, pathnames)
+        except:
+            self.close()
+            raise
+
+    def _watch_dir(self, dirname):
+        import ctypes
+        wd = self._libc.inotify_add_watch(self._fd, str(dirname),
+                                          _INOTIFY_MASK)
+        if wd < 0:
+            e = ctypes.get_errno()
+            logger.warning("Can't watch %s: %s", dirname, os.strerror(e))
+            return
+        self._wd_to_dir[wd] = dirname
+
+    def _read_events(self):
+        try:
+            data = os.read(self._fd, 65536)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+        events = []
+        pos = 0
+        while pos < len(data):
+            wd, mask, _, length = _INOTIFY_EVENT.unpack_from(data, pos)
+            pos += _INOTIFY_EVENT.size
+            name = data[pos:pos+length].rstrip("\0")
+            pos += length
+            events.append((wd, mask, name))
+        return events
+
+    def _wait_for_events(self, timeout):
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return []
+        candidates = []
+        for wd, mask, name in self._read_events():
+            if mask & _IN_Q_OVERFLOW:
+                logger.warning("Too many changes at once; checking all files")
+                candidates.extend(self._signatures)
+                continue
+            dirname = self._wd_to_dir.get(wd)
+            if dirname is None:
+                continue
+            if mask & _IN_IGNORED:
+                # The directory was removed.
+                del self._wd_to_dir[wd]
+                self._dirs.discard(dirname)
+                continue
+            try:
+                filename = dirname / name
+            except UnsafeFilenameError:
+                continue
+            if mask & _IN_ISDIR:
+                if (mask & (_IN_CREATE | _IN_MOVED_TO) and
+                    dirname in self._dirs and _is_watched_dir_entry(filename)):
+                    candidates.extend(self._add_dir(filename))
+                elif mask & (_IN_DELETE | _IN_MOVED_FROM):
+                    self._dirs.discard(filename)
+                continue
+            if mask & (_IN_CLOSE_WRITE | _IN_MOVED_TO):
+                if self._is_watched_file(filename):
+                    candidates.append(filename)
+            elif mask & (_IN_DELETE | _IN_MOVED_FROM):
+                self._signatures.pop(filename, None)
+        return candidates
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+def file_watcher(pathnames, poll_interval=1.0):
+    """
+    Watch C{pathnames} for changes to python files.  Directories are watched
+    recursively for C{*.py} files, skipping hidden directories like
+    L{pyflyby._file.expand_py_files_from_args}.
+
+    Use inotify if available, else poll every C{poll_interval} seconds.
+
+    @type pathnames:
+      C{list} of L{Filename}s
+    @return:
+      Watcher object with a C{wait(delay)} method.
+    """
+    try:
+        return _InotifyFileWatcher(pathnames)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            raise
+        logger.debug("Polling for changes: %s", e)
+    return _PollingFileWatcher(pathnames, poll_interval=poll_interval)
@@ -191,7 +191,6 @@ setup(
         "License :: OSI Approved :: MIT License",
         "Programming Language :: Python",
     ],
-    install_requires=['pyflakes'],
     tests_require=['pexpect>=3.3', 'pytest', 'epydoc'],
     cmdclass = {
         'test'           : PyTest,
@@ -5,10 +5,14 @@
 
 from __future__ import absolute_import, division, with_statement
 
+import json
 import os
+from   shutil                   import rmtree
+import signal
 import subprocess
 import tempfile
 from   textwrap                 import dedent
+import time
 
 from   pyflyby._util            import EnvVarCtx
 
@@ -16,12 +20,13 @@ PYFLYBY_HOME = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 BIN_DIR = os.path.join(PYFLYBY_HOME, "bin")
 
 
-def pipe(command, stdin=""):
+def pipe(command, stdin="", cwd=None):
     return subprocess.Popen(
         command,
         stdin=subprocess.PIPE,
         stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT
+        stderr=subprocess.STDOUT,
+        cwd=cwd,
     ).communicate(stdin)[0].strip()
 
 
@@ -137,6 +142,107 @@ def test_tidy_imports_filename_action_replace_1():
     os.unlink(name)
 
 
+def test_tidy_imports_diff_1():
+    with tempfile.NamedTemporaryFile(suffix=".py") as f:
+        f.write(dedent('''
+            # hello
+            import a, b
+            a, os
+            x = 1
+        ''').lstrip())
+        f.flush()
+        result = pipe([BIN_DIR+"/tidy-imports", "--diff", "--quiet",
+                       "--no-add-mandatory", f.name])
+        expected = dedent('''
+            --- {f.name}
+            +++ {f.name}
+            @@ -1,4 +1,5 @@
+             # hello
+            -import a, b
+            +import a
+            +import os
+             a, os
+             x = 1
+        ''').strip().format(f=f)
+        assert result == expected
+
+
+def test_tidy_imports_report_1():
+    d = tempfile.mkdtemp(prefix="pyflyby_test_report_")
+    try:
+        with open(os.path.join(d, "a.py"), "w") as f:
+            f.write("import a, b\na, os, omgundefined_5923812\n")
+        with open(os.path.join(d, "b.py"), "w") as f:
+            f.write("import os\nos\n")
+        with open(os.path.join(d, "c.py"), "w") as f:
+            f.write("def (\n")
+        report = os.path.join(d, "report.jsonl")
+        proc = subprocess.Popen(
+            [BIN_DIR+"/tidy-imports", "--quiet", "--no-add-mandatory",
+             "--report", report, "a.py", "b.py", "c.py"],
+            cwd=d, stdin=open("/dev/null"),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        proc.communicate()
+        assert proc.returncode == 1
+        with open(report) as f:
+            records = [json.loads(line) for line in f]
+        assert [os.path.basename(r["filename"]) for r in records] == [
+            "a.py", "b.py", "c.py"]
+        a, b, c = records
+        assert a["changed"] is True
+        assert a["added"] == ["import os"]
+        assert a["removed"] == ["import b"]
+        assert a["unresolved"] == [
+            dict(name="omgundefined_5923812", lineno=2)]
+        assert a["error"] is None
+        assert sorted(a["timings"]) == [
+            "analysis", "format", "parse", "read", "total", "write"]
+        assert a["timings"]["parse"] > 0
+        assert b["changed"] is False
+        assert (b["added"], b["removed"], b["unresolved"]) == ([], [], [])
+        assert c["changed"] is None
+        assert c["error"].startswith("SyntaxError: ")
+    finally:
+        rmtree(d)
+
+
+def test_prune_broken_imports_jobs_1():
+    # Each distinct import is executed once per run, even with -j and a
+    # first file without imports, and the shared results are cleaned up.
+    d = tempfile.mkdtemp(prefix="pyflyby_test_prune_")
+    try:
+        os.mkdir(os.path.join(d, "lib"))
+        os.mkdir(os.path.join(d, "tmp"))
+        log = os.path.join(d, "log")
+        with open(os.path.join(d, "lib", "m4419207.py"), "w") as f:
+            f.write("open(%r, 'a').write('x')\n" % (log,))
+        with open(os.path.join(d, "a.py"), "w") as f:
+            f.write("x = 1\n")
+        filenames = [os.path.join(d, "a.py")]
+        for name in ["b", "c", "d"]:
+            filename = os.path.join(d, name + ".py")
+            with open(filename, "w") as f:
+                f.write("import m4419207, m5108325\nm4419207\n")
+            filenames.append(filename)
+        pythonpath = os.path.join(d, "lib")
+        if os.environ.get("PYTHONPATH"):
+            pythonpath += ":" + os.environ["PYTHONPATH"]
+        with EnvVarCtx(PYTHONPATH=pythonpath, TMPDIR=os.path.join(d, "tmp")):
+            proc = subprocess.Popen(
+                [BIN_DIR+"/prune-broken-imports", "--quiet", "-j", "2",
+                 "--action=replace"] + filenames,
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            output = proc.communicate()[0]
+        assert proc.returncode == 0, output
+        with open(filenames[1]) as f:
+            assert f.read() == "import m4419207\nm4419207\n"
+        with open(log) as f:
+            assert f.read() == "x"
+        assert os.listdir(os.path.join(d, "tmp")) == []
+    finally:
+        rmtree(d)
+
+
 def test_tidy_imports_no_add_no_remove_1():
     input = dedent('''
         import a, b, c
@@ -153,6 +259,271 @@ def test_tidy_imports_no_add_no_remove_1():
     assert result == expected
 
 
+def test_tidy_imports_jobs_1():
+    # Output with -j should be the same as without, in filename order.
+    tmpdir = tempfile.mkdtemp()
+    names = []
+    for i in range(6):
+        name = os.path.join(tmpdir, "f%d.py" % i)
+        with open(name, 'w') as f:
+            if i == 3:
+                f.write("def (\n")
+            else:
+                f.write(dedent('''
+                    import a, b
+                    a, os, x%d
+                ''' % i).lstrip())
+        names.append(name)
+    serial = pipe([BIN_DIR+"/tidy-imports", "-j", "1"] + names)
+    parallel = pipe([BIN_DIR+"/tidy-imports", "-j", "3"] + names)
+    assert "f3.py: SyntaxError" in parallel
+    assert serial.count("added 'import os'") == 5
+    strip_traceback = lambda s: [line for line in s.splitlines()
+                                 if not line.startswith(" ")]
+    assert strip_traceback(parallel) == strip_traceback(serial)
+    pipe([BIN_DIR+"/tidy-imports", "-j", "3", "-r"] + names)
+    for i, name in enumerate(names):
+        with open(name) as f:
+            result = f.read()
+        if i != 3:
+            assert "import os" in result
+            assert "import b" not in result
+        os.unlink(name)
+    os.rmdir(tmpdir)
+
+
+def test_tidy_imports_server_1():
+    tmpdir = tempfile.mkdtemp()
+    server_dir = os.path.join(tmpdir, "server")
+    cmd = [BIN_DIR+"/tidy-imports", "--server", "--no-add-mandatory"]
+    with EnvVarCtx(PYFLYBY_CACHE_DIR=tmpdir):
+        expected = pipe(cmd[:1] + cmd[2:], stdin="os, sys")
+        try:
+            # The first run starts the server and runs in-process.
+            assert pipe(cmd, stdin="os, sys") == expected
+            for _ in range(100):
+                if any(n.endswith(".sock") for n in os.listdir(server_dir)):
+                    break
+                time.sleep(0.1)
+            else:
+                raise AssertionError("server didn't start")
+            assert pipe(cmd, stdin="os, sys") == expected
+            assert pipe(cmd + ["--width=10"], stdin="os, sys") == (
+                pipe(cmd[:1] + cmd[2:] + ["--width=10"], stdin="os, sys"))
+        finally:
+            _kill_servers(server_dir)
+    rmtree(tmpdir)
+
+
+def test_tidy_imports_server_importdb_changed_1():
+    tmpdir = tempfile.mkdtemp()
+    server_dir = os.path.join(tmpdir, "server")
+    db = os.path.join(tmpdir, "known.py")
+    with open(db, 'w') as f:
+        f.write("from m3818211 import f5519231\n")
+    cmd = [BIN_DIR+"/tidy-imports", "--server", "--no-add-mandatory",
+           "--quiet", "--align=0", "--from-spaces=1"]
+    with EnvVarCtx(PYFLYBY_CACHE_DIR=tmpdir, PYFLYBY_PATH=db):
+        try:
+            _wait_for_server(cmd, server_dir)
+            # This request loads the import database in the server.
+            assert pipe(cmd, stdin="f5519231, f7712904") == dedent('''
+                from m3818211 import f5519231
+
+                f5519231, f7712904
+            ''').strip()
+            with open(db, 'a') as f:
+                f.write("from m3818211 import f7712904\n")
+            assert pipe(cmd, stdin="f5519231, f7712904") == dedent('''
+                from m3818211 import f5519231, f7712904
+
+                f5519231, f7712904
+            ''').strip()
+        finally:
+            _kill_servers(server_dir)
+    rmtree(tmpdir)
+
+
+def _wait_for_server(cmd, server_dir):
+    """
+    Run C{cmd}, which starts a server, and wait until the server listens.
+    """
+    pipe(cmd, stdin="")
+    for _ in range(100):
+        if any(n.endswith(".sock") for n in os.listdir(server_dir)):
+            return
+        time.sleep(0.1)
+    raise AssertionError("server didn't start")
+
+
+def _kill_servers(server_dir):
+    for name in os.listdir(server_dir):
+        if name.endswith(".lock"):
+            with open(os.path.join(server_dir, name)) as f:
+                pid = f.read().strip()
+            if pid:
+                os.kill(int(pid), signal.SIGTERM)
+
+
+def test_tidy_imports_watch_1():
+    tmpdir = tempfile.mkdtemp()
+    name = os.path.join(tmpdir, "a.py")
+    with open(name, 'w') as f:
+        f.write("x = 1\n")
+    proc = subprocess.Popen(
+        [BIN_DIR+"/tidy-imports", "--watch", "--watch-delay=0.1",
+         "--no-add-mandatory", tmpdir],
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    try:
+        assert proc.stdout.readline().strip() == (
+            "[PYFLYBY] Watching 1 files for changes")
+        os.mkdir(os.path.join(tmpdir, "sub"))
+        subname = os.path.join(tmpdir, "sub", "b.py")
+        with open(subname, 'w') as f:
+            f.write("sys.argv\n")
+        with open(name, 'w') as f:
+            f.write("os.path\n")
+        expected = {name: "import os\n\nos.path\n",
+                    subname: "import sys\n\nsys.argv\n"}
+        for _ in range(100):
+            result = {}
+            for n in expected:
+                with open(n) as f:
+                    result[n] = f.read()
+            if result == expected:
+                break
+            time.sleep(0.1)
+        assert result == expected
+    finally:
+        proc.terminate()
+        proc.wait()
+    rmtree(tmpdir)
+
+
+def test_tidy_imports_batch_1():
+    proc = subprocess.Popen(
+        [BIN_DIR+"/tidy-imports", "--batch", "--quiet", "--no-add-mandatory"],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    # The output for each file is written before the next one is read.
+    proc.stdin.write("/foo/a.py\0os.path\n\0")
+    proc.stdin.flush()
+    output = ""
+    while output.count("\0") < 2:
+        data = os.read(proc.stdout.fileno(), 4096)
+        assert data
+        output += data
+    assert output == "/foo/a.py\0import os\n\nos.path\n\0"
+    proc.stdin.write("/foo/__init__.py\0import sys\n\0/foo/b.py\0def (\n\0")
+    proc.stdin.close()
+    output = proc.stdout.read()
+    assert proc.wait() == 1
+    assert output == (
+        "/foo/__init__.py\0import sys\n\0/foo/b.py\0def (\n\0")
+
+
+def test_tidy_imports_cache_1():
+    tmpdir = tempfile.mkdtemp()
+    cache_dir = os.path.join(tmpdir, "cache")
+    tidy = os.path.join(tmpdir, "tidy.py")
+    with open(tidy, 'w') as f:
+        f.write(dedent('''
+            from __future__ import absolute_import, division, with_statement
+
+            import os
+
+            os.path
+        ''').lstrip())
+    untidy = os.path.join(tmpdir, "untidy.py")
+    with open(untidy, 'w') as f:
+        f.write("import sys\nos.path\n")
+    cmd = [BIN_DIR+"/tidy-imports", "--cache-dir", cache_dir, "--verbose",
+           "--action=ifchanged", tidy, untidy]
+    result = pipe(cmd)
+    assert "known to be unchanged" not in result
+    # Only the file that was left unchanged is recorded.
+    entries = [name for _, _, names in os.walk(cache_dir) for name in names]
+    assert len(entries) == 1
+    result = pipe(cmd)
+    assert "%s: known to be unchanged" % (tidy,) in result
+    assert "%s: known to be unchanged" % (untidy,) not in result
+    # Different options give a different key.
+    result = pipe(cmd + ["--width=70"])
+    assert "known to be unchanged" not in result
+    result = pipe(cmd + ["--cache-max-entries=1", "--no-add-mandatory"])
+    entries = [name for _, _, names in os.walk(cache_dir) for name in names]
+    assert len(entries) == 1
+    with open(untidy) as f:
+        assert f.read() == "import sys\nos.path\n"
+    rmtree(tmpdir)
+
+
+def _make_git_repo(files):
+    d = os.path.realpath(tempfile.mkdtemp())
+    for name, content in files.items():
+        if not os.path.isdir(os.path.dirname(os.path.join(d, name))):
+            os.makedirs(os.path.dirname(os.path.join(d, name)))
+        with open(os.path.join(d, name), 'w') as f:
+            f.write(content)
+    for cmd in [["git", "init", "-q"],
+                ["git", "add", "-A"],
+                ["git", "-c", "user.name=x", "-c", "user.email=x@x",
+                 "commit", "-q", "-m", "init"]]:
+        subprocess.check_call(cmd, cwd=d)
+    return d
+
+
+def test_tidy_imports_changed_since_1():
+    d = _make_git_repo({"a.py": "import os\nos\n",
+                        "sub/b.py": "import os\nos\n",
+                        "sub/c.py": "import os\nos\n"})
+    with open(os.path.join(d, "sub/b.py"), 'w') as f:
+        f.write("import sys\nos\n")
+    with open(os.path.join(d, "sub/new.py"), 'w') as f:
+        f.write("import re\nos\n")
+    with open(os.path.join(d, "new.txt"), 'w') as f:
+        f.write("import re\n")
+    cmd = [BIN_DIR+"/tidy-imports", "--no-add-mandatory", "--action=ifchanged",
+           "--action=print", "--changed-since=HEAD"]
+    result = pipe(cmd, cwd=d)
+    expected = dedent('''
+        [PYFLYBY] {d}/sub/b.py: removed unused 'import sys'
+        [PYFLYBY] {d}/sub/b.py: added 'import os'
+        import os
+        os
+        [PYFLYBY] {d}/sub/new.py: removed unused 'import re'
+        [PYFLYBY] {d}/sub/new.py: added 'import os'
+        import os
+        os
+    ''').strip().format(d=d)
+    assert result == expected
+    result = pipe(cmd + ["a.py"], cwd=d)
+    assert result == "[PYFLYBY] No changed python files"
+    rmtree(d)
+
+
+def test_tidy_imports_staged_1():
+    d = _make_git_repo({"a.py": "import os\nos\n"})
+    with open(os.path.join(d, "a.py"), 'w') as f:
+        f.write("import sys\nos\n")
+    subprocess.check_call(["git", "add", "a.py"], cwd=d)
+    with open(os.path.join(d, "a.py"), 'w') as f:
+        f.write("import sys\nos\nsys\n")
+    cmd = [BIN_DIR+"/tidy-imports", "--no-add-mandatory", "--staged"]
+    # The staged content is processed, not the working tree.
+    result = pipe(cmd + ["--quiet"], cwd=d)
+    assert result == "import os\nos"
+    # Unstaged changes aren't clobbered.
+    result = pipe(cmd + ["-r"], cwd=d)
+    assert "not replacing" in result
+    with open(os.path.join(d, "a.py")) as f:
+        assert f.read() == "import sys\nos\nsys\n"
+    subprocess.check_call(["git", "checkout", "-q", "a.py"], cwd=d)
+    pipe(cmd + ["-r"], cwd=d)
+    with open(os.path.join(d, "a.py")) as f:
+        assert f.read() == "import os\nos\n"
+    rmtree(d)
+
+
 def test_reformat_imports_1():
     input = dedent('''
         import zzt, megazeux
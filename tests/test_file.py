@@ -5,9 +5,12 @@
 
 from __future__ import absolute_import, division, with_statement
 
+import mmap
 import pytest
 
-from   pyflyby._file            import FilePos, FileText, Filename
+import pyflyby._file
+from   pyflyby._file            import (FilePos, FileText, Filename,
+                                        read_file, write_file)
 from   pyflyby._util            import CwdCtx
 
 def test_Filename_1():
@@ -341,6 +344,114 @@ def test_FileText_slice_out_of_range_empty_1():
         text[ (102,200) : (102,200) ]
 
 
+def test_FileText_slice_of_slice_1():
+    text = FileText("one\ntwo4567\nthree6789\nfour\n", startpos=(101,55))
+    result = text[ (102,3) : (104,3) ][ (103,2) : (104,1) ]
+    expected = FileText("hree6789\n", startpos=(103,2))
+    assert result == expected
+    assert result.endpos == FilePos(104,1)
+    assert result[103] == "hree6789"
+
+
+def test_FileText_slice_shares_buffer_1():
+    text = FileText("one\ntwo4567\nthree6789\nfour\n", startpos=(101,55))
+    result = text[ (102,3) : (103,8) ]
+    assert result._buffer is text._buffer
+    assert 'joined' not in result.__dict__
+    assert result.joined == "o4567\nthree67"
+
+
+def test_FileText_concatenate_adjacent_slices_1():
+    text = FileText("one\ntwo4567\nthree6789\nfour\n", startpos=(101,55))
+    pieces = [text[(101,56):(102,3)], text[(102,3):103], text[103:(104,2)]]
+    result = FileText.concatenate(pieces)
+    expected = FileText("ne\ntwo4567\nthree6789\nf", startpos=(101,56))
+    assert result == expected
+    assert result._buffer is text._buffer
+
+
+def test_FileText_concatenate_nonadjacent_1():
+    text = FileText("one\ntwo4567\nthree6789\nfour\n")
+    result = FileText.concatenate([text[1:2], text[3:4]])
+    assert result == FileText("one\nthree6789\n")
+
+
+def test_FileText_alter_startpos_slice_1():
+    text = FileText("one\ntwo4567\nthree6789\n")
+    result = text[2:4].alter(startpos=(5,3))
+    assert result == FileText("two4567\nthree6789\n", startpos=(5,3))
+    assert result[(6,1):(6,6)] == FileText("three", startpos=(6,1))
+
+
+def test_FileText_concatenate_lazy_1():
+    text = FileText("one\ntwo4567\nthree6789\nfour\n", filename="/foo")
+    result = FileText.concatenate([FileText("zero\n", filename="/foo"),
+                                   text[2:5]])
+    assert result._pieces is not None
+    assert result.endpos == FilePos(5,1)
+    # Slicing within a piece gives a slice of that piece.
+    rest = result[3:5]
+    assert rest._pieces is None
+    assert rest._buffer is text._buffer
+    assert rest == FileText("three6789\nfour\n", filename="/foo",
+                            startpos=(3,1))
+    # Slicing across pieces gives another lazy concatenation.
+    middle = result[(1,3):(2,4)]
+    assert middle._pieces is not None
+    assert middle == FileText("ro\ntwo", filename="/foo", startpos=(1,3))
+    assert result[2] == "two4567"
+    assert result._pieces is not None
+    assert result == FileText("zero\ntwo4567\nthree6789\nfour\n",
+                              filename="/foo")
+
+
+def test_FileText_concatenate_lazy_line_across_pieces_1():
+    text = FileText("abc\ndef\n")
+    result = FileText.concatenate([text[(1,1):(1,3)], "X", text[(1,3):3]])
+    assert result[1] == "abXc"
+    assert result[2] == "def"
+    assert result.lines == ("abXc", "def", "")
+
+
+def test_write_file_lazy_1(tmpdir):
+    text = FileText("one\ntwo\n")
+    result = FileText.concatenate(["zero\n", text])
+    filename = str(tmpdir.join("out.py"))
+    write_file(filename, result)
+    assert result._pieces is not None
+    with open(filename) as f:
+        assert f.read() == "zero\none\ntwo\n"
+
+
+def test_read_file_mmap_1(tmpdir, monkeypatch):
+    monkeypatch.setattr(pyflyby._file, "_MMAP_MIN_SIZE", 1)
+    filename = tmpdir.join("big.py")
+    filename.write("import os\nx = 1\n")
+    text = read_file(Filename(str(filename)))
+    assert isinstance(text._buffer, mmap.mmap)
+    assert text[2] == "x = 1"
+    assert text == FileText("import os\nx = 1\n", filename=str(filename))
+
+
+def test_read_file_mmap_crlf_1(tmpdir, monkeypatch):
+    monkeypatch.setattr(pyflyby._file, "_MMAP_MIN_SIZE", 1)
+    filename = tmpdir.join("big.py")
+    filename.write("import os\r\nx = 1\r\n", mode="wb")
+    text = read_file(Filename(str(filename)))
+    assert isinstance(text._buffer, str)
+    assert text.joined == "import os\nx = 1\n"
+
+
+def test_read_file_mmap_disabled_1(tmpdir, monkeypatch):
+    monkeypatch.setattr(pyflyby._file, "_MMAP_MIN_SIZE", 1)
+    monkeypatch.setattr(pyflyby._file, "mmap_enabled", False)
+    filename = tmpdir.join("big.py")
+    filename.write("import os\nx = 1\n")
+    text = read_file(Filename(str(filename)))
+    assert isinstance(text._buffer, str)
+    assert text.joined == "import os\nx = 1\n"
+
+
 def test_FileText_getitem_out_of_range_1():
     text = FileText("a\nb\nc\nd")
     with pytest.raises(IndexError):
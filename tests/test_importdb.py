@@ -10,6 +10,7 @@ from   shutil                   import rmtree
 from   tempfile                 import NamedTemporaryFile, mkdtemp
 from   textwrap                 import dedent
 
+from   pyflyby._file            import Filename
 from   pyflyby._importclns      import ImportMap, ImportSet
 from   pyflyby._importdb        import ImportDB
 from   pyflyby._importstmt      import Import
@@ -193,3 +194,104 @@ def test_ImportDB_pyflyby_forget_1():
         """)
         assert result == expected
         rmtree(d)
+
+
+def test_ImportDB_pyflyby_project_path_1():
+    d = mkdtemp("_pyflyby")
+    os.mkdir("%s/proj"%d)
+    os.mkdir("%s/proj/m31402757"%d)
+    with open("%s/proj/m31402757/__init__.py"%d, 'w') as f:
+        f.write("")
+    with open("%s/proj/m31402757/m2.py"%d, 'w') as f:
+        f.write("def f29581442(): pass\ndef f24519031(): pass\n")
+    with open("%s/known.py"%d, 'w') as f:
+        f.write("from m5910226 import f24519031\n")
+    with EnvVarCtx(PYFLYBY_PATH="%s/known.py"%d,
+                   PYFLYBY_PROJECT_PATH="%s/proj"%d,
+                   PYFLYBY_CACHE_DIR="%s/cache"%d):
+        db = ImportDB.get_default("/bin")
+    result = db.by_fullname_or_import_as["f29581442"]
+    expected = (Import("from m31402757.m2 import f29581442"),)
+    assert result == expected
+    result = db.by_fullname_or_import_as["f24519031"]
+    expected = (Import("from m5910226 import f24519031"),)
+    assert result == expected
+    rmtree(d)
+
+
+def test_ImportDB_default_fingerprint_1():
+    d = mkdtemp("_pyflyby")
+    with open("%s/known.py"%d, 'w') as f:
+        f.write("from m83271102 import f4410572\n")
+    with EnvVarCtx(PYFLYBY_PATH="%s/known.py"%d):
+        fp1 = ImportDB.get_default_fingerprint("/bin/x.py")
+        assert ImportDB.get_default_fingerprint("/bin") == fp1
+        with open("%s/known.py"%d, 'a') as f:
+            f.write("from m83271102 import f9129204\n")
+        # Memoized until the cache is cleared.
+        assert ImportDB.get_default_fingerprint("/bin") == fp1
+        ImportDB.clear_default_cache()
+        fp2 = ImportDB.get_default_fingerprint("/bin")
+    assert fp2 != fp1
+    assert ImportDB.get_default_fingerprint("/bin") != fp2
+    rmtree(d)
+
+
+def test_ImportDB_clear_default_cache_if_changed_1():
+    d = mkdtemp("_pyflyby")
+    with open("%s/known.py"%d, 'w') as f:
+        f.write("from m3818211 import f5519231\n")
+    with EnvVarCtx(PYFLYBY_PATH="%s/known.py"%d):
+        ImportDB.clear_default_cache()
+        db1 = ImportDB.get_default("/bin")
+        assert "f5519231" in db1.known_imports.by_import_as
+        # The first change after loading is noticed, even if nothing was
+        # checked before it.
+        with open("%s/known.py"%d, 'a') as f:
+            f.write("from m3818211 import f7712904\n")
+        ImportDB.clear_default_cache_if_changed()
+        ImportDB.clear_default_cache_if_changed()
+        db2 = ImportDB.get_default("/bin")
+        assert "f7712904" in db2.known_imports.by_import_as
+        # Unchanged files don't cause reloading.
+        ImportDB.clear_default_cache_if_changed()
+        assert ImportDB.get_default("/bin") is db2
+    ImportDB.clear_default_cache()
+    rmtree(d)
+
+
+def test_ImportDB_clear_default_cache_if_changed_project_1(monkeypatch):
+    d = mkdtemp("_pyflyby")
+    os.mkdir("%s/proj"%d)
+    m1 = "%s/proj/m2291847.py"%d
+    with open(m1, 'w') as f:
+        f.write("def f8130572(): pass\n")
+    with open("%s/known.py"%d, 'w') as f:
+        f.write("from m5713310 import f3312471\n")
+    with EnvVarCtx(PYFLYBY_PATH="%s/known.py"%d,
+                   PYFLYBY_PROJECT_PATH="%s/proj"%d,
+                   PYFLYBY_CACHE_DIR="%s/cache"%d):
+        ImportDB.clear_default_cache()
+        db1 = ImportDB.get_default("/bin")
+        assert "f8130572" in db1.known_imports.by_import_as
+        # Checking doesn't walk the project tree.
+        import pyflyby._symindex
+        def fail(args):
+            raise AssertionError("walked the project tree")
+        monkeypatch.setattr(pyflyby._symindex, "expand_py_files_from_args",
+                            fail)
+        # Rewriting a file without changing its definitions (e.g. by
+        # tidy-imports) doesn't cause reloading.
+        with open(m1, 'a') as f:
+            f.write("import os\n")
+        ImportDB.clear_default_cache_if_changed([Filename(m1)])
+        assert ImportDB.get_default("/bin") is db1
+        # New definitions in changed files are noticed.
+        with open(m1, 'a') as f:
+            f.write("def f6617302(): pass\n")
+        ImportDB.clear_default_cache_if_changed([Filename(m1)])
+        monkeypatch.undo()
+        db2 = ImportDB.get_default("/bin")
+        assert "f6617302" in db2.known_imports.by_import_as
+    ImportDB.clear_default_cache()
+    rmtree(d)
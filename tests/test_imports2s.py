@@ -10,13 +10,20 @@ import sys
 from   textwrap                 import dedent
 import types
 
+from   pyflyby._importclns      import NoSuchImportError
 from   pyflyby._importdb        import ImportDB
-from   pyflyby._imports2s       import (canonicalize_imports,
+from   pyflyby._importprobe     import ImportProber
+from   pyflyby._imports2s       import (ImportAlreadyExistsError,
+                                        LineNumberNotFoundError,
+                                        SourceToSourceFileImportsTransformation,
+                                        canonicalize_imports,
+                                        find_unused_and_missing_imports,
                                         fix_unused_and_missing_imports,
                                         reformat_import_statements,
                                         remove_broken_imports,
                                         replace_star_imports,
-                                        transform_imports)
+                                        tidy_imports, transform_imports)
+from   pyflyby._importstmt      import Import
 from   pyflyby._parse           import PythonBlock
 
 
@@ -103,6 +110,44 @@ def test_reformat_continuation_comments_1():
     assert expected == output
 
 
+def test_reformat_import_statements_header_only_1():
+    # Only the header needs to be parsed, so a syntax error later in the file
+    # doesn't matter.
+    input = PythonBlock(dedent('''
+        """Docstring."""
+        import foo.bar2, foo.bar1
+
+        x = (
+    ''').lstrip())
+    output = reformat_import_statements(input)
+    expected = dedent('''
+        """Docstring."""
+        import foo.bar1
+        import foo.bar2
+
+        x = (
+    ''').lstrip()
+    assert output.text.joined == expected
+
+
+def test_reformat_import_statements_after_code_1():
+    # Top-level imports after the header are reformatted too.
+    input = PythonBlock(dedent('''
+        import foo.bar2, foo.bar1
+        x = 1
+        import foo.bar4, foo.bar3
+    ''').lstrip())
+    output = reformat_import_statements(input)
+    expected = PythonBlock(dedent('''
+        import foo.bar1
+        import foo.bar2
+        x = 1
+        import foo.bar3
+        import foo.bar4
+    ''').lstrip())
+    assert output == expected
+
+
 def test_fix_unused_and_missing_imports_1():
     input = PythonBlock(dedent('''
         from foo import m1, m2, m3, m4
@@ -427,6 +472,28 @@ def test_fix_unused_and_missing_imports_doctests_2():
     assert output == expected
 
 
+def test_fix_unused_and_missing_imports_doctests_builtin_1():
+    input = PythonBlock(dedent('''
+        from m1 import f1, sum
+        def foo():
+            """
+              >>> sum([1])
+            """
+            return None
+    ''').lstrip())
+    db = ImportDB("")
+    output = fix_unused_and_missing_imports(input, db=db)
+    expected = PythonBlock(dedent('''
+        from m1 import sum
+        def foo():
+            """
+              >>> sum([1])
+            """
+            return None
+    ''').lstrip())
+    assert output == expected
+
+
 def test_fix_unused_and_missing_imports_xref_1():
     input = PythonBlock(dedent('''
         from m1 import f1, f2, f3
@@ -566,6 +633,158 @@ def test_fix_unused_and_missing_print_function_1():
     assert output == expected
 
 
+def test_find_unused_and_missing_imports_try_except_1():
+    input = PythonBlock(dedent('''
+        try:
+            import simplejson as json
+        except ImportError:
+            import json
+        try:
+            from m1 import f1
+        except ImportError:
+            from m2 import f1
+        json.dumps
+    ''').lstrip())
+    result = find_unused_and_missing_imports(input)
+    assert result == ([('f1', 6), ('f1', 8)], [])
+
+
+def test_find_unused_and_missing_imports_reimport_redefinition_1():
+    input = PythonBlock(dedent('''
+        from socket import socket
+        x = 1
+        from socket import socket
+        socket
+        import m1
+        import m1
+        m1
+    ''').lstrip())
+    result = find_unused_and_missing_imports(input)
+    assert result == ([('socket', 1)], [])
+
+
+def test_find_unused_and_missing_imports_except_as_redefinition_1():
+    input = PythonBlock(dedent('''
+        import e
+        try:
+            pass
+        except Exception as e:
+            pass
+    ''').lstrip())
+    result = find_unused_and_missing_imports(input)
+    assert result == ([('e', 1)], [])
+
+
+def test_fix_unused_and_missing_imports_repeated_1():
+    input = PythonBlock(dedent('''
+        import m1, m2
+        f(m1)
+        import m1, m3
+        import m3
+        m1
+        import m4, m4.a
+        m4.a.b
+    ''').lstrip())
+    db = ImportDB("from m5 import f")
+    output = fix_unused_and_missing_imports(input, db=db)
+    expected = PythonBlock(dedent('''
+        import m1
+        from m5 import f
+        f(m1)
+        import m1
+        m1
+        import m4
+        import m4.a
+        m4.a.b
+    ''').lstrip())
+    assert output == expected
+
+
+def test_fix_unused_and_missing_imports_all_1():
+    input = PythonBlock(dedent('''
+        from m1 import f1, f2, f3
+        __all__ = ['f1']
+        __all__ += ['f2']
+    ''').lstrip())
+    db = ImportDB("")
+    output = fix_unused_and_missing_imports(input, db=db)
+    expected = PythonBlock(dedent('''
+        from m1 import f1, f2
+        __all__ = ['f1']
+        __all__ += ['f2']
+    ''').lstrip())
+    assert output == expected
+
+
+def test_fix_unused_and_missing_imports_NameError_1():
+    input = PythonBlock(dedent('''
+        try:
+            x1
+        except NameError:
+            x1 = None
+        x2
+    ''').lstrip())
+    db = ImportDB("from m1 import x1, x2")
+    output = fix_unused_and_missing_imports(input, db=db)
+    expected = PythonBlock(dedent('''
+        from m1 import x2
+
+        try:
+            x1
+        except NameError:
+            x1 = None
+        x2
+    ''').lstrip())
+    assert output == expected
+
+
+def test_fix_unused_and_missing_imports_global_1():
+    input = PythonBlock(dedent('''
+        import m1, m2
+        def f():
+            global m1, x1
+            x1 = m1
+        def g():
+            return x1, x2
+    ''').lstrip())
+    db = ImportDB("from m3 import x1, x2")
+    output = fix_unused_and_missing_imports(input, db=db)
+    expected = PythonBlock(dedent('''
+        import m1
+        from m3 import x2
+        def f():
+            global m1, x1
+            x1 = m1
+        def g():
+            return x1, x2
+    ''').lstrip())
+    assert output == expected
+
+
+def test_fix_unused_and_missing_imports_comprehension_scope_1():
+    input = PythonBlock(dedent('''
+        {k: v for k, v in x1}
+        {v for v in x2}
+        k, v
+    ''').lstrip())
+    db = ImportDB("from m1 import k, v, x1, x2")
+    output = fix_unused_and_missing_imports(input, db=db)
+    expected = PythonBlock(dedent('''
+        from m1 import k, v, x1, x2
+
+        {k: v for k, v in x1}
+        {v for v in x2}
+        k, v
+    ''').lstrip())
+    assert output == expected
+
+
+def test_find_unused_and_missing_imports_star_1():
+    result = find_unused_and_missing_imports(
+        "from m1 import *\nimport m2\nx\n")
+    assert result == ([('m2', 2)], [])
+
+
 def test_last_line_no_trailing_newline_1():
     input = PythonBlock("#x\ny")
     db = ImportDB("from Y import y")
@@ -635,6 +854,33 @@ def test_remove_broken_imports_1():
     assert output == expected
 
 
+def test_remove_broken_imports_hang_crash_1(tmpdir, monkeypatch):
+    tmpdir.join("hang_7386421.py").write("import time\ntime.sleep(60)\n")
+    tmpdir.join("crash_7386421.py").write(
+        "import os, signal\nos.kill(os.getpid(), signal.SIGKILL)\n")
+    tmpdir.join("noisy_7386421.py").write(
+        "import sys\nprint 'hello'\nsys.stdin.read()\n")
+    monkeypatch.syspath_prepend(str(tmpdir))
+    input = PythonBlock(dedent('''
+        import hang_7386421, crash_7386421, noisy_7386421, os
+        from os import path, omgdoesntexist_3818212
+        code()
+    ''').lstrip(), filename="/foo/test_remove_broken_imports_hang_crash_1.py")
+    prober = ImportProber(jobs=2, timeout=2)
+    try:
+        output = remove_broken_imports(input, prober=prober)
+    finally:
+        prober.close()
+    expected = PythonBlock(dedent('''
+        import noisy_7386421
+        import os
+        from os import path
+        code()
+    ''').lstrip(), filename="/foo/test_remove_broken_imports_hang_crash_1.py")
+    assert output == expected
+    assert "noisy_7386421" not in sys.modules
+
+
 def test_replace_star_imports_1():
     m = types.ModuleType("fake_test_module_345489")
     m.__all__ = ['f1', 'f2', 'f3', 'f4', 'f5']
@@ -691,6 +937,24 @@ def test_transform_imports_1():
     assert output == expected
 
 
+def test_transform_imports_overlapping_1():
+    input = PythonBlock(dedent('''
+        from a.b import c, d
+        import a.b
+        import p.r
+        print a.b.c, a.b.d, self.p.r, a.bc, p, 1.e5
+    ''').lstrip(), filename="/foo/test_transform_imports_overlapping_1.py")
+    output = transform_imports(input, {"a.b": "x", "a.b.c": "y", "p": "q"})
+    expected = PythonBlock(dedent('''
+        import q.r
+        import x
+        import y as c
+        from x import d
+        print y, x.d, self.q.r, a.bc, q, 1.e5
+    ''').lstrip(), filename="/foo/test_transform_imports_overlapping_1.py")
+    assert output == expected
+
+
 def test_canonicalize_imports_1():
     input = PythonBlock(dedent('''
         from m import x
@@ -710,6 +974,88 @@ def test_canonicalize_imports_1():
     assert output == expected
 
 
+def test_tidy_imports_canonicalize_1():
+    input = PythonBlock(dedent('''
+        from m import x, w
+        print m.x, w, m.xx, y
+    ''').lstrip(), filename="/foo/test_tidy_imports_canonicalize_1.py")
+    db = ImportDB("""
+        from m2 import y
+        __canonical_imports__ = {"m.x": "m.y.z"}
+    """)
+    output = tidy_imports(input, db=db)
+    expected = PythonBlock(dedent('''
+        from m  import w
+        from m2 import y
+        print m.y.z, w, m.xx, y
+    ''').lstrip(), filename="/foo/test_tidy_imports_canonicalize_1.py")
+    assert output == expected
+
+
+def test_tidy_imports_replace_star_1():
+    m = types.ModuleType("fake_test_module_345490")
+    m.__all__ = ['f1', 'f2', 'f3']
+    sys.modules["fake_test_module_345490"] = m
+    input = PythonBlock(dedent('''
+        from fake_test_module_345489 import *
+        from mod1                    import f1
+        f1, f2
+    ''').lstrip(), filename="/foo/test_tidy_imports_replace_star_1.py")
+    output = tidy_imports(
+        input, replace_star=True, db=ImportDB(""),
+        transformations={"fake_test_module_345489": "fake_test_module_345490"})
+    expected = PythonBlock(dedent('''
+        from fake_test_module_345490 import f2
+        from mod1                    import f1
+        f1, f2
+    ''').lstrip(), filename="/foo/test_tidy_imports_replace_star_1.py")
+    assert output == expected
+
+
+def test_SourceToSourceFileImportsTransformation_batch_1():
+    input = PythonBlock(dedent('''
+        from m1 import a1, a2
+        import m2.b1
+
+        x = 1
+
+        from m3 import c1, c2
+        from m4 import *
+        from m4.d import d1
+        y = 2
+    ''').lstrip())
+    transformer = SourceToSourceFileImportsTransformation(input)
+    with transformer.batch():
+        transformer.remove_import(Import("from m1 import a2"), 1)
+        transformer.remove_import(Import("from m4 import *"), 6)
+        transformer.add_import(Import("from m3.e import e1"))
+        transformer.add_import(Import("import m2.b2"), 3)
+        transformer.add_import(Import("from m5 import f1"), 5)
+        with pytest.raises(NoSuchImportError):
+            transformer.remove_import(Import("from m1 import a2"), 2)
+        with pytest.raises(ImportAlreadyExistsError):
+            transformer.add_import(Import("from m1 import a1"), 5)
+        with pytest.raises(LineNumberNotFoundError):
+            transformer.remove_import(Import("from m3 import c1"), 4)
+        # Blocks are only updated at the end of the batch.
+        block = transformer.import_blocks[0]
+        assert Import("from m1 import a2") in block.importset
+    output = transformer.output()
+    expected = PythonBlock(dedent('''
+        import m2.b1
+        import m2.b2
+        from m1 import a1
+        from m5 import f1
+
+        x = 1
+
+        from m3   import c1, c2
+        from m3.e import e1
+        y = 2
+    ''').lstrip())
+    assert output == expected
+
+
 def test_empty_file_1():
     input = PythonBlock('', filename="/foo/test_empty_file_1.py")
     db = ImportDB("")
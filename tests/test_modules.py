@@ -7,13 +7,18 @@ from __future__ import absolute_import, division, with_statement
 
 
 import logging.handlers
+import os
 from   pyflyby._file            import Filename
 from   pyflyby._idents          import DottedIdentifier
-from   pyflyby._modules         import ModuleHandle
+from   pyflyby._modules         import ModuleHandle, _iter_modules
+from   pyflyby._util            import ImportPathCtx
 import re
+from   shutil                   import rmtree
 import subprocess
 import sys
+from   tempfile                 import mkdtemp
 from   textwrap                 import dedent
+import zipfile
 
 
 def test_ModuleHandle_1():
@@ -71,3 +76,80 @@ def test_filename_noload_1():
         sys.exit("multiprocessing" in sys.modules)
     ''')])
     assert retcode == 0
+
+
+def test_exists_noload_parent_1():
+    d = mkdtemp(prefix="pyflyby_test_modules_", suffix=".tmp")
+    try:
+        os.mkdir("%s/m73817262" % d)
+        with open("%s/m73817262/__init__.py" % d, 'w') as f:
+            f.write("raise Exception('imported m73817262')\n")
+        with open("%s/m73817262/m2.py" % d, 'w') as f:
+            f.write("")
+        with ImportPathCtx(d):
+            assert ModuleHandle("m73817262.m2").exists
+            assert not ModuleHandle("m73817262.m3").exists
+            assert not ModuleHandle("m73817262.m2.m4").exists
+            filename = ModuleHandle("m73817262.m2").filename
+            assert filename == Filename("%s/m73817262/m2.py" % d)
+            filename = ModuleHandle("m73817262").filename
+            assert filename == Filename("%s/m73817262/__init__.py" % d)
+        assert "m73817262" not in sys.modules
+    finally:
+        rmtree(d)
+
+
+def test_exists_nonexistent_toplevel_1():
+    assert not ModuleHandle("m19826384").exists
+    assert ModuleHandle("sys").exists
+    assert ModuleHandle("sys").filename is None
+
+
+def test_submodules_1():
+    d = mkdtemp(prefix="pyflyby_test_modules_", suffix=".tmp")
+    try:
+        os.mkdir("%s/m28361746" % d)
+        for fn in ["__init__.py", "a.py", "b.so", "c.txt", "d-e.py"]:
+            with open("%s/m28361746/%s" % (d, fn), 'w') as f:
+                f.write("")
+        os.mkdir("%s/m28361746/sub" % d)
+        with open("%s/m28361746/sub/__init__.py" % d, 'w') as f:
+            f.write("")
+        os.mkdir("%s/m28361746/notpkg" % d)
+        with ImportPathCtx(d):
+            m = ModuleHandle("m28361746")
+            result = [str(s.name) for s in m.submodules]
+            assert result == ["m28361746.a", "m28361746.b", "m28361746.sub"]
+            # Adding a module is noticed, even though the directory listing
+            # was cached.
+            with open("%s/m28361746/z.py" % d, 'w') as f:
+                f.write("")
+            m = ModuleHandle("m28361746")
+            m.__dict__.pop("submodules", None)
+            result = [str(s.name) for s in m.submodules]
+            assert result == ["m28361746.a", "m28361746.b", "m28361746.sub",
+                              "m28361746.z"]
+    finally:
+        rmtree(d)
+
+
+def test_iter_modules_zip_1():
+    d = mkdtemp(prefix="pyflyby_test_modules_", suffix=".tmp")
+    try:
+        zipname = "%s/m.zip" % d
+        with zipfile.ZipFile(zipname, 'w') as zf:
+            zf.writestr("m38201745.py", "")
+            zf.writestr("p38201745/__init__.py", "")
+            zf.writestr("p38201745/a.py", "")
+            zf.writestr("p38201745/sub/__init__.py", "")
+            zf.writestr("p38201745/sub/b.py", "")
+        result = sorted(_iter_modules([zipname]))
+        assert result == [("m38201745", False), ("p38201745", True)]
+        result = sorted(_iter_modules([os.path.join(zipname, "p38201745")]))
+        assert result == [("a", False), ("sub", True)]
+        with ImportPathCtx(zipname):
+            m = ModuleHandle("p38201745")
+            result = [str(s.name) for s in m.submodules]
+            assert result == ["p38201745.a", "p38201745.sub"]
+    finally:
+        rmtree(d)
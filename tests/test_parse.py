@@ -274,6 +274,40 @@ def test_PythonBlock_statements_all_comments_2():
     assert block.statements[0].block is block
 
 
+def test_PythonBlock_string_literals_order_1():
+    block = PythonBlock(dedent('''
+        def f(x='a', y={'b': 'c'}):
+            """
+            d
+            """
+            return 'e' if x else ('f'
+                'g')
+        z = """h
+        """ + 'i'
+    ''').lstrip())
+    result = [(n.s, n.startpos) for n in block.string_literals()]
+    expected = [('a'           , FilePos(1,9)),
+                ('b'           , FilePos(1,17)),
+                ('c'           , FilePos(1,22)),
+                ('\n    d\n    ', FilePos(2,5)),
+                ('e'           , FilePos(5,12)),
+                ('fg'          , FilePos(5,27)),
+                ('h\n'         , FilePos(7,5)),
+                ('i'           , FilePos(8,7))]
+    assert result == expected
+
+
+def test_PythonBlock_literal_brace_identifiers_1():
+    block = PythonBlock(dedent('''
+        """
+        See L{foo.bar} and L{baz}.
+        """
+        def f():
+            return "{x} {0} { y }".format(1, x=2)
+    ''').lstrip())
+    assert block.literal_brace_identifiers == frozenset(['baz', 'x'])
+
+
 def test_PythonBlock_doctest_1():
     block = PythonBlock(dedent("""
         # x
@@ -416,6 +450,37 @@ def test_PythonBlock_doctest_assignments_at_global_scope_1():
     assert block.get_doctests() == expected
 
 
+def test_PythonBlock_doctests_block_1():
+    block = PythonBlock(dedent("""
+        def f():
+            '''
+              >>> x = [1,
+              ...      2]
+              >>> f(x)
+            '''
+        def g():
+            '>>> g(y)'
+    """).lstrip())
+    assert block.get_doctests_block() == PythonBlock('x = [1,\n     2]\nf(x)\ng(y)\n')
+
+
+def test_PythonBlock_doctests_block_unparsable_1():
+    block = PythonBlock(dedent("""
+        def f():
+            '''
+              >>> a(
+              >>> b
+              >>> c d
+              >>> e
+            '''
+    """).lstrip())
+    assert block.get_doctests_block() == PythonBlock('b\ne\n')
+
+
+def test_PythonBlock_doctests_block_none_1():
+    assert PythonBlock("def f():\n  'x'\n").get_doctests_block() is None
+
+
 def test_PythonBlock_doctest_assignments_ClassDef_1():
     block = PythonBlock(dedent("""
         class C:
@@ -768,6 +833,174 @@ def test_str_lineno_concatenated_1():
     assert literals == expected_literals
 
 
+def test_str_lineno_no_tokenize_fallback_1(monkeypatch):
+    # If the tokenizer can't be used, we fall back to searching for the
+    # start of multiline strings.
+    import pyflyby._parse
+    monkeypatch.setattr(pyflyby._parse, "_find_string_positions",
+                        lambda text: None)
+    block = PythonBlock(dedent('''
+        x = 1
+        """A
+        a""" 'A'
+        y = ("""B
+        b""",
+             """C
+        c""")
+    ''').lstrip(), startpos=(101,1))
+    literals = [(f.s, f.startpos) for f in block.string_literals()]
+    expected_literals = [
+        ("A\naA", FilePos(102,1)),
+        ("B\nb" , FilePos(104,6)),
+        ("C\nc" , FilePos(106,6)),
+    ]
+    assert literals == expected_literals
+
+
+def test_PythonBlock_lazy_annotation_1():
+    block = PythonBlock(dedent('''
+        x = f('a',
+              'b')
+    ''').lstrip(), startpos=(101,1))
+    assert block.statements[0].startpos == FilePos(101,1)
+    # Computing statements doesn't annotate nested nodes.
+    call_node = block.annotated_ast_node.body[0].value
+    assert not hasattr(call_node, 'startpos')
+    literals = [(f.s, f.startpos) for f in block.string_literals()]
+    assert literals == [("a", FilePos(101,7)), ("b", FilePos(102,7))]
+    # Single-line string literals are positioned without annotating their
+    # ancestors.
+    assert not hasattr(call_node, 'startpos')
+
+
+def test_PythonBlock_deeply_nested_1():
+    # Annotation shouldn't hit the recursion limit.
+    block = PythonBlock("x = " + " + ".join(["'a'"] * 3000) + "\n")
+    literals = list(block.string_literals())
+    assert len(literals) == 3000
+    assert literals[-1].startpos == FilePos(1, 5 + 6*2999)
+
+
+def test_PythonBlock_split_header_1():
+    block = PythonBlock(dedent('''
+        """
+        Docstring.
+        x = 1
+        """
+        from __future__ import division
+        from foo import (bar,
+        baz)
+        # comment
+        def f():
+            import os
+    ''').lstrip(), startpos=(101,1))
+    header, rest = block.split_header()
+    assert header.text.joined == ('"""\nDocstring.\nx = 1\n"""\n'
+                                  'from __future__ import division\n'
+                                  'from foo import (bar,\nbaz)\n# comment\n')
+    assert 'ast_node' not in rest.__dict__
+    assert rest == PythonBlock("def f():\n    import os\n", startpos=(109,1))
+
+
+def test_PythonBlock_split_header_later_import_1():
+    block = PythonBlock(dedent('''
+        import os
+        x = 1
+        import sys
+    ''').lstrip())
+    assert block.split_header() is None
+
+
+def test_PythonBlock_split_header_wrapped_imports_1():
+    imports = "".join("from m%d import (\n    a,\n    b,\n)\n" % i
+                      for i in range(30))
+    block = PythonBlock(imports + "x = 1\n")
+    header, rest = block.split_header()
+    assert header.text.joined == imports
+    assert rest == PythonBlock("x = 1\n", startpos=(121,1))
+
+
+def test_PythonBlock_split_header_long_docstring_1():
+    doc = "".join("Line %d of the docstring.\n" % i for i in range(30))
+    header_text = '"""\n' + doc + '"""\nimport os\n'
+    block = PythonBlock(header_text + "x = 1\n")
+    header, rest = block.split_header()
+    assert header.text.joined == header_text
+    assert rest == PythonBlock("x = 1\n", startpos=(34,1))
+
+
+def test_PythonBlock_parse_cache_1(tmpdir, monkeypatch):
+    monkeypatch.setenv("PYFLYBY_CACHE_DIR", str(tmpdir))
+    monkeypatch.setenv("PYFLYBY_PARSE_CACHE", "1")
+    source = dedent('''
+        """
+        Module docstring.
+          >>> f(1)
+        """
+        from __future__ import print_function
+        # comment
+        import os
+
+        def f(x):
+            "Use L{sys}."
+            return os.path.join(x, 'y')
+    ''').lstrip()
+    def make_block():
+        return PythonBlock(FileText(source, filename="/foo/cached.py"))
+    block1 = make_block()
+    statements1 = block1.statements
+    assert tmpdir.join("parse").check(dir=True)
+    string_literals1 = [(n.s, n.startpos) for n in block1.string_literals()]
+    doctests1 = block1.get_doctests()
+    # A fresh block should get everything from the cache without parsing.
+    block2 = make_block()
+    statements2 = block2.statements
+    assert statements2 == statements1
+    assert [s.is_import for s in statements2] == [
+        False, True, False, True, False, False]
+    assert [s.is_comment_or_blank_or_string_literal for s in statements2] == [
+        True, False, True, False, True, False]
+    assert block2.flags == block1.flags
+    assert block2.source_flags == block1.source_flags
+    assert [(n.s, n.startpos) for n in block2.string_literals()] == (
+        string_literals1)
+    assert block2.get_doctests() == doctests1
+    assert 'ast_node' not in block2.__dict__
+    assert not any('ast_node' in s.block.__dict__ for s in statements2)
+
+
+def test_PythonBlock_parse_cache_lazy_1(tmpdir, monkeypatch):
+    # On a cache miss, only the products that are needed are computed and
+    # cached; the others are added to the entry when they're first needed.
+    monkeypatch.setenv("PYFLYBY_CACHE_DIR", str(tmpdir))
+    monkeypatch.setenv("PYFLYBY_PARSE_CACHE", "1")
+    source = '"""Doc."""\nimport os\nx = "a" + os.sep\n'
+    def make_block():
+        return PythonBlock(FileText(source, filename="/foo/lazy.py"))
+    expected_string_literals = [('Doc.', FilePos(1,1)), ('a', FilePos(3,5))]
+    block1 = make_block()
+    assert len(block1.statements) == 3
+    assert '_string_literal_scan' not in block1.__dict__
+    block2 = make_block()
+    assert len(block2.statements) == 3
+    assert 'ast_node' not in block2.__dict__
+    assert [(n.s, n.startpos) for n in block2.string_literals()] == (
+        expected_string_literals)
+    block3 = make_block()
+    assert [(n.s, n.startpos) for n in block3.string_literals()] == (
+        expected_string_literals)
+    assert len(block3.statements) == 3
+    assert 'ast_node' not in block3.__dict__
+
+
+def test_PythonBlock_parse_cache_disabled_1(tmpdir, monkeypatch):
+    monkeypatch.setenv("PYFLYBY_CACHE_DIR", str(tmpdir))
+    monkeypatch.delenv("PYFLYBY_PARSE_CACHE", raising=False)
+    block = PythonBlock(FileText("import os\nx = 1\n", filename="/foo/x.py"))
+    assert len(block.statements) == 2
+    assert not tmpdir.join("parse").check()
+
+
 def test_PythonBlock_compound_statements_1():
     block = PythonBlock(dedent('''
         foo(); bar()
@@ -1126,6 +1359,34 @@ def test_PythonBlock_auto_flags_pn_flagpf_futpf_1():
     assert     (block.source_flags         & "print_function")
 
 
+def test_PythonBlock_auto_flags_prescan_no_fallback_1():
+    import pyflyby._parse
+    count = pyflyby._parse.auto_flags_fallback_count
+    block = PythonBlock(dedent('''
+        x = 1
+        print x
+    ''').lstrip(), flags="print_function", auto_flags=True)
+    assert not (block.flags & "print_function")
+    block = PythonBlock(dedent('''
+        print(1)
+        print(42, file=x)
+    ''').lstrip(), auto_flags=True)
+    assert     (block.flags & "print_function")
+    assert pyflyby._parse.auto_flags_fallback_count == count
+
+
+def test_PythonBlock_auto_flags_prescan_strings_1():
+    # "print" in comments and strings doesn't count as evidence, so the
+    # ambiguous code is parsed with the given flags.
+    block = PythonBlock(dedent('''
+        """
+        Then print the value, or print it with print(x, file=f).
+        """
+        print(x) # print y
+    ''').lstrip(), auto_flags=True)
+    assert not (block.flags & "print_function")
+
+
 def test_PythonStatement_flags_1():
     block = PythonBlock("from __future__ import unicode_literals\nx\n",
                         flags="division")
@@ -0,0 +1,61 @@
+# pyflyby/test_report.py
+
+# License for THIS FILE ONLY: CC0 Public Domain Dedication
+# http://creativecommons.org/publicdomain/zero/1.0/
+
+from __future__ import absolute_import, division, with_statement
+
+import time
+
+from   pyflyby._cmdline         import Modifier
+from   pyflyby._file            import FileText, Filename
+from   pyflyby._report          import (FileReport, report_timing,
+                                        reporting_to)
+
+
+def _fake_clock(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+    return now
+
+
+def test_report_timing_nested_1(monkeypatch):
+    now = _fake_clock(monkeypatch)
+    report = FileReport("a.py")
+    with reporting_to(report):
+        with report_timing("analysis"):
+            now[0] += 1
+            with report_timing("format"):
+                now[0] += 2
+                with report_timing("parse"):
+                    now[0] += 4
+            with report_timing("parse"):
+                now[0] += 8
+            now[0] += 16
+    assert report.timings == dict(analysis=17, format=2, parse=12)
+    assert report.to_dict()["timings"]["total"] == 31
+
+
+def test_report_timing_no_report_1(monkeypatch):
+    now = _fake_clock(monkeypatch)
+    report = FileReport("a.py")
+    with reporting_to(report):
+        with report_timing("analysis"):
+            with reporting_to(None):
+                with report_timing("parse"):
+                    now[0] += 1
+    assert report.timings == dict(analysis=1)
+
+
+def test_Modifier_reread_not_timed_1(monkeypatch):
+    # In process_actions with jobs > 1, the worker's report, which already
+    # timed reading the file, is attached to the parent's Modifier.
+    now = _fake_clock(monkeypatch)
+    def read(filename):
+        now[0] += 1
+        return FileText("x = 1\n", filename=filename)
+    m = Modifier(lambda x: x, Filename("/foo/a.py"), read_function=read)
+    m.report = FileReport(m.filename)
+    m.report.add_time("read", 5)
+    assert m.input_content.joined == "x = 1\n"
+    assert m.report.timings == dict(read=5)
@@ -0,0 +1,119 @@
+# pyflyby/test_symindex.py
+
+# License for THIS FILE ONLY: CC0 Public Domain Dedication
+# http://creativecommons.org/publicdomain/zero/1.0/
+
+from __future__ import absolute_import, division, with_statement
+
+import os
+import pytest
+from   shutil                   import rmtree
+from   tempfile                 import mkdtemp
+from   textwrap                 import dedent
+
+from   pyflyby._file            import Filename
+from   pyflyby._importclns      import ImportSet
+from   pyflyby._symindex        import SymbolIndex, find_project_imports
+
+
+@pytest.fixture
+def tmp(request):
+    """
+    A temporary directory containing a project tree and a snapshot file.
+    """
+    d = Filename(mkdtemp(prefix="pyflyby_test_symindex_", suffix=".tmp")).real
+    os.mkdir(str(d/"proj"))
+    request.addfinalizer(lambda: rmtree(str(d)))
+    return d
+
+
+def writetext(filename, text):
+    with open(str(filename), 'w') as f:
+        f.write(dedent(text))
+
+
+def _make_project(proj):
+    os.mkdir(str(proj/"pkg4372"))
+    writetext(proj/"pkg4372/__init__.py", "")
+    writetext(proj/"pkg4372/m1.py", """
+        def f93251(): pass
+        class C93252(object): pass
+        _f93253 = 1
+    """)
+    os.mkdir(str(proj/"pkg4372/sub"))
+    writetext(proj/"pkg4372/sub/__init__.py", "x93254, y93255 = 1, 2\n")
+    os.mkdir(str(proj/"scripts"))
+    writetext(proj/"scripts/s1.py", "def f93256(): pass\n")
+    writetext(proj/"toplevel4372.py", "def f93257(): pass\n")
+
+
+def test_SymbolIndex_definitions_1(tmp):
+    _make_project(tmp/"proj")
+    index = SymbolIndex(tmp/"proj", snapshot_filename=tmp/"snapshot")
+    result = index.update().definitions
+    expected = {
+        'C93252': ('pkg4372.m1',),
+        'f93251': ('pkg4372.m1',),
+        'f93257': ('toplevel4372',),
+        'x93254': ('pkg4372.sub',),
+        'y93255': ('pkg4372.sub',),
+    }
+    assert result == expected
+    assert index.num_parsed == 4
+
+
+def test_SymbolIndex_incremental_1(tmp):
+    _make_project(tmp/"proj")
+    index = SymbolIndex(tmp/"proj", snapshot_filename=tmp/"snapshot")
+    index.update()
+    index.update()
+    assert index.num_parsed == 0
+    writetext(tmp/"proj/pkg4372/m1.py", "def f93258(): pass\n")
+    definitions = index.update().definitions
+    assert index.num_parsed == 1
+    assert definitions["f93258"] == ('pkg4372.m1',)
+    assert "f93251" not in definitions
+
+
+def test_SymbolIndex_snapshot_1(tmp):
+    _make_project(tmp/"proj")
+    SymbolIndex(tmp/"proj", snapshot_filename=tmp/"snapshot").update()
+    assert (tmp/"snapshot").exists
+    # Simulate a fresh process.
+    SymbolIndex._cls_cache.clear()
+    index = SymbolIndex(tmp/"proj", snapshot_filename=tmp/"snapshot")
+    definitions = index.update().definitions
+    assert index.num_parsed == 0
+    assert definitions["f93251"] == ('pkg4372.m1',)
+
+
+def test_find_project_imports_ambiguous_1(tmp):
+    _make_project(tmp/"proj")
+    writetext(tmp/"proj/pkg4372/m2.py", "def f93251(): pass\n")
+    imports = find_project_imports([tmp/"proj"])
+    assert "f93251" not in imports.by_import_as
+    assert imports.by_import_as["f93257"] == ImportSet(
+        "from toplevel4372 import f93257").imports
+
+
+def test_SymbolIndex_update_filenames_1(tmp, monkeypatch):
+    _make_project(tmp/"proj")
+    index = SymbolIndex(tmp/"proj", snapshot_filename=tmp/"snapshot")
+    digest = index.update().digest
+    import pyflyby._symindex
+    def fail(args):
+        raise AssertionError("walked the project tree")
+    monkeypatch.setattr(pyflyby._symindex, "expand_py_files_from_args", fail)
+    writetext(tmp/"proj/pkg4372/m1.py", """
+        def f93251(): pass
+        class C93252(object): pass
+    """)
+    index.update([tmp/"proj/pkg4372/m1.py", tmp/"elsewhere.py"])
+    assert index.num_parsed == 1
+    assert index.digest == digest
+    writetext(tmp/"proj/pkg4372/m1.py", "def f93259(): pass\n")
+    definitions = index.update([tmp/"proj/pkg4372/m1.py"]).definitions
+    assert definitions["f93259"] == ('pkg4372.m1',)
+    assert "f93251" not in definitions
+    assert definitions["f93257"] == ('toplevel4372',)
+    assert index.digest != digest